@@ -0,0 +1,434 @@
+import json
+import logging
+import platform
+import sys
+from getopt import getopt
+from itertools import product
+from multiprocessing import Value
+from os import (
+    getpid,
+    sysconf,
+)
+from shutil import rmtree
+from socket import (
+    create_connection,
+    socket,
+    AF_INET,
+    SHUT_WR,
+    SOCK_STREAM,
+)
+from struct import Struct
+from tempfile import mkdtemp
+from threading import Thread
+from time import (
+    monotonic,
+    sleep,
+    strftime,
+)
+
+from kamui.base_stream import (
+    BaseClient,
+    BaseServer,
+)
+from kamui.proxy_runner import (
+    ClientWorkspaceProcess,
+    ServerWorkspaceProcess,
+)
+from kamui.tcp_on_fs.sim_io import (
+    parse_sim_profile,
+    SimulatedFsTcpTunnelIO,
+)
+
+
+# --- the target server ---
+#
+# The first byte of a tcp connection picks the service:
+#   'E': echo everything back
+#   'S': sink, read until EOF, then reply the byte count
+
+MODE_ECHO = b'E'
+MODE_SINK = b'S'
+SINK_REPLY = Struct('>Q')
+
+
+def _serve_one(conn):
+    try:
+        mode = conn.recv(1)
+        if mode == MODE_ECHO:
+            while True:
+                data = conn.recv(65536)
+                if not data:
+                    break
+                conn.sendall(data)
+        elif mode == MODE_SINK:
+            total = 0
+            while True:
+                data = conn.recv(65536)
+                if not data:
+                    break
+                total += len(data)
+            conn.sendall(SINK_REPLY.pack(total))
+        conn.shutdown(SHUT_WR)
+    except OSError:
+        pass
+    finally:
+        conn.close()
+
+
+def start_target_server():
+    sock = socket(AF_INET, SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    sock.listen(128)
+
+    def serve():
+        while True:
+            conn, _ = sock.accept()
+            thr = Thread(target=_serve_one, args=(conn,))
+            thr.daemon = True
+            thr.start()
+
+    thr = Thread(target=serve)
+    thr.daemon = True
+    thr.start()
+    return sock.getsockname()
+
+
+def free_port():
+    sock = socket(AF_INET, SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+# --- counting io ops ---
+
+class CountingIO(SimulatedFsTcpTunnelIO):
+    # Every operation on the shared medium, counted across the processes.
+    # The medium is a plain local dir unless a sim profile is given.
+    ops = None  # a multiprocessing.Value, set before the proxies start
+
+    @classmethod
+    def count(cls):
+        with cls.ops.get_lock():
+            cls.ops.value += 1
+
+    @classmethod
+    def delete(cls, workspace, zone_id):
+        cls.count()
+        return super(CountingIO, cls).delete(workspace, zone_id)
+
+    def write(self, data):
+        self.count()
+        return super(CountingIO, self).write(data)
+
+    def read(self, create=False):
+        self.count()
+        return super(CountingIO, self).read(create)
+
+    def append(self, data):
+        self.count()
+        return super(CountingIO, self).append(data)
+
+    def read_at(self, offset):
+        self.count()
+        return super(CountingIO, self).read_at(offset)
+
+    def claim(self):
+        self.count()
+        return super(CountingIO, self).claim()
+
+
+class CountingClient(BaseClient):
+    IO = CountingIO
+
+
+class CountingServer(BaseServer):
+    IO = CountingIO
+
+
+class CountingClientWorkspaceProcess(ClientWorkspaceProcess):
+    PROXY_CLIENT = CountingClient
+
+
+class CountingServerWorkspaceProcess(ServerWorkspaceProcess):
+    PROXY_SERVER = CountingServer
+
+
+def cpu_secs(pid):
+    # user + system time of a running process
+    with open('/proc/%d/stat' % pid) as fd:
+        fields = fd.read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / sysconf('SC_CLK_TCK')
+
+
+# --- measurements ---
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def wait_listening(address, timeout=30):
+    deadline = monotonic() + timeout
+    while True:
+        try:
+            create_connection(address, timeout=1).close()
+            return
+        except OSError:
+            if monotonic() > deadline:
+                raise
+            sleep(0.05)
+
+
+def measure_connect(address, rounds):
+    # A tcp connect to the client proxy returns at once, the proxy
+    # connection is set up behind it. So the connect latency is taken
+    # as the time until the first byte comes back through the tunnel.
+    latencies = []
+    for _ in range(rounds):
+        start_time = monotonic()
+        conn = create_connection(address)
+        conn.sendall(MODE_ECHO + b'x')
+        conn.recv(1)
+        latencies.append(monotonic() - start_time)
+        conn.close()
+    return latencies
+
+
+def _rpc_loop(address, count, size, latencies):
+    conn = create_connection(address)
+    conn.sendall(MODE_ECHO)
+    request = b'r' * size
+    for _ in range(count):
+        start_time = monotonic()
+        conn.sendall(request)
+        received = 0
+        while received < size:
+            data = conn.recv(size - received)
+            if not data:
+                raise ConnectionError('closed by the proxy')
+            received += len(data)
+        latencies.append(monotonic() - start_time)
+    conn.close()
+
+
+def measure_rpc(address, concurrency, count, size):
+    latencies = []
+    threads = [Thread(target=_rpc_loop, args=(address, count, size, latencies))
+               for _ in range(concurrency)]
+    for thr in threads:
+        thr.start()
+    for thr in threads:
+        thr.join()
+    return latencies
+
+
+def _bulk_send(address, payload_size, errors):
+    try:
+        conn = create_connection(address)
+        conn.sendall(MODE_SINK)
+        chunk = b'b' * 65536
+        left = payload_size
+        while left > 0:
+            conn.sendall(chunk[:left])
+            left -= len(chunk)
+        conn.shutdown(SHUT_WR)
+        reply = b''
+        while len(reply) < SINK_REPLY.size:
+            data = conn.recv(SINK_REPLY.size - len(reply))
+            if not data:
+                break
+            reply += data
+        conn.close()
+        if len(reply) != SINK_REPLY.size or SINK_REPLY.unpack(reply)[0] != payload_size:
+            errors.append('bad sink reply: %r' % reply)
+    except OSError as ex:
+        errors.append(str(ex))
+
+
+def measure_bulk(address, concurrency, payload_size):
+    errors = []
+    threads = [Thread(target=_bulk_send, args=(address, payload_size, errors))
+               for _ in range(concurrency)]
+    start_time = monotonic()
+    for thr in threads:
+        thr.start()
+    for thr in threads:
+        thr.join()
+    elapsed = monotonic() - start_time
+    if errors:
+        raise ConnectionError('; '.join(errors))
+    return elapsed
+
+
+def run_case(case, options):
+    workspace = mkdtemp(prefix='kamui-bench-')
+    target_address = start_target_server()
+    listen_address = ('127.0.0.1', free_port())
+    ops = Value('L', 0)
+    CountingIO.ops = ops
+
+    common = {
+        'flush_deadline':       options['flush_deadline'],
+        'iops':                 case['iops'],
+        'max_segment_size':     options['max_segment_size'],
+        'proxy_address':        'bench',
+        'time_slice_interval':  case['time_slice_interval'],
+        'window_size':          case['window_size'],
+        'workspace':            workspace,
+    }
+    server = CountingServerWorkspaceProcess(dict(common, target_address=target_address))
+    client = CountingClientWorkspaceProcess(dict(common, listen_address=listen_address))
+    server.start()
+    client.start()
+    try:
+        wait_listening(listen_address)
+
+        connect = measure_connect(listen_address, options['connect_rounds'])
+        rpc = measure_rpc(listen_address, case['concurrency'],
+                          options['rpc_count'], options['rpc_size'])
+
+        cpu_before = cpu_secs(client.pid) + cpu_secs(server.pid)
+        ops_before = ops.value
+        elapsed = measure_bulk(listen_address, case['concurrency'], case['payload_size'])
+        cpu = cpu_secs(client.pid) + cpu_secs(server.pid) - cpu_before
+        io_ops = ops.value - ops_before
+    finally:
+        client.terminate()
+        server.terminate()
+        client.join()
+        server.join()
+        rmtree(workspace, ignore_errors=True)
+
+    mb = case['concurrency'] * case['payload_size'] / 1024 / 1024
+    return dict(case, **{
+        'bulk_mb_per_sec':      mb / elapsed,
+        'connect_ms_p50':       percentile(connect, 50) * 1000,
+        'connect_ms_p99':       percentile(connect, 99) * 1000,
+        'rpc_ms_p50':           percentile(rpc, 50) * 1000,
+        'rpc_ms_p99':           percentile(rpc, 99) * 1000,
+        'cpu_secs_per_mb':      cpu / mb,
+        'io_ops_per_mb':        io_ops / mb,
+    })
+
+
+# --- command line ---
+
+DEFAULT_CONCURRENCY = '1,8'
+DEFAULT_CONNECT_ROUNDS = 10
+DEFAULT_FLUSH_DEADLINE = 10
+DEFAULT_IOPS = '100,1000'
+DEFAULT_MAX_SEGMENT_SIZE = 1024 * 1024
+DEFAULT_PAYLOAD_SIZE = '262144,4194304'
+DEFAULT_RPC_COUNT = 50
+DEFAULT_RPC_SIZE = 64
+DEFAULT_TIME_SLICE_INTERVAL = '1,10'
+DEFAULT_WINDOW_SIZE = '8'
+
+
+def usage():
+    sys.stderr.writelines([
+        'Usage: %s <ARGS> \n' % sys.argv[0],
+        '  <ARGS> can be: \n',
+        '  <LIST> is comma separated numbers, every combination of the lists is run.\n',
+        '  --concurrency <LIST>             (OPTIONAL,DEFAULT=%s) parallel tcp connections.\n' % DEFAULT_CONCURRENCY,
+        '  --connect-rounds <NUMBER>        (OPTIONAL,DEFAULT=%s) fresh connections for the connect latency.\n' % DEFAULT_CONNECT_ROUNDS,
+        '  --flush-deadline <NUMBER>        (OPTIONAL,DEFAULT=%s) passed to both proxies.\n' % DEFAULT_FLUSH_DEADLINE,
+        '  --iops <LIST>                    (OPTIONAL,DEFAULT=%s) passed to both proxies.\n' % DEFAULT_IOPS,
+        '  --max-segment-size <NUMBER>      (OPTIONAL,DEFAULT=%s) passed to both proxies.\n' % DEFAULT_MAX_SEGMENT_SIZE,
+        '  --output <PATH>                  (OPTIONAL) write the json results to PATH instead of stdout.\n',
+        '  --payload-size <LIST>            (OPTIONAL,DEFAULT=%s) bytes sent by each bulk connection.\n' % DEFAULT_PAYLOAD_SIZE,
+        '  --rpc-count <NUMBER>             (OPTIONAL,DEFAULT=%s) request/response rounds per connection.\n' % DEFAULT_RPC_COUNT,
+        '  --rpc-size <NUMBER>              (OPTIONAL,DEFAULT=%s) bytes of a request and of a response.\n' % DEFAULT_RPC_SIZE,
+        '  --sim-profile <NAME>=<N>,...     (OPTIONAL) run on a simulated slow medium, as --sim-profile of tcp_on_fs.\n',
+        '  --time-slice-interval <LIST>     (OPTIONAL,DEFAULT=%s) passed to both proxies.\n' % DEFAULT_TIME_SLICE_INTERVAL,
+        '  --window-size <LIST>             (OPTIONAL,DEFAULT=%s) passed to both proxies.\n' % DEFAULT_WINDOW_SIZE,
+        '\n',
+    ])
+
+
+def _numbers(value):
+    return [int(item) for item in value.split(',') if item]
+
+
+def parse_and_run():
+    pairs, _ = getopt(sys.argv[1:], 'h', [
+        'concurrency=',
+        'connect-rounds=',
+        'flush-deadline=',
+        'iops=',
+        'max-segment-size=',
+        'output=',
+        'payload-size=',
+        'rpc-count=',
+        'rpc-size=',
+        'sim-profile=',
+        'time-slice-interval=',
+        'window-size=',
+        'help',
+    ])
+
+    sweep = {
+        'concurrency':          _numbers(DEFAULT_CONCURRENCY),
+        'iops':                 _numbers(DEFAULT_IOPS),
+        'payload_size':         _numbers(DEFAULT_PAYLOAD_SIZE),
+        'time_slice_interval':  _numbers(DEFAULT_TIME_SLICE_INTERVAL),
+        'window_size':          _numbers(DEFAULT_WINDOW_SIZE),
+    }
+    options = {
+        'connect_rounds':       DEFAULT_CONNECT_ROUNDS,
+        'flush_deadline':       DEFAULT_FLUSH_DEADLINE,
+        'max_segment_size':     DEFAULT_MAX_SEGMENT_SIZE,
+        'rpc_count':            DEFAULT_RPC_COUNT,
+        'rpc_size':             DEFAULT_RPC_SIZE,
+    }
+    output = None
+    sim_profile = dict()
+    for arg, value in pairs:
+        name = arg.lstrip('-').replace('-', '_')
+        if name in sweep:
+            sweep[name] = _numbers(value)
+        elif name in options:
+            options[name] = int(value)
+        elif name == 'output':
+            output = value
+        elif name == 'sim_profile':
+            sim_profile = parse_sim_profile(value)
+        elif arg in ('-h', '--help'):
+            usage()
+            sys.exit(1)
+
+    # The proxies log every connection, keep the output readable.
+    logging.disable(logging.WARNING)
+    CountingIO.configure(medium_name='bench-%d' % getpid(), **sim_profile)
+
+    names = sorted(sweep)
+    runs = []
+    for values in product(*(sweep[name] for name in names)):
+        case = dict(zip(names, values))
+        sys.stderr.write('running %s\n' % json.dumps(case, sort_keys=True))
+        runs.append(run_case(case, options))
+
+    result = {
+        'benchmark':    'tcp_on_fs',
+        'time':         strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'platform':     platform.platform(),
+        'python':       platform.python_version(),
+        'options':      options,
+        'sim_profile':  sim_profile,
+        'runs':         runs,
+    }
+    content = json.dumps(result, indent=2, sort_keys=True)
+    if output is None:
+        sys.stdout.write(content + '\n')
+    else:
+        with open(output, 'w') as fd:
+            fd.write(content + '\n')
+
+
+if __name__ == '__main__':
+    parse_and_run()
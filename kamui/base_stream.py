@@ -1,13 +1,25 @@
+from collections import deque
 from functools import partial
 from socket import (
     SHUT_RD,
     SHUT_RDWR,
     SHUT_WR,
 )
+from time import monotonic
 from uuid import uuid4
 from zlib import crc32
 
 from kamui.logging import get_logger
+from kamui.metrics import METRICS
+from kamui.records import (
+    pack_frame_parts,
+    unpack_frame,
+    TornRecord,
+    FRAME_DATA,
+    FRAME_FIN,
+    FRAME_ROTATE,
+)
+from kamui.tracing import TRACING
 
 
 LOG = get_logger(__name__)
@@ -19,6 +31,12 @@ ID_CONN_C2S_CTRL = 'id_conn_c2s_ctrl'
 ID_CONN_C2S_DATA = 'id_conn_c2s_data'
 ID_CONN_S2C_CTRL = 'id_conn_s2c_ctrl'
 ID_CONN_S2C_DATA = 'id_conn_s2c_data'
+ID_CONN_C2S_ACK = 'id_conn_c2s_ack'
+ID_CONN_S2C_ACK = 'id_conn_s2c_ack'
+ID_CONN_C2S_LOG = 'id_conn_c2s_log'
+ID_CONN_S2C_LOG = 'id_conn_s2c_log'
+ID_CONN_LEASE = 'id_conn_lease'
+ID_LEASE = 'id_lease'
 
 
 def id_join(*args):
@@ -46,6 +64,23 @@ def is_request_token(raw):
     return raw.startswith('req-')
 
 
+def make_claim_token(request_token):
+    return 'claim-' + request_token
+
+
+def make_conn_id(conn_num, conn_gen=0):
+    # A reused connection number gets a new generation, so a stale
+    # peer of the old connection can't reach the new one.
+    if not conn_gen:
+        return str(conn_num)
+    return '%d-%d' % (conn_num, conn_gen)
+
+
+def split_conn_id(conn_id):
+    conn_num, _, conn_gen = str(conn_id).partition('-')
+    return int(conn_num), int(conn_gen or 0)
+
+
 class EAgain(Exception):
     pass
 
@@ -61,18 +96,83 @@ class ConnectionRefused(Exception):
     pass
 
 
+def run_blocking(waiter, func, *args, **kwargs):
+    # Retries a BlockingOperation until it's done,
+    # $waiter tells how long to wait between the retries.
+    try:
+        return func(*args, **kwargs)
+    except BlockingOperation as ex:
+        retrying = ex.retrying
+        while True:
+            mark = waiter.mark()
+            try:
+                return retrying()
+            except EAgain as ex:
+                METRICS.inc('kamui_eagain_total', reason=str(ex))
+                waiter.wait(mark)
+                continue
+
+
 class BaseIO(object):
 
     # TODO: move to an individual base_io.py
 
+    # A segment log file is rotated once it grows over this size,
+    # and deleted after the peer moves on to the next one.
+    # None if the medium reuses its space by itself.
+    LOG_ROTATE_BYTES = 4 * 1024 * 1024
+    # max payload of a segment log frame, a larger one is split up.
+    # None if the medium takes any size.
+    MAX_FRAME_PAYLOAD = None
+    # secs between retries of a blocking operation, None for the default
+    POLL_INTERVAL = None
+
     @classmethod
     def set_iops(cls, iops):
         raise NotImplementedError()
 
+    @staticmethod
+    def is_written_in_place(name):
+        # True if the file $name under a watch path is appended or
+        # overwritten in place, which doesn't change the mtime of the dir.
+        return False
+
+    @classmethod
+    def run_metered(cls, func, *args):
+        # Runs IO outside of the zones, e.g. a sweep of the notifier,
+        # as one operation of the IOPS budget.
+        return func(*args)
+
+    @classmethod
+    def set_weights(cls, weights):
+        raise NotImplementedError()
+
+    @classmethod
+    def set_keep_files_open(cls, keep):
+        raise NotImplementedError()
+
+    @classmethod
+    def set_workspace_format(cls, fmt):
+        # The layout of the addresses which are new to the workspace.
+        raise NotImplementedError()
+
+    @classmethod
+    def detect_format(cls, workspace, address):
+        # Returns the layout of $address, which is fixed by the first
+        # one using it, and used by this process from then on.
+        raise NotImplementedError()
+
     @classmethod
     def delete(cls, workspace, zone_id):
         raise NotImplementedError()
 
+    @classmethod
+    def locate(cls, workspace, zone_id):
+        # A local path whose changes can be watched for the zone, a tuple
+        # of them if it's spread over several, or None if the medium
+        # can't be watched.
+        return None
+
     @classmethod
     def checksum(cls, io_data):
         return hex(crc32(io_data)).replace('0x', '')
@@ -87,9 +187,31 @@ class BaseIO(object):
     def read(self, create=False):
         raise NotImplementedError()
 
+    def append(self, data):
+        # $data is bytes, or a tuple of buffers written one after the other
+        raise NotImplementedError()
+
+    def read_at(self, offset):
+        raise NotImplementedError()
+
+    def claim(self):
+        # Creates the zone if it doesn't exist, in one atomic step.
+        # Returns False if someone else created it.
+        raise NotImplementedError()
+
+    @classmethod
+    def prune(cls, workspace, zone_id):
+        # Deletes the zone of a connection if nothing but its lease
+        # record is left, by the last of the peers to close it.
+        raise NotImplementedError()
+
     def delete_self(self):
         return self.delete(self._workspace, self._zone_id)
 
+    def close(self):
+        # Releases what's kept open for the zone, e.g. file handles.
+        pass
+
 
 class _Connection(object):
 
@@ -103,6 +225,9 @@ class _Connection(object):
     FIN_STAGE_REQUESTING = 'fin_stage_requesting'
     FIN_STAGE_REPLYING = 'fin_stage_replying'
 
+    # give up if a complete frame (or data file) keeps failing its checksum.
+    MAX_BAD_FRAME_RETRIES = 100
+
     @classmethod
     def get_snd_stage(cls, ctrl_data):
         snd = ctrl_data.get('F_SND')
@@ -129,46 +254,221 @@ class _Connection(object):
     def finishing(cls, ctrl_data):
         return cls.get_fin_stage(ctrl_data) == cls.FIN_STAGE_REQUESTING
 
-    def __init__(self, io_type, workspace, side, zone_id, on_close=None):
+    def __init__(self, io_type, workspace, side, zone_id, on_close=None, window=1,
+                 multiplexed=False, peer_lease=None):
         assert side in ('client', 'server')
+        assert isinstance(window, int) and window >= 1
         self._io_t = io_type
         self._workspace = workspace
         self._side = side
         self._zone_id = zone_id
         self._on_close = on_close
-        self._recv_buffer = b''
+        # carries mux sub-streams instead of one tcp connection
+        self.multiplexed = multiplexed
+        # the lease of the peer process, None for an old peer
+        self.peer_lease = peer_lease
+        self.closed = False
+        self._aborted = False
+        # Received segments are kept as they are, and only copied out by
+        # recv(), so draining a large one in small pieces stays linear.
+        self._recv_chunks = deque()  # memoryview
+        self._recv_buffered = 0
         self._recv_eof = False
         self._send_eof = False
         self._recv_seq = 0
         self._send_seq = 0
 
+        # window == 1 means the legacy stop-and-wait protocol,
+        # otherwise up to $window numbered segments can be in flight.
+        self._window = window
+        self._send_ack_seq = 0
+        self._send_log_first = 0  # the oldest log file not deleted yet
+        self._send_log_index = 0
+        self._send_log_size = 0
+        self._recv_log_index = 0
+        self._recv_log_offset = 0
+        self._recv_ack_dirty = False
+        self._recv_bad_frames = 0
+
+        # e.g. foo.com/1
+        self._stats = METRICS.connection(id_join(*id_split(zone_id)[1:3]), side)
+        # IO objects live as long as the connection, a retry doesn't
+        # parse the zone ids or open the files again.
+        self._ios = dict()  # zone_id -> IO
+
         if side == 'client':
             self._recv_ctrl_id = id_join(zone_id, ID_CONN_S2C_CTRL)
             self._recv_data_id = id_join(zone_id, ID_CONN_S2C_DATA)
+            self._recv_ack_id = id_join(zone_id, ID_CONN_S2C_ACK)
+            self._recv_log_id = id_join(zone_id, ID_CONN_S2C_LOG)
             self._send_ctrl_id = id_join(zone_id, ID_CONN_C2S_CTRL)
             self._send_data_id = id_join(zone_id, ID_CONN_C2S_DATA)
+            self._send_ack_id = id_join(zone_id, ID_CONN_C2S_ACK)
+            self._send_log_id = id_join(zone_id, ID_CONN_C2S_LOG)
         else:
             self._recv_ctrl_id = id_join(zone_id, ID_CONN_C2S_CTRL)
             self._recv_data_id = id_join(zone_id, ID_CONN_C2S_DATA)
+            self._recv_ack_id = id_join(zone_id, ID_CONN_C2S_ACK)
+            self._recv_log_id = id_join(zone_id, ID_CONN_C2S_LOG)
             self._send_ctrl_id = id_join(zone_id, ID_CONN_S2C_CTRL)
             self._send_data_id = id_join(zone_id, ID_CONN_S2C_DATA)
+            self._send_ack_id = id_join(zone_id, ID_CONN_S2C_ACK)
+            self._send_log_id = id_join(zone_id, ID_CONN_S2C_LOG)
+
+    def watch_path(self):
+        return self._io_t.locate(self._workspace, self._zone_id)
+
+    def poll_interval(self):
+        return self._io_t.POLL_INTERVAL
+
+    @property
+    def window(self):
+        return self._window
+
+    @property
+    def windowed(self):
+        return self._window > 1
+
+    @property
+    def zone_id(self):
+        return self._zone_id
+
+    def abort(self):
+        # The peer is gone, the blocking operations fail from now on.
+        self._aborted = True
+
+    def _check_aborted(self, retrying, *args):
+        if self._aborted:
+            raise ConnectionAbortedError('the peer\'s lease expired')
+        return retrying(*args)
+
+    def _blocking(self, retrying, *args):
+        return BlockingOperation(partial(self._check_aborted, retrying, *args))
+
+    def _io(self, zone_id):
+        io = self._ios.get(zone_id)
+        if io is None:
+            io = self._ios[zone_id] = self._io_t(self._workspace, zone_id)
+        return io
+
+    def _drop_io(self, zone_id):
+        io = self._ios.pop(zone_id, None)
+        if io is not None:
+            io.close()
+
+    def _delete_zone(self, zone_id):
+        self._drop_io(zone_id)
+        self._io_t.delete(self._workspace, zone_id)
+
+    @staticmethod
+    def _log_file_id(log_id, index):
+        # e.g.
+        # id= $ID_CONNECTION/foo.com/1/$ID_CONN_C2S_LOG/3
+        return id_join(log_id, index)
 
     def recv(self, data_len=0):
-        raise BlockingOperation(partial(
-            self._on_retrying_receiving, data_len))
+        take = partial(self._cut_buffer, data_len)
+        if self.windowed:
+            raise self._blocking(self._on_retrying_receiving_windowed, take)
+        raise self._blocking(self._on_retrying_receiving, take)
+
+    def recv_chunk(self, data_len=0):
+        # Like recv(), but returns a view of the received data instead
+        # of a copy, which is only valid until the next recv call.
+        take = partial(self._cut_chunk, data_len)
+        if self.windowed:
+            raise self._blocking(self._on_retrying_receiving_windowed, take)
+        raise self._blocking(self._on_retrying_receiving, take)
+
+    def recv_into(self, buffer, nbytes=0):
+        # Like socket.recv_into(), returns the number of bytes received,
+        # 0 at EOF.
+        take = partial(self._copy_buffer, buffer, nbytes)
+        if self.windowed:
+            raise self._blocking(self._on_retrying_receiving_windowed, take)
+        raise self._blocking(self._on_retrying_receiving, take)
+
+    def _trace(self, transition):
+        if TRACING.enabled:
+            TRACING.event('connection', transition, zone_id=self._zone_id, side=self._side)
+
+    def _count_sent(self, data):
+        self._stats.add('bytes_sent', len(data))
+        self._stats.add('segments_sent', 1)
+
+    def _count_received(self, data):
+        self._stats.add('bytes_received', len(data))
+        self._stats.add('segments_received', 1)
+
+    def _feed_buffer(self, data):
+        if data:
+            self._recv_chunks.append(memoryview(data))
+            self._recv_buffered += len(data)
+
+    def _detach_buffer(self):
+        # Copies the chunks which are views of the medium, e.g. of a
+        # mapped log file, into memory of their own.
+        self._recv_chunks = deque(
+            chunk if isinstance(chunk.obj, bytes) else memoryview(bytes(chunk))
+            for chunk in self._recv_chunks)
+
+    def _copy_buffer(self, buffer, nbytes=0):
+        # Copies up to $nbytes buffered bytes into $buffer.
+        out = memoryview(buffer).cast('B')
+        if nbytes <= 0 or nbytes > len(out):
+            nbytes = len(out)
+        copied = 0
+        chunks = self._recv_chunks
+        while chunks and copied < nbytes:
+            chunk = chunks[0]
+            size = min(len(chunk), nbytes - copied)
+            out[copied:copied + size] = chunk[:size]
+            copied += size
+            if size == len(chunk):
+                chunks.popleft()
+            else:
+                chunks[0] = chunk[size:]
+        self._recv_buffered -= copied
+        return copied
+
+    def _cut_chunk(self, data_len):
+        if not self._recv_chunks:
+            return memoryview(b'')
+        chunk = self._recv_chunks[0]
+        if data_len <= 0 or data_len >= len(chunk):
+            self._recv_chunks.popleft()
+        else:
+            self._recv_chunks[0] = chunk[data_len:]
+            chunk = chunk[:data_len]
+        self._recv_buffered -= len(chunk)
+        return chunk
 
     def _cut_buffer(self, data_len):
-        if data_len <= 0:
-            tmp = self._recv_buffer
-            self._recv_buffer = b''
-            return tmp
-        tmp = self._recv_buffer[:data_len]
-        self._recv_buffer = self._recv_buffer[data_len:]
-        return tmp
-
-    def _on_retrying_receiving(self, data_len):
-        ctrl_io = self._io_t(self._workspace, self._recv_ctrl_id)
-        data_io = self._io_t(self._workspace, self._recv_data_id)
+        if data_len <= 0 or data_len > self._recv_buffered:
+            data_len = self._recv_buffered
+        chunks = self._recv_chunks
+        if chunks and len(chunks[0]) >= data_len:
+            # most of the time, no need to join anything
+            chunk = chunks[0]
+            data = bytes(chunk[:data_len])
+            if data_len == len(chunk):
+                chunks.popleft()
+            else:
+                chunks[0] = chunk[data_len:]
+            self._recv_buffered -= data_len
+            return data
+        data = bytearray(data_len)
+        self._copy_buffer(data)
+        return bytes(data)
+
+    def _on_retrying_receiving(self, take):
+        if self._recv_buffered or self._recv_eof:
+            # left by a smaller recv than the last segment, or EOF
+            # once more, the zones of the peer may be deleted already
+            return take()
+
+        ctrl_io = self._io(self._recv_ctrl_id)
+        data_io = self._io(self._recv_data_id)
 
         ctrl_data = ctrl_io.read()
         if ctrl_data is None or not ctrl_data:
@@ -186,35 +486,190 @@ class _Connection(object):
             if ctrl_data.get('SEQ', -7) != self._recv_seq + 1:
                 raise BrokenPipeError('bad request seq')
             in_data = data_io.read()
-            if self._io_t.checksum(in_data) != ctrl_data.get('CHECKSUM'):
-                raise BrokenPipeError('bad request checksum')
-
-            self._recv_buffer += in_data
+            if in_data is None or self._io_t.checksum(in_data) != ctrl_data.get('CHECKSUM'):
+                # An old peer may still be writing the data in place.
+                self._recv_bad_frames += 1
+                if self._recv_bad_frames > self.MAX_BAD_FRAME_RETRIES:
+                    raise BrokenPipeError('bad request checksum')
+                raise EAgain('someone may be writing this zone.')
+            self._recv_bad_frames = 0
+
+            self._feed_buffer(in_data)
             self._recv_seq += 1
+            self._count_received(in_data)
             ctrl_data['F_SND_ACK'] = True
             ctrl_data['SEQ_ACK'] = self._recv_seq
             ctrl_io.write(ctrl_data)
-            # REQUESTING -> REPLYING
+            self._trace('snd: REQUESTING -> REPLYING')
 
         if finishing:
             self._recv_eof = True
             ctrl_data['F_FIN_ACK'] = True
             ctrl_io.write(ctrl_data)
+            self._trace('fin: REQUESTING -> REPLYING')
+
+        return take()
 
-        buf_len = len(self._recv_buffer)
-        if buf_len >= data_len:
-            return self._cut_buffer(data_len)
+    def _flush_recv_ack(self):
+        ack_io = self._io(self._recv_ack_id)
+        ack_io.write({
+            'SEQ_ACK':      self._recv_seq,
+            'LOG':          self._recv_log_index,
+            'F_FIN_ACK':    self._recv_eof,
+        })
+        self._recv_ack_dirty = False
+
+    def _on_retrying_receiving_windowed(self, take):
+        if self._recv_ack_dirty:
+            try:
+                self._flush_recv_ack()
+            except EAgain:
+                if not self._recv_buffered:
+                    raise
+        if self._recv_buffered or self._recv_eof:
+            return take()
+
+        log_io = self._io(self._log_file_id(
+            self._recv_log_id, self._recv_log_index))
+        raw = log_io.read_at(self._recv_log_offset)
+        if not raw:
+            raise EAgain('request not found')
+        # the payloads are slices of it, not copies
+        raw = memoryview(raw)
+
+        # Consume every complete frame at once, a torn frame at the
+        # tail is left for the next round.
+        offset = 0
+        rotated = False
+        while not rotated and not self._recv_eof:
+            try:
+                frame = unpack_frame(raw, offset)
+            except TornRecord as ex:
+                if offset > 0:
+                    break
+                self._recv_bad_frames += 1
+                if self._recv_bad_frames > self.MAX_BAD_FRAME_RETRIES:
+                    raise BrokenPipeError(str(ex))
+                raise EAgain('someone may be writing this zone.')
+            except ValueError as ex:
+                raise BrokenPipeError(str(ex))
+            if frame is None:
+                break
+            kind, seq, payload, offset = frame
+            if kind == FRAME_DATA:
+                if seq != self._recv_seq + 1:
+                    raise BrokenPipeError('bad request seq')
+                self._feed_buffer(payload)
+                self._recv_seq = seq
+                self._count_received(payload)
+            elif kind == FRAME_ROTATE:
+                rotated = True
+            elif kind == FRAME_FIN:
+                self._recv_eof = True
+                self._trace('fin: REQUESTING -> REPLYING')
+
+        if offset == 0:
+            raise EAgain('request not complete')
+        self._recv_bad_frames = 0
+        if rotated:
+            # The sender deletes the log once the ack moves on to the
+            # next one, the pages of a deleted file mapped from a network
+            # share may fail to fault in again.
+            self._detach_buffer()
+            self._drop_io(self._log_file_id(self._recv_log_id, self._recv_log_index))
+            self._recv_log_index += 1
+            self._recv_log_offset = 0
         else:
-            return self._cut_buffer(buf_len)
+            self._recv_log_offset += offset
+
+        # cumulative ack, it covers every segment up to $SEQ_ACK.
+        self._recv_ack_dirty = True
+        try:
+            self._flush_recv_ack()
+        except EAgain:
+            # EOF is not returned before the peer can see its FIN acked,
+            # nothing may flush the ack after it.
+            if not self._recv_buffered:
+                raise
+
+        if not self._recv_buffered and not self._recv_eof:
+            raise EAgain('request not found')
+        return take()
 
     def sendall(self, data):
         assert isinstance(data, bytes)
-        raise BlockingOperation(partial(
-            self._on_retrying_sending_all, data))
+        if self.windowed:
+            max_payload = self._io_t.MAX_FRAME_PAYLOAD
+            if max_payload is not None and len(data) > max_payload:
+                view = memoryview(data)
+                pieces = deque(view[offset:offset + max_payload]
+                               for offset in range(0, len(data), max_payload))
+                raise self._blocking(self._on_retrying_sending_pieces_windowed, pieces)
+            raise self._blocking(self._on_retrying_sending_all_windowed, data)
+        raise self._blocking(self._on_retrying_sending_all, data)
+
+    def _read_send_ack(self):
+        ack_io = self._io(self._send_ack_id)
+        try:
+            ack_data = ack_io.read()
+        except ValueError as ex:
+            # e.g. an ack record of an unknown version, a torn one is
+            # retried by the io
+            raise BrokenPipeError(str(ex))
+        if ack_data is None or not ack_data:
+            return {}
+
+        seq_ack = ack_data.get('SEQ_ACK', 0)
+        if seq_ack > self._send_seq:
+            raise BrokenPipeError('bad reply ack')
+        self._send_ack_seq = max(self._send_ack_seq, seq_ack)
+
+        # log files before the one the peer is reading are done.
+        log_index = min(ack_data.get('LOG', 0), self._send_log_index)
+        while self._send_log_first < log_index:
+            self._delete_zone(self._log_file_id(
+                self._send_log_id, self._send_log_first))
+            self._send_log_first += 1
+        return ack_data
+
+    def _append_send_log(self, frame_parts):
+        rotate_bytes = self._io_t.LOG_ROTATE_BYTES
+        if rotate_bytes is not None and self._send_log_size >= rotate_bytes:
+            log_io = self._io(self._log_file_id(
+                self._send_log_id, self._send_log_index))
+            log_io.append(pack_frame_parts(FRAME_ROTATE, self._send_seq))
+            self._drop_io(self._log_file_id(self._send_log_id, self._send_log_index))
+            self._send_log_index += 1
+            self._send_log_size = 0
+
+        log_io = self._io(self._log_file_id(
+            self._send_log_id, self._send_log_index))
+        log_io.append(frame_parts)
+        self._send_log_size += sum(len(part) for part in frame_parts)
+
+    def _on_retrying_sending_all_windowed(self, data):
+        if self._send_eof:
+            raise BrokenPipeError('sending-pipe closed')
+
+        if self._send_seq - self._send_ack_seq >= self._window:
+            self._read_send_ack()
+            if self._send_seq - self._send_ack_seq >= self._window:
+                raise EAgain('window full')
+
+        seq = self._send_seq + 1
+        self._append_send_log(pack_frame_parts(FRAME_DATA, seq, data))
+        self._send_seq = seq
+        self._count_sent(data)
+
+    def _on_retrying_sending_pieces_windowed(self, pieces):
+        # a retry goes on with the pieces not sent yet
+        while pieces:
+            self._on_retrying_sending_all_windowed(pieces[0])
+            pieces.popleft()
 
     def _on_retrying_sending_all(self, data):
-        ctrl_io = self._io_t(self._workspace, self._send_ctrl_id)
-        data_io = self._io_t(self._workspace, self._send_data_id)
+        ctrl_io = self._io(self._send_ctrl_id)
+        data_io = self._io(self._send_data_id)
 
         ctrl_data = ctrl_io.read(create=True)
         snd_stage = self.get_snd_stage(ctrl_data)
@@ -225,12 +680,13 @@ class _Connection(object):
         if snd_stage == self.SND_STAGE_IDLE:
             data_io.write(data)
             self._send_seq += 1
+            self._count_sent(data)
             ctrl_data['F_SND'] = True
             ctrl_data['F_SND_ACK'] = False
             ctrl_data['SEQ'] = self._send_seq
             ctrl_data['CHECKSUM'] = self._io_t.checksum(data)
             ctrl_io.write(ctrl_data)
-            # IDLE -> REQUESTING
+            self._trace('snd: IDLE -> REQUESTING')
             raise EAgain('data sent')
 
         if snd_stage == self.SND_STAGE_REPLYING:
@@ -241,7 +697,7 @@ class _Connection(object):
             ctrl_data['SEQ'] = -1
             ctrl_data['SEQ_ACK'] = -1
             ctrl_io.write(ctrl_data)
-            # REPLYING -> IDLE
+            self._trace('snd: REPLYING -> IDLE')
             return
 
         raise EAgain('waiting for rely')
@@ -253,11 +709,34 @@ class _Connection(object):
         if flag == SHUT_RD:
             # Do nothing.
             pass
+        elif self.windowed:
+            raise self._blocking(self._on_retrying_shutting_down_wr_windowed)
         else:
-            raise BlockingOperation(self._on_retrying_shutting_down_wr)
+            raise self._blocking(self._on_retrying_shutting_down_wr)
+
+    def _on_retrying_shutting_down_wr_windowed(self):
+        if not self._send_eof:
+            # FIN is ordered behind the data frames in the log,
+            # no need to wait for the data being acked.
+            self._append_send_log(pack_frame_parts(FRAME_FIN, self._send_seq))
+            self._send_eof = True
+            self._trace('fin: IDLE -> REQUESTING')
+            raise EAgain('fin sent')
+
+        ack_data = self._read_send_ack()
+        if not ack_data.get('F_FIN_ACK'):
+            raise EAgain('waiting for fin-ack')
+
+        self._trace('fin: REPLYING -> IDLE')
+        # FIN-ACK received, now the io can be deleted safely.
+        for index in range(self._send_log_first, self._send_log_index + 1):
+            self._delete_zone(self._log_file_id(
+                self._send_log_id, index))
+        self._send_log_first = self._send_log_index + 1
+        self._delete_zone(self._send_ack_id)
 
     def _on_retrying_shutting_down_wr(self):
-        ctrl_io = self._io_t(self._workspace, self._send_ctrl_id)
+        ctrl_io = self._io(self._send_ctrl_id)
         ctrl_data = ctrl_io.read(create=True)
 
         snd_stage = self.get_snd_stage(ctrl_data)
@@ -269,130 +748,344 @@ class _Connection(object):
             ctrl_data['F_FIN'] = True
             ctrl_io.write(ctrl_data)
             self._send_eof = True
-            # IDLE -> REQUESTING
+            self._trace('fin: IDLE -> REQUESTING')
             raise EAgain('fin sent')
 
         if fin_stage == self.FIN_STAGE_REPLYING:
-            # REPLYING -> IDLE
+            self._trace('fin: REPLYING -> IDLE')
             # FIN-ACK received, now the io can be deleted safely.
-            ctrl_io.delete_self()
-            data_io = self._io_t(self._workspace, self._send_data_id)
-            data_io.delete_self()
+            self._delete_zone(self._send_ctrl_id)
+            self._delete_zone(self._send_data_id)
             return
 
         raise EAgain('waiting for fin-ack')
 
+    def _prune(self):
+        try:
+            self._io_t.prune(self._workspace, self._zone_id)
+        except EAgain:
+            pass
+
+    def _on_retrying_closing(self):
+        if self.windowed:
+            self._on_retrying_shutting_down_wr_windowed()
+        else:
+            self._on_retrying_shutting_down_wr()
+        self._prune()
+
     def close(self):
         if self._on_close is not None:
             self._on_close(self)
             self._on_close = None
+        self._stats.release()
+        self.closed = True
+        # the ones shutdown() needs are opened again
+        for zone_id in list(self._ios):
+            self._drop_io(zone_id)
+        if self._aborted:
+            # Nobody else is going to clean up after the dead peer.
+            try:
+                self._io_t.delete(self._workspace, self._zone_id)
+            except EAgain:
+                pass
+            return
         if not self._send_eof:
-            self.shutdown(SHUT_RDWR)
+            raise self._blocking(self._on_retrying_closing)
+        self._prune()
 
 
 class BaseClient(object):
 
     IO = BaseIO
 
-    def __init__(self, workspace):
+    def __init__(self, workspace, window=1, multiplex=False, janitor=None):
         self._workspace = workspace
+        self._window = window
+        self._multiplex = multiplex
+        # keeps the lease of this process, see kamui.lease
+        self._janitor = janitor
+        self._pending = dict()  # address -> zone_id of the request
+
+    def _make_request(self):
+        r_data = {
+            'CLIENT_ADDRESS':       'reserved',
+            'F_CONN':               True,
+            'F_CONN_ACK':           False,
+        }
+        if self._window > 1:
+            # Old servers never reply WINDOW_ACK,
+            # so they are talked to in stop-and-wait mode.
+            r_data['WINDOW'] = self._window
+        if self._multiplex:
+            # Same as above, MUX_ACK from the server or a plain connection.
+            r_data['MUX'] = True
+        # Old servers never reply CONN_GEN_ACK,
+        # then the connection is named by the number only.
+        r_data['CONN_GEN'] = True
+        if self._janitor is not None:
+            # The server drops the request, or the connection, once the
+            # lease expires. Old servers ignore it.
+            r_data['LEASE'] = self._janitor.lease
+        return r_data
+
+    def watch_path(self, address):
+        # The ack is written to the request, whose dir may be a shard
+        # of the backlog.
+        zone_id = self._pending.get(address, id_join(ID_SERVER_LISTEN_BACKLOG, address))
+        return self.IO.locate(self._workspace, zone_id)
 
     def connect(self, address):
         request_token = make_request_token()
         zone_id = id_join(ID_SERVER_LISTEN_BACKLOG, address, request_token)
         r_io = self.IO(self._workspace, zone_id)
-        r_data = r_io.read(create=True)
-
-        r_data['CLIENT_ADDRESS'] = 'reserved'
-        r_data['F_CONN'] = True
-        r_data['F_CONN_ACK'] = False
-        r_io.write(r_data)
+        # Write the request at once, an empty placeholder could be
+        # taken as a dead request and deleted by the server.
+        r_io.write(self._make_request())
+        self._pending[address] = zone_id
 
         raise BlockingOperation(partial(
-            self._on_retrying_connecting, r_io, address))
+            self._on_retrying_connecting, r_io, address, monotonic()))
 
-    def _on_retrying_connecting(self, r_io, address):
+    def _on_retrying_connecting(self, r_io, address, start_time):
         r_data = r_io.read()
         if r_data is None or not r_data:
-            r_data = {
-                'CLIENT_ADDRESS':       'reserved',
-                'F_CONN':               True,
-                'F_CONN_ACK':           False,
-            }
-            r_io.write(r_data)
+            r_io.write(self._make_request())
             raise EAgain('waiting for server accepting')
 
         if r_data.get('F_CONN') and r_data.get('F_CONN_ACK'):
-            conn_num = r_data['CONN_NUM']
-            zone_id = id_join(ID_CONNECTION, address, conn_num)
+            conn_id = make_conn_id(r_data['CONN_NUM'], r_data.get('CONN_GEN_ACK', 0))
+            window = min(r_data.get('WINDOW_ACK', 1), self._window)
+            zone_id = id_join(ID_CONNECTION, address, conn_id)
             r_io.delete_self()
-            return _Connection(self.IO, self._workspace, 'client', zone_id)
+            self._pending.pop(address, None)
+            METRICS.observe('kamui_handshake_seconds', monotonic() - start_time, side='client')
+            multiplexed = self._multiplex and bool(r_data.get('MUX_ACK'))
+            conn = _Connection(self.IO, self._workspace, 'client', zone_id,
+                               window=window, multiplexed=multiplexed,
+                               peer_lease=r_data.get('LEASE_ACK'))
+            if self._janitor is not None:
+                self._janitor.watch(conn)
+            return conn
         else:
             raise EAgain('waiting for server accepting')
 
 
+class _ConnNumAllocator(object):
+    # Connection numbers are reused from a free-list, the most recently
+    # freed first. Every reuse bumps the generation of the number.
+    # The generations of a process start from a random one, zones left
+    # on the medium by a process before a restart have others.
+    #
+    # Servers sharing an address take every $step-th number from $start,
+    # so they never pick the same one.
+
+    def __init__(self, limit, start=0, step=1):
+        self._limit = limit
+        self._step = step
+        self._next = start
+        self._free = list()
+        self._gens = dict()  # conn_num -> generation of the last use
+        # 0 is for the clients which know nothing about generations
+        self._first_gen = (uuid4().int >> 96) or 1
+
+    def take(self):
+        if self._free:
+            conn_num = self._free.pop()
+            conn_gen = self._gens[conn_num] + 1
+        elif self._next < self._limit:
+            conn_num = self._next
+            conn_gen = self._first_gen
+            self._next += self._step
+        else:
+            raise EAgain('connection numbers full')
+        self._gens[conn_num] = conn_gen
+        return conn_num, conn_gen
+
+    def give_back(self, conn_num):
+        self._free.append(conn_num)
+
+
 class BaseServer(object):
 
     IO = BaseIO
+    MAX_CONNECTIONS = 65536
 
-    def __init__(self, workspace):
+    def __init__(self, workspace, window=1, shard=(0, 1), janitor=None):
         self._workspace = workspace
+        self._window = window
+        # keeps the lease of this process, see kamui.lease
+        self._janitor = janitor
+        # (index, count) of this server among the ones on the same address
+        self._shard_index, self._shard_count = shard
+        assert 0 <= self._shard_index < self._shard_count
         self._address = None
-        self._connections = list()
-        self._conn_nums = [False] * 1000
-
-    def _pick_conn_num(self):
-        for num in range(len(self._conn_nums)):
-            if not self._conn_nums[num]:
-                self._conn_nums[num] = True
-                return num
-        raise EAgain('connection numbers full')
+        self._backlog_io = None
+        self._connections = dict()  # conn_num -> _Connection
+        self._conn_nums = _ConnNumAllocator(self.MAX_CONNECTIONS,
+                                            self._shard_index, self._shard_count)
+        self._backlog = 5
+        self._ready = deque()  # accepted, not returned by accept() yet
+        self._acked_tokens = set()  # accepted, not taken by the clients yet
+        self._request_leases = dict()  # acked token -> lease of the client
+        self._claimed_tokens = set()  # claimed by this server
+        self._foreign_tokens = set()  # claimed by the other servers
 
     def listen(self, address, backlog=5):
-        assert isinstance(backlog, int)  # backlog is not used at present
+        # At most $backlog connections are accepted ahead of the caller.
+        assert isinstance(backlog, int)
         self._address = address
+        self._backlog = max(1, backlog)
+        self._backlog_io = self.IO(self._workspace, id_join(ID_SERVER_LISTEN_BACKLOG, address))
+
+    def watch_path(self):
+        assert self._address is not None
+        zone_id = id_join(ID_SERVER_LISTEN_BACKLOG, self._address)
+        return self.IO.locate(self._workspace, zone_id)
 
     def accept(self):
         assert self._address is not None
+        if not self._ready:
+            self._accept_pending()
+        if not self._ready:
+            raise EAgain('no new requests at present.')
+        return self._ready.popleft()
+
+    def accept_batch(self):
+        # Accepts every pending request in one sweep of the backlog,
+        # up to the backlog size.
+        assert self._address is not None
+        self._accept_pending()
+        if not self._ready:
+            raise EAgain('no new requests at present.')
+        conns = list(self._ready)
+        self._ready.clear()
+        return conns
 
-        zone_id = id_join(ID_SERVER_LISTEN_BACKLOG, self._address)
-        b_io = self.IO(self._workspace, zone_id)
-        b_data = b_io.read(create=True)
+    def _accept_pending(self):
+        b_data = self._backlog_io.read(create=True)
 
         request_tokens = b_data.get('REQUEST_TOKENS', [])
+        # The clients delete their requests once they see the ack,
+        # no need to read them again before that.
+        self._acked_tokens.intersection_update(request_tokens)
+        self._foreign_tokens.intersection_update(request_tokens)
+        for token in set(self._request_leases).difference(self._acked_tokens):
+            del self._request_leases[token]
+        if self._janitor is not None:
+            self._drop_dead_requests()
+        for token in self._claimed_tokens.difference(request_tokens):
+            # the request is gone, so is its claim
+            self._drop_claim(token)
+
         for token in request_tokens:
+            if len(self._ready) >= self._backlog:
+                break
+            if token in self._acked_tokens or token in self._foreign_tokens:
+                continue
+            start_time = monotonic()
             try:
                 conn = self._accept_one(token)
             except EAgain:
                 continue
-            else:
-                return conn
-
-        raise EAgain('no new requests at present.')
+            METRICS.observe('kamui_handshake_seconds', monotonic() - start_time, side='server')
+            self._acked_tokens.add(token)
+            self._ready.append(conn)
+
+    def _drop_dead_requests(self):
+        # A client which died before taking its connection leaves the
+        # request behind, the connection itself is aborted by the janitor.
+        for token, lease in list(self._request_leases.items()):
+            if not self._janitor.expired(lease):
+                continue
+            self.IO.delete(self._workspace,
+                           id_join(ID_SERVER_LISTEN_BACKLOG, self._address, token))
+            self._request_leases.pop(token, None)
+            METRICS.inc('kamui_reclaimed_total', kind='request')
 
     def _accept_one(self, request_token):
         zone_id = id_join(ID_SERVER_LISTEN_BACKLOG, self._address, request_token)
+        # The claim goes first, a request read before it may be accepted
+        # and deleted by another server meanwhile, and writing the ack
+        # would bring it back.
+        if self._shard_count > 1 and not self._claim(request_token):
+            raise EAgain('claimed by another server')
+
         l_io = self.IO(self._workspace, zone_id)
         l_data = l_io.read()
-        if l_data is None or not l_data.get('F_CONN'):
+        if l_data is None:
+            self._drop_claim(request_token)
+            raise EAgain('request gone')
+        if not l_data.get('F_CONN'):
             self.IO.delete(self._workspace, zone_id)
             raise EAgain('F_CONN false')
 
         if l_data.get('F_CONN_ACK'):
             raise EAgain('already accepted, ignore')
 
-        conn_num = self._pick_conn_num()
+        client_lease = l_data.get('LEASE')
+        if self._janitor is not None and client_lease and \
+                self._janitor.expired(client_lease):
+            self.IO.delete(self._workspace, zone_id)
+            METRICS.inc('kamui_reclaimed_total', kind='request')
+            raise EAgain('client lease expired')
+
+        conn_num, conn_gen = self._conn_nums.take()
+        if not l_data.get('CONN_GEN'):
+            # an old client knows nothing about generations
+            conn_gen = 0
+        window = max(1, min(l_data.get('WINDOW', 1), self._window))
 
         l_data['F_CONN_ACK'] = True
         l_data['CONN_NUM'] = conn_num
-        l_io.write(l_data)
-
-        zone_id = id_join(ID_CONNECTION, self._address, conn_num)
-        conn = _Connection(self.IO, self._workspace, 'server', zone_id,
-                           partial(self._close_cb, conn_num))
-        self._connections.append(conn)
+        l_data['CONN_GEN_ACK'] = conn_gen
+        l_data['WINDOW_ACK'] = window
+        multiplexed = bool(l_data.get('MUX'))
+        l_data['MUX_ACK'] = multiplexed
+        conn_zone_id = id_join(ID_CONNECTION, self._address, make_conn_id(conn_num, conn_gen))
+        try:
+            if self._janitor is not None:
+                # Tells the janitors of the others whose connection it is,
+                # if both of the peers die.
+                self.IO(self._workspace, id_join(conn_zone_id, ID_CONN_LEASE)).write({
+                    'SERVER':   self._janitor.lease,
+                    'CLIENT':   client_lease,
+                })
+                l_data['LEASE_ACK'] = self._janitor.lease
+            l_io.write(l_data)
+        except EAgain:
+            self._conn_nums.give_back(conn_num)
+            raise
+
+        conn = _Connection(self.IO, self._workspace, 'server', conn_zone_id,
+                           partial(self._close_cb, conn_num), window=window,
+                           multiplexed=multiplexed, peer_lease=client_lease)
+        self._connections[conn_num] = conn
+        if self._janitor is not None:
+            self._janitor.watch(conn)
+            if client_lease:
+                self._request_leases[request_token] = client_lease
         return conn
 
+    def _claim_zone_id(self, request_token):
+        return id_join(ID_SERVER_LISTEN_BACKLOG, self._address,
+                       make_claim_token(request_token))
+
+    def _claim(self, request_token):
+        # Only one of the servers on the address gets a request.
+        if request_token in self._claimed_tokens:
+            return True
+        c_io = self.IO(self._workspace, self._claim_zone_id(request_token))
+        if not c_io.claim():
+            self._foreign_tokens.add(request_token)
+            return False
+        self._claimed_tokens.add(request_token)
+        return True
+
+    def _drop_claim(self, request_token):
+        if request_token in self._claimed_tokens:
+            self.IO.delete(self._workspace, self._claim_zone_id(request_token))
+            self._claimed_tokens.discard(request_token)
+
     def _close_cb(self, conn_num, conn):
-        self._conn_nums[conn_num] = False
-        self._connections.remove(conn)
+        self._conn_nums.give_back(conn_num)
+        self._connections.pop(conn_num, None)
@@ -0,0 +1,174 @@
+from collections import deque
+from concurrent.futures import Future
+from copy import deepcopy
+from os import getpid
+from threading import (
+    Condition,
+    Thread,
+)
+from time import (
+    monotonic,
+    sleep,
+)
+
+from kamui.metrics import METRICS
+from kamui.tracing import TRACING
+
+
+def copy_result(result):
+    # Everyone gets its own copy of a shared result. Bytes and read-only
+    # views (e.g. of a mapped file) can't be changed, they are shared.
+    if isinstance(result, bytes) or (
+            isinstance(result, memoryview) and result.readonly):
+        return result
+    return deepcopy(result)
+
+
+class _Request(object):
+
+    def __init__(self, key, func, args):
+        self.key = key
+        self.func = func
+        self.args = args
+        self.future = Future()
+        self.shared = False
+        self.submit_time = monotonic()
+
+
+class _Flow(object):
+
+    def __init__(self, weight):
+        self.weight = weight
+        self.deficit = weight
+        self.requests = deque()
+
+
+class IODispatcher(object):
+    # Runs IO operations on a few worker threads, no faster than one
+    # operation per $interval_msec in total.
+    #
+    # Callers block on a future instead of sleeping inside a lock,
+    # so the IO latency of the medium can overlap between workers
+    # while the IOPS ceiling still holds. Reads of the same zone that
+    # are queued at the same time are done once and shared.
+    #
+    # The IOPS budget is shared between flows (e.g. connections) by
+    # deficit round robin, a flow of weight 2 gets twice the operations
+    # of a flow of weight 1 when both are busy. Urgent operations (ctrl
+    # and ack updates, which unblock the peer) skip the flows. Urgent
+    # reads skip them too, but idle connections poll with them, so
+    # they take turns with the flows when both are waiting.
+
+    # urgent reads in a row before a flow gets its turn
+    URGENT_READS_PER_TURN = 1
+
+    def __init__(self, interval_msec, workers=4):
+        self.pid = getpid()
+        self._interval = interval_msec / 1000
+        self._next_slot = 0
+        self._cond = Condition()
+        self._urgent = deque()
+        self._urgent_reads = deque()
+        self._urgent_streak = 0
+        self._flows = dict()  # flow -> _Flow, only the backlogged ones
+        self._active = deque()  # round robin order of self._flows
+        self._pending = dict()  # key -> _Request not started yet
+
+        for _ in range(workers):
+            thr = Thread(target=self._run)
+            thr.daemon = True
+            thr.start()
+
+    def set_interval(self, interval_msec):
+        with self._cond:
+            self._interval = interval_msec / 1000
+
+    def submit(self, key, flow, weight, urgent, func, *args):
+        # $key identifies a read-only operation which can be coalesced,
+        # None for the others.
+        with self._cond:
+            if key is not None:
+                request = self._pending.get(key)
+                if request is not None:
+                    request.shared = True
+                    return request
+            request = _Request(key, func, args)
+            if key is not None:
+                self._pending[key] = request
+
+            if urgent and key is None:
+                self._urgent.append(request)
+            elif urgent:
+                self._urgent_reads.append(request)
+            else:
+                state = self._flows.get(flow)
+                if state is None:
+                    state = _Flow(weight)
+                    self._flows[flow] = state
+                    self._active.append(flow)
+                state.requests.append(request)
+            self._cond.notify()
+        return request
+
+    def call(self, key, flow, weight, urgent, func, *args):
+        request = self.submit(key, flow, weight, urgent, func, *args)
+        result = request.future.result()
+        if request.shared:
+            return copy_result(result)
+        return result
+
+    def _pick(self):
+        if self._urgent:
+            return self._urgent.popleft()
+        if self._urgent_reads and (
+                not self._active or self._urgent_streak < self.URGENT_READS_PER_TURN):
+            self._urgent_streak += 1
+            return self._urgent_reads.popleft()
+        self._urgent_streak = 0
+        while self._active:
+            flow = self._active[0]
+            state = self._flows[flow]
+            if state.deficit < 1:
+                # used up its quantum in this round
+                state.deficit += state.weight
+                self._active.rotate(-1)
+                continue
+            state.deficit -= 1
+            request = state.requests.popleft()
+            if not state.requests:
+                # an idle flow doesn't save up deficit
+                self._active.popleft()
+                del self._flows[flow]
+            return request
+        return None
+
+    def _take_slot(self):
+        # under self._cond
+        now = monotonic()
+        slot = max(now, self._next_slot)
+        self._next_slot = slot + self._interval
+        return slot - now
+
+    def _run(self):
+        while True:
+            with self._cond:
+                request = self._pick()
+                while request is None:
+                    self._cond.wait()
+                    request = self._pick()
+                delay = self._take_slot()
+            if delay > 0:
+                sleep(delay)
+            METRICS.observe('kamui_io_budget_wait_seconds', monotonic() - request.submit_time)
+            if TRACING.enabled:
+                TRACING.span('throttle', 'wait_slot', request.submit_time,
+                             op=getattr(request.func, '__name__', None))
+            with self._cond:
+                if self._pending.get(request.key) is request:
+                    del self._pending[request.key]
+            try:
+                result = request.func(*request.args)
+            except BaseException as ex:
+                request.future.set_exception(ex)
+            else:
+                request.future.set_result(result)
@@ -0,0 +1,193 @@
+from os import getpid
+from socket import gethostname
+from threading import (
+    Lock,
+    Thread,
+)
+from time import (
+    monotonic,
+    sleep,
+)
+from uuid import uuid4
+from weakref import WeakSet
+
+from kamui.base_stream import (
+    EAgain,
+    id_join,
+    ID_CONNECTION,
+    ID_CONN_LEASE,
+    ID_LEASE,
+)
+from kamui.logging import get_logger
+from kamui.metrics import METRICS
+
+
+LOG = get_logger(__name__)
+
+
+def make_lease_name(role):
+    # e.g. server-foo-1234-0123abcd
+    return '%s-%s-%s-%s' % (role, gethostname(), getpid(), uuid4().hex[:8])
+
+
+class LeaseTracker(object):
+    # Tells if the holder of a lease is gone. A lease is renewed by
+    # writing a new beat count, it's expired once the count stays the
+    # same for $timeout secs of our own clock, so the clocks of the
+    # hosts never have to agree.
+
+    def __init__(self, io_type, workspace, timeout):
+        self._io_t = io_type
+        self._workspace = workspace
+        self._timeout = timeout
+        self._lock = Lock()
+        self._leases = dict()  # name -> [beat, changed_at, checked_at, timeout]
+
+    def expired(self, name):
+        now = monotonic()
+        with self._lock:
+            state = self._leases.get(name)
+            if state is None:
+                state = self._leases[name] = [None, now, None, self._timeout]
+            due = state[2] is None or now - state[2] >= self._timeout / 4
+            if due:
+                state[2] = now
+        if due:
+            self._check(name, state, now)
+        return now - state[1] > state[3]
+
+    def _check(self, name, state, now):
+        try:
+            data = self._io_t(self._workspace, id_join(ID_LEASE, name)).read()
+        except EAgain:
+            # tells nothing, it's read again next time
+            return
+        data = data or {}
+        beat = data.get('BEAT')
+        if beat != state[0]:
+            state[0] = beat
+            state[1] = now
+        # the holder may renew less often than we expect
+        state[3] = max(self._timeout, data.get('TIMEOUT', 0))
+
+    def forget_idle(self):
+        # The leases nobody asked about for a while.
+        expire_time = monotonic() - 4 * self._timeout
+        with self._lock:
+            for name in list(self._leases):
+                checked_at = self._leases[name][2]
+                if checked_at is not None and checked_at < expire_time:
+                    del self._leases[name]
+
+
+class Janitor(object):
+    # Keeps the lease of this process, and cleans up after the dead ones:
+    #   - A connection whose peer's lease expired is aborted, its thread
+    #     gives up, and the zone and the connection number are freed.
+    #   - The connections of the dead servers under the scanned addresses
+    #     are deleted, if their clients are gone as well.
+    #   - The requests of the dead clients are deleted by the servers,
+    #     see BaseServer.
+    # A peer without a lease (an old version) is never taken as dead.
+
+    def __init__(self, io_type, workspace, role, timeout):
+        self.lease = make_lease_name(role)
+        self.timeout = timeout
+        self._io_t = io_type
+        self._workspace = workspace
+        self._tracker = LeaseTracker(io_type, workspace, timeout)
+        self._beat = 0
+        self._lock = Lock()
+        self._connections = WeakSet()
+        self._addresses = set()  # whose connections are scanned
+        self._owners = dict()  # zone_id -> lease record of a connection
+
+    def expired(self, lease):
+        return self._tracker.expired(lease)
+
+    def watch(self, conn):
+        if conn.peer_lease is None:
+            return
+        with self._lock:
+            self._connections.add(conn)
+
+    def scan(self, address):
+        with self._lock:
+            self._addresses.add(address)
+
+    def start(self):
+        # The lease is there before any request refers to it.
+        self._renew()
+        thr = Thread(target=self._run)
+        thr.daemon = True
+        thr.start()
+
+    def _renew(self):
+        self._beat += 1
+        try:
+            self._io_t(self._workspace, id_join(ID_LEASE, self.lease)).write({
+                'BEAT':     self._beat,
+                'TIMEOUT':  self.timeout,
+            })
+        except EAgain:
+            LOG.warning('failed to renew the lease %s' % self.lease)
+
+    def _check_connections(self):
+        with self._lock:
+            conns = [conn for conn in self._connections if not conn.closed]
+        for conn in conns:
+            if self._tracker.expired(conn.peer_lease):
+                LOG.warning('the peer of %s is gone, aborting' % conn.zone_id)
+                conn.abort()
+                METRICS.inc('kamui_reclaimed_total', kind='connection')
+                with self._lock:
+                    self._connections.discard(conn)
+
+    def _scan(self, address):
+        with self._lock:
+            live = set(conn.zone_id for conn in self._connections)
+        list_id = id_join(ID_CONNECTION, address)
+        conn_ids = self._io_t(self._workspace, list_id).read().get('CONNECTIONS', [])
+        zone_ids = set(id_join(list_id, conn_id) for conn_id in conn_ids)
+        for zone_id in [z for z in self._owners if z.startswith(list_id + '/')]:
+            if zone_id not in zone_ids:
+                del self._owners[zone_id]
+
+        for zone_id in zone_ids.difference(live):
+            # The record is written once, when the connection is accepted.
+            owner = self._owners.get(zone_id)
+            if owner is None:
+                owner = self._io_t(self._workspace, id_join(zone_id, ID_CONN_LEASE)).read()
+                if owner:
+                    self._owners[zone_id] = owner
+            if not owner or owner.get('SERVER') in (None, self.lease):
+                # an old server's, or closed by ourselves
+                continue
+            if not self._tracker.expired(owner['SERVER']):
+                continue
+            if owner.get('CLIENT') and not self._tracker.expired(owner['CLIENT']):
+                # the client aborts it by itself
+                continue
+            LOG.info('deleting %s of a dead server' % zone_id)
+            self._io_t.delete(self._workspace, zone_id)
+            self._owners.pop(zone_id, None)
+            METRICS.inc('kamui_reclaimed_total', kind='zone')
+
+    def _run(self):
+        interval = self.timeout / 4
+        next_scan = monotonic() + self.timeout
+        while True:
+            sleep(interval)
+            self._renew()
+            self._check_connections()
+            if monotonic() < next_scan:
+                continue
+            next_scan = monotonic() + self.timeout
+            with self._lock:
+                addresses = list(self._addresses)
+            for address in addresses:
+                try:
+                    self._scan(address)
+                except EAgain:
+                    pass
+            self._tracker.forget_idle()
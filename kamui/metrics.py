@@ -0,0 +1,234 @@
+import json
+from http.server import (
+    BaseHTTPRequestHandler,
+    ThreadingHTTPServer,
+)
+from os import (
+    getpid,
+    makedirs,
+    remove,
+    replace as replace_file,
+)
+from os.path import (
+    dirname,
+    isdir,
+    join as path_join,
+)
+from socket import gethostname
+from threading import (
+    Event,
+    Lock,
+    Thread,
+)
+from time import time
+
+from kamui.logging import get_logger
+
+
+LOG = get_logger(__name__)
+
+
+# upper bounds in secs, the last bucket is +Inf
+HISTOGRAM_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                     0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+CONNECTION_FIELDS = ('bytes_sent', 'bytes_received', 'segments_sent', 'segments_received')
+
+
+class _Histogram(object):
+
+    def __init__(self):
+        self.counts = [0] * (len(HISTOGRAM_BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        index = 0
+        while index < len(HISTOGRAM_BUCKETS) and value > HISTOGRAM_BUCKETS[index]:
+            index += 1
+        self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+
+
+class _ConnectionStats(object):
+    # Counters of one live connection, they are added to the totals
+    # as they go, and dropped from the registry once it's closed.
+
+    def __init__(self, registry, conn_id, side):
+        self._registry = registry
+        self.conn_id = conn_id
+        self.side = side
+        for field in CONNECTION_FIELDS:
+            setattr(self, field, 0)
+
+    def add(self, field, value):
+        with self._registry.lock:
+            setattr(self, field, getattr(self, field) + value)
+        self._registry.inc('kamui_connection_%s_total' % field, value, side=self.side)
+
+    def release(self):
+        self._registry.release_connection(self)
+
+
+class MetricsRegistry(object):
+    # Counters and histograms of one process, keyed by name and labels.
+
+    def __init__(self):
+        self.lock = Lock()
+        self._counters = dict()  # (name, labels) -> value
+        self._histograms = dict()  # (name, labels) -> _Histogram
+        self._connections = dict()  # (side, conn_id) -> _ConnectionStats
+
+    def reset(self):
+        # e.g. in a forked child, the parent's numbers are not its own
+        with self.lock:
+            self._counters.clear()
+            self._histograms.clear()
+            self._connections.clear()
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = _Histogram()
+                self._histograms[key] = histogram
+            histogram.observe(value)
+
+    def connection(self, conn_id, side):
+        stats = _ConnectionStats(self, conn_id, side)
+        with self.lock:
+            self._connections[(side, conn_id)] = stats
+        return stats
+
+    def release_connection(self, stats):
+        with self.lock:
+            if self._connections.get((stats.side, stats.conn_id)) is stats:
+                del self._connections[(stats.side, stats.conn_id)]
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'counters': [
+                    {'name': name, 'labels': dict(labels), 'value': value}
+                    for (name, labels), value in sorted(self._counters.items())
+                ],
+                'histograms': [
+                    {'name': name, 'labels': dict(labels), 'buckets': list(HISTOGRAM_BUCKETS),
+                     'counts': list(h.counts), 'count': h.count, 'sum': h.sum}
+                    for (name, labels), h in sorted(self._histograms.items())
+                ],
+                'connections': [
+                    dict({'conn_id': s.conn_id, 'side': s.side},
+                         **{field: getattr(s, field) for field in CONNECTION_FIELDS})
+                    for _, s in sorted(self._connections.items())
+                ],
+            }
+
+    def render_prometheus(self):
+        snapshot = self.snapshot()
+        lines = []
+        for item in snapshot['counters']:
+            lines.append('%s%s %s' % (item['name'], _labels(item['labels']), item['value']))
+        for item in snapshot['histograms']:
+            name, labels = item['name'], item['labels']
+            cumulative = 0
+            for bound, count in zip(list(HISTOGRAM_BUCKETS) + ['+Inf'], item['counts']):
+                cumulative += count
+                lines.append('%s_bucket%s %s' % (name, _labels(labels, le=bound), cumulative))
+            lines.append('%s_count%s %s' % (name, _labels(labels), item['count']))
+            lines.append('%s_sum%s %s' % (name, _labels(labels), item['sum']))
+        for item in snapshot['connections']:
+            labels = {'conn': item['conn_id'], 'side': item['side']}
+            for field in CONNECTION_FIELDS:
+                lines.append('kamui_live_connection_%s%s %s' % (field, _labels(labels), item[field]))
+        return '\n'.join(lines) + '\n'
+
+
+def _labels(labels, **extra):
+    labels = dict(labels, **extra)
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+        for name, value in sorted(labels.items()))
+
+
+METRICS = MetricsRegistry()
+
+
+# --- exporting ---
+
+def stats_file_path(workspace, role):
+    # e.g. $WORKSPACE/stats/server-myhost-1234.json
+    return path_join(workspace, 'stats', '%s-%s-%s.json' % (role, gethostname(), getpid()))
+
+
+def _write_stats(path):
+    t_dir = dirname(path)
+    if not isdir(t_dir):
+        makedirs(t_dir)
+    content = dict(METRICS.snapshot(), time=time(), pid=getpid())
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as fd:
+        json.dump(content, fd)
+    replace_file(tmp_path, path)
+
+
+def start_stats_writer(path, interval):
+    # Writes the stats to $path every $interval secs, until the returned
+    # function is called, which removes $path: a process has one file,
+    # and leaves none behind.
+    stopped = Event()
+
+    def write_loop():
+        while not stopped.wait(interval):
+            try:
+                _write_stats(path)
+            except OSError as ex:
+                LOG.error('failed to write stats: %s' % ex)
+
+    def stop():
+        stopped.set()
+        thr.join()
+        try:
+            remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as ex:
+            LOG.error('failed to remove stats: %s' % ex)
+
+    thr = Thread(target=write_loop)
+    thr.daemon = True
+    thr.start()
+    return stop
+
+
+class _PrometheusHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        content = METRICS.render_prometheus().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_prometheus(port, host='127.0.0.1'):
+    # A local text endpoint in the Prometheus exposition format.
+    server = ThreadingHTTPServer((host, port), _PrometheusHandler)
+    server.daemon_threads = True
+    thr = Thread(target=server.serve_forever)
+    thr.daemon = True
+    thr.start()
+    return server
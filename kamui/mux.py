@@ -0,0 +1,331 @@
+from collections import deque
+from functools import partial
+from socket import (
+    SHUT_RD,
+    SHUT_RDWR,
+    SHUT_WR,
+)
+from struct import Struct
+from threading import (
+    Condition,
+    Thread,
+)
+
+from kamui.base_stream import (
+    run_blocking,
+    BlockingOperation,
+    EAgain,
+)
+from kamui.logging import get_logger
+
+
+LOG = get_logger(__name__)
+
+
+# --- mux frames ---
+#
+# Sub-streams are carried over one proxy connection as frames:
+#   +-----------+------+--------+---------+
+#   | stream id | kind | length | payload |
+#   +-----------+------+--------+---------+
+#   4B          1B     4B       $length B
+
+MUX_HEADER = Struct('>IBI')
+
+MUX_OPEN = 1
+MUX_DATA = 2
+MUX_FIN = 3
+# the stream is closed before reading EOF, drop what is sent to it
+MUX_RST = 4
+
+
+class _SessionWaiter(object):
+    # Waits for something to happen in a session, e.g. data arrived
+    # for a stream, or the outgoing queue drained.
+
+    FALLBACK_TIMEOUT = 1.0
+
+    def __init__(self, session):
+        self._session = session
+
+    def mark(self):
+        return self._session.generation
+
+    def wait(self, mark):
+        cond = self._session.cond
+        with cond:
+            if self._session.generation == mark:
+                cond.wait(self.FALLBACK_TIMEOUT)
+
+    def close(self):
+        pass
+
+
+class MuxStream(object):
+    # A sub-stream, which works like a proxy connection.
+
+    def __init__(self, session, stream_id):
+        self._session = session
+        self.stream_id = stream_id
+        self._recv_buffer = bytearray()
+        self._recv_eof = False
+        self._send_eof = False
+        self._closed = False
+        self._reset = False
+
+    def waiter(self):
+        return _SessionWaiter(self._session)
+
+    def feed(self, data):
+        # under session.cond
+        if not self._closed:
+            self._recv_buffer += data
+
+    def feed_eof(self):
+        # under session.cond
+        self._recv_eof = True
+
+    def feed_reset(self):
+        # under session.cond
+        self._recv_eof = True
+        self._reset = True
+        del self._recv_buffer[:]
+
+    @property
+    def closed(self):
+        return self._closed
+
+    @property
+    def buffered(self):
+        return len(self._recv_buffer)
+
+    def recv(self, data_len=0):
+        raise BlockingOperation(partial(
+            self._on_retrying_receiving, data_len))
+
+    def _on_retrying_receiving(self, data_len):
+        with self._session.cond:
+            if self._reset:
+                raise ConnectionResetError('mux stream reset by peer')
+            if not self._recv_buffer:
+                if self._recv_eof:
+                    return b''
+                raise EAgain('no data')
+            if data_len <= 0:
+                data_len = len(self._recv_buffer)
+            data = bytes(self._recv_buffer[:data_len])
+            del self._recv_buffer[:data_len]
+            # the reader may be waiting for buffers to drain
+            self._session.touch()
+            return data
+
+    def sendall(self, data):
+        assert isinstance(data, bytes)
+        raise BlockingOperation(partial(
+            self._on_retrying_sending_all, data))
+
+    def _on_retrying_sending_all(self, data):
+        if self._reset:
+            raise ConnectionResetError('mux stream reset by peer')
+        if self._send_eof:
+            raise BrokenPipeError('sending-pipe closed')
+        if self._session.closed:
+            raise BrokenPipeError('mux session closed')
+        self._session.push(self.stream_id, MUX_DATA, data)
+
+    def shutdown(self, flag):
+        assert flag in (SHUT_RD, SHUT_WR, SHUT_RDWR)
+        if flag == SHUT_RD or self._send_eof or self._reset:
+            return
+        self._send_eof = True
+        self._session.push(self.stream_id, MUX_FIN, b'', force=True)
+        self._session.release(self)
+
+    def close(self):
+        # Closing before EOF resets the stream, or the peer would go on
+        # sending to it, and its data would hold up the session.
+        with self._session.cond:
+            if self._closed:
+                return
+            self._closed = True
+            del self._recv_buffer[:]
+            reset = not self._recv_eof
+            self._session.touch()
+        if not reset:
+            self.shutdown(SHUT_RDWR)
+            return
+        self._send_eof = True
+        if not self._session.closed:
+            self._session.push(self.stream_id, MUX_RST, b'', force=True)
+        self._session.release(self)
+
+
+class MuxSession(object):
+    # Many sub-streams over one long-lived proxy connection.
+    #
+    # Opening a stream is a single OPEN frame, no handshake on the
+    # shared medium. The client opens streams with odd ids.
+    #
+    # There is no per-stream flow control: when a stream has too much
+    # unread data, the reader thread stops reading the proxy connection
+    # until it drains, which holds back every stream of the session.
+
+    MAX_QUEUED_BYTES = 1024 * 1024
+    MAX_BUFFERED_BYTES = 4 * 1024 * 1024
+    MAX_BATCH_BYTES = 256 * 1024
+
+    def __init__(self, conn, side, make_waiter, on_stream=None):
+        assert side in ('client', 'server')
+        self._conn = conn
+        self._side = side
+        self._make_waiter = make_waiter
+        self._on_stream = on_stream
+        self._streams = dict()  # stream id -> MuxStream
+        self._outgoing = deque()
+        self._queued = 0
+        self._next_id = 1
+        self.cond = Condition()
+        self.generation = 0
+        self.closed = False
+
+        for target in (self._read_loop, self._write_loop):
+            thr = Thread(target=target)
+            thr.daemon = True
+            thr.start()
+
+    def touch(self):
+        # under self.cond
+        self.generation += 1
+        self.cond.notify_all()
+
+    def open_stream(self):
+        assert self._side == 'client'
+        with self.cond:
+            if self.closed:
+                raise BrokenPipeError('mux session closed')
+            stream = MuxStream(self, self._next_id)
+            self._next_id += 2
+            self._streams[stream.stream_id] = stream
+        self.push(stream.stream_id, MUX_OPEN, b'', force=True)
+        return stream
+
+    def push(self, stream_id, kind, payload, force=False):
+        with self.cond:
+            if not force and self._queued >= self.MAX_QUEUED_BYTES:
+                raise EAgain('mux session busy')
+            self._outgoing.append(MUX_HEADER.pack(stream_id, kind, len(payload)))
+            self._outgoing.append(payload)
+            self._queued += MUX_HEADER.size + len(payload)
+            self.touch()
+
+    def release(self, stream):
+        with self.cond:
+            if stream._closed or (stream._send_eof and stream._recv_eof):
+                self._streams.pop(stream.stream_id, None)
+
+    def _write_loop(self):
+        waiter = self._make_waiter()
+        try:
+            while True:
+                with self.cond:
+                    while not self._outgoing and not self.closed:
+                        self.cond.wait()
+                    if self.closed:
+                        break
+                    batch = []
+                    size = 0
+                    while self._outgoing and size < self.MAX_BATCH_BYTES:
+                        chunk = self._outgoing.popleft()
+                        batch.append(chunk)
+                        size += len(chunk)
+                    self._queued -= size
+                    self.touch()
+                run_blocking(waiter, self._conn.sendall, b''.join(batch))
+        except (BrokenPipeError, ConnectionError) as ex:
+            LOG.error('mux session broken: %s' % ex)
+        finally:
+            self._close(waiter)
+
+    def _read_loop(self):
+        waiter = self._make_waiter()
+        buf = bytearray()
+        try:
+            while not self.closed:
+                data = run_blocking(waiter, self._conn.recv, 0)
+                if not data:
+                    LOG.debug('mux session: EOF')
+                    break
+                buf += data
+                offset = self._dispatch(buf)
+                del buf[:offset]
+                self._wait_for_draining()
+        except (BrokenPipeError, ConnectionError) as ex:
+            LOG.error('mux session broken: %s' % ex)
+        finally:
+            self._close(waiter)
+
+    def _dispatch(self, buf):
+        offset = 0
+        new_streams = []
+        with self.cond:
+            while len(buf) - offset >= MUX_HEADER.size:
+                stream_id, kind, length = MUX_HEADER.unpack_from(buf, offset)
+                end = offset + MUX_HEADER.size + length
+                if len(buf) < end:
+                    break
+                payload = bytes(buf[offset + MUX_HEADER.size:end])
+                offset = end
+
+                stream = self._streams.get(stream_id)
+                if kind == MUX_OPEN:
+                    if stream is None and self._side == 'server':
+                        stream = MuxStream(self, stream_id)
+                        self._streams[stream_id] = stream
+                        new_streams.append(stream)
+                elif stream is None:
+                    # closed already, drop it
+                    continue
+                elif kind == MUX_DATA:
+                    stream.feed(payload)
+                elif kind == MUX_FIN:
+                    stream.feed_eof()
+                    if stream._send_eof:
+                        self._streams.pop(stream_id, None)
+                elif kind == MUX_RST:
+                    stream.feed_reset()
+                    self._streams.pop(stream_id, None)
+                else:
+                    raise BrokenPipeError('bad mux frame')
+            self.touch()
+
+        for stream in new_streams:
+            if self._on_stream is not None:
+                self._on_stream(stream)
+        return offset
+
+    def _wait_for_draining(self):
+        with self.cond:
+            while not self.closed and any(
+                    not s.closed and s.buffered > self.MAX_BUFFERED_BYTES
+                    for s in self._streams.values()):
+                self.cond.wait(_SessionWaiter.FALLBACK_TIMEOUT)
+
+    def _close(self, waiter):
+        waiter.close()
+        with self.cond:
+            if self.closed:
+                return
+            self.closed = True
+            for stream in self._streams.values():
+                # without its FIN, the stream may be cut short
+                if not stream._recv_eof:
+                    stream.feed_reset()
+            self._streams.clear()
+            self.touch()
+        waiter = self._make_waiter()
+        try:
+            run_blocking(waiter, self._conn.close)
+        except (BrokenPipeError, ConnectionError):
+            pass
+        finally:
+            waiter.close()
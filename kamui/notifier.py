@@ -0,0 +1,451 @@
+import ctypes
+import ctypes.util
+import os
+import struct
+import sys
+from threading import (
+    Condition,
+    Lock,
+    Thread,
+)
+from time import (
+    monotonic,
+    sleep,
+    time_ns,
+)
+
+from kamui.logging import get_logger
+
+
+LOG = get_logger(__name__)
+
+
+class _PollingWaiter(object):
+    # Polls every $interval secs. With a larger $max_interval, every
+    # poll that finds nothing doubles the sleep up to $max_interval, and
+    # the sleep drops back to $interval once an operation goes through.
+    # So idle connections spend little IOPS, and busy ones stay fast.
+    #
+    # An operation is known to have gone through when mark() is called
+    # again without a wait() in between.
+
+    MAX_STREAK = 32
+
+    def __init__(self, interval, max_interval=None):
+        self._interval = interval
+        self._max_interval = max(interval, max_interval or 0)
+        self._streak = 0
+        self._waited = False
+        self._idle_since = None
+        self._last_wake = None
+        self._gap = 0  # moving average of secs the peer kept us waiting
+
+    def mark(self):
+        if not self._waited and self._idle_since is not None:
+            gap = self._last_wake - self._idle_since
+            self._gap = gap if not self._gap else 0.8 * self._gap + 0.2 * gap
+            self._idle_since = None
+            self._streak = 0
+        self._waited = False
+        return None
+
+    def _next_delay(self, now):
+        delay = min(self._interval * 2 ** self._streak, self._max_interval)
+        if self._gap and now - self._idle_since < 2 * self._gap:
+            # The peer usually acts about now, don't sleep through it.
+            delay = min(delay, max(self._interval, self._gap / 4))
+        return delay
+
+    def wait(self, mark):
+        now = monotonic()
+        if self._idle_since is None:
+            self._idle_since = now
+        delay = self._next_delay(now)
+        self._streak = min(self._streak + 1, self.MAX_STREAK)
+        self._waited = True
+        sleep(delay)
+        self._last_wake = monotonic()
+
+    def close(self):
+        pass
+
+
+class PollingNotifier(object):
+    # The fallback when change notification is not available,
+    # e.g. the workspace is on SMB/NFS, or the OS is not linux.
+    #
+    # $max_interval is the most secs an idle waiter may sleep,
+    # None means polling at the fixed interval.
+
+    available = True
+
+    def __init__(self, max_interval=None):
+        self.max_interval = max_interval
+
+    def waiter(self, path, interval):
+        return _PollingWaiter(interval, self.max_interval)
+
+    def close(self):
+        pass
+
+
+class _Watch(object):
+
+    def __init__(self, path, lock):
+        self.path = path
+        self.wd = None
+        self.refs = 0
+        self.generation = 0
+        self.cond = Condition(lock)
+        # of the waiters on several paths, which are woken by any of them
+        self.listeners = []
+
+    def changed(self):
+        # under the lock
+        self.generation += 1
+        self.cond.notify_all()
+        for cond in self.listeners:
+            cond.notify_all()
+
+
+def _listen(watches, lock):
+    # Returns the condition notified on a change of any of $watches,
+    # under $lock.
+    if len(watches) == 1:
+        return watches[0].cond
+    cond = Condition(lock)
+    for watch in watches:
+        watch.listeners.append(cond)
+    return cond
+
+
+def _unlisten(watch, cond):
+    # under the lock
+    if cond in watch.listeners:
+        watch.listeners.remove(cond)
+
+
+def _paths(path):
+    # A zone may be spread over several dirs, see BaseIO.locate().
+    return path if isinstance(path, tuple) else (path,)
+
+
+class _InotifyWaiter(object):
+
+    def __init__(self, notifier, watches, cond, interval):
+        self._notifier = notifier
+        self._watches = watches
+        self._cond = cond
+        self._interval = interval
+
+    def mark(self):
+        return tuple(watch.generation for watch in self._watches)
+
+    def wait(self, mark):
+        for watch in self._watches:
+            if watch.wd is None and not self._notifier.add_watch(watch):
+                # The directory may be not created yet, poll for a while.
+                sleep(self._interval)
+                return
+        deadline = monotonic() + self._notifier.fallback_timeout
+        with self._cond:
+            while self.mark() == mark and \
+                    all(watch.wd is not None for watch in self._watches):
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+
+    def close(self):
+        if self._watches is not None:
+            for watch in self._watches:
+                self._notifier.release(watch, self._cond)
+            self._watches = None
+
+
+class InotifyNotifier(object):
+
+    # struct inotify_event { int wd; uint32_t mask, cookie, len; char name[]; }
+    _EVENT = struct.Struct('iIII')
+
+    IN_MODIFY = 0x00000002
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_IGNORED = 0x00008000
+    IN_ONLYDIR = 0x01000000
+    IN_CLOEXEC = 0o2000000
+
+    WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE |
+                  IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_ONLYDIR)
+
+    def __init__(self, fallback_timeout=1.0, max_interval=None):
+        # Even with notifications, a waiter re-checks every $fallback_timeout
+        # seconds, so that a missed event can't hang a connection.
+        self.fallback_timeout = fallback_timeout
+        # for the paths which can't be watched, see PollingNotifier
+        self.max_interval = max_interval
+        self._libc = None
+        self._fd = -1
+        self._lock = Lock()
+        self._watches = dict()  # path -> _Watch
+        self._wds = dict()  # wd -> _Watch
+
+        if not sys.platform.startswith('linux'):
+            return
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            fd = libc.inotify_init1(self.IN_CLOEXEC)
+        except (OSError, AttributeError):
+            return
+        if fd < 0:
+            return
+        self._libc = libc
+        self._fd = fd
+        thr = Thread(target=self._run)
+        thr.daemon = True
+        thr.start()
+
+    @property
+    def available(self):
+        return self._fd >= 0
+
+    def waiter(self, path, interval):
+        watches = []
+        with self._lock:
+            for one_path in _paths(path):
+                watch = self._watches.get(one_path)
+                if watch is None:
+                    watch = _Watch(one_path, self._lock)
+                    self._watches[one_path] = watch
+                watch.refs += 1
+                watches.append(watch)
+            cond = _listen(watches, self._lock)
+        for watch in watches:
+            self.add_watch(watch)
+        return _InotifyWaiter(self, watches, cond, interval)
+
+    def add_watch(self, watch):
+        with self._lock:
+            if watch.wd is not None:
+                return True
+            wd = self._libc.inotify_add_watch(
+                self._fd, os.fsencode(watch.path), self.WATCH_MASK)
+            if wd < 0:
+                return False
+            watch.wd = wd
+            self._wds[wd] = watch
+            # Something may have changed before the watch was set up.
+            watch.generation += 1
+            return True
+
+    def release(self, watch, cond):
+        with self._lock:
+            _unlisten(watch, cond)
+            watch.refs -= 1
+            if watch.refs > 0:
+                return
+            self._watches.pop(watch.path, None)
+            if watch.wd is not None:
+                self._wds.pop(watch.wd, None)
+                self._libc.inotify_rm_watch(self._fd, watch.wd)
+                watch.wd = None
+
+    def _run(self):
+        while True:
+            try:
+                buf = os.read(self._fd, 64 * 1024)
+            except OSError:
+                LOG.debug('inotify closed')
+                return
+            offset = 0
+            with self._lock:
+                while offset < len(buf):
+                    wd, mask, _, name_len = self._EVENT.unpack_from(buf, offset)
+                    offset += self._EVENT.size + name_len
+                    watch = self._wds.get(wd)
+                    if watch is None:
+                        continue
+                    if mask & self.IN_IGNORED:
+                        # The directory is gone, waiters fall back to polling.
+                        self._wds.pop(wd, None)
+                        watch.wd = None
+                    watch.changed()
+
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+
+class _SweptWatch(_Watch):
+
+    def __init__(self, path, lock):
+        super(_SweptWatch, self).__init__(path, lock)
+        self.signature = None
+        self.names = ()  # the files written in place in the dir
+        self.streak = 0
+        self.next_sweep = 0
+
+
+class _SweepWaiter(object):
+
+    def __init__(self, notifier, watches, cond):
+        self._notifier = notifier
+        self._watches = watches
+        self._cond = cond
+
+    def mark(self):
+        return tuple(watch.generation for watch in self._watches)
+
+    def wait(self, mark):
+        deadline = monotonic() + self._notifier.fallback_timeout
+        with self._cond:
+            while self.mark() == mark:
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+
+    def close(self):
+        if self._watches is not None:
+            for watch in self._watches:
+                self._notifier.release(watch, self._cond)
+            self._watches = None
+
+
+class SweepNotifier(object):
+    # For a medium without change notification, e.g. SMB/NFS.
+    #
+    # Instead of every blocked operation reading its own files again
+    # and again, one thread per process stats the watched dirs, and
+    # wakes the waiters of the ones that changed. A file replaced by a
+    # rename changes the mtime of its dir, the files appended or
+    # overwritten in place ($in_place(name) is true) are stat'ed as well.
+    #
+    # A dir that didn't change is stat'ed less and less often, the
+    # interval doubles up to $max_interval, so the stats per tick grow
+    # with the active connections rather than the open ones. A sweep
+    # is run by $run_io(func, *args), e.g. as one operation of the
+    # IOPS budget of the medium.
+
+    # A medium which keeps whole secs of mtime can't tell changes in
+    # the same sec apart, such a dir is taken as changed for this long.
+    RACY_NSEC = 2 * 10 ** 9
+
+    available = True
+
+    def __init__(self, interval, max_interval=None, in_place=None, run_io=None,
+                 fallback_timeout=1.0):
+        self.fallback_timeout = fallback_timeout
+        self.max_interval = max_interval
+        self._interval = interval
+        self._max_interval = max(interval, max_interval or 0)
+        self._in_place = in_place or (lambda name: False)
+        self._run_io = run_io or (lambda func, *args: func(*args))
+        self._lock = Lock()
+        self._cond = Condition(self._lock)  # wakes the sweeper for a new watch
+        self._watches = dict()  # path -> _SweptWatch
+        thr = Thread(target=self._run)
+        thr.daemon = True
+        thr.start()
+
+    def waiter(self, path, interval):
+        watches = []
+        with self._lock:
+            for one_path in _paths(path):
+                watch = self._watches.get(one_path)
+                if watch is None:
+                    watch = _SweptWatch(one_path, self._lock)
+                    self._watches[one_path] = watch
+                    self._cond.notify()
+                watch.refs += 1
+                watches.append(watch)
+            cond = _listen(watches, self._lock)
+        return _SweepWaiter(self, watches, cond)
+
+    def release(self, watch, cond):
+        with self._lock:
+            _unlisten(watch, cond)
+            watch.refs -= 1
+            if watch.refs <= 0:
+                self._watches.pop(watch.path, None)
+
+    def _signature(self, watch):
+        # Returns the state of the dir, None if it doesn't exist.
+        try:
+            st = os.stat(watch.path)
+        except OSError:
+            return None
+        if watch.signature is None or watch.signature[0] != st.st_mtime_ns:
+            # something is created, renamed or deleted in the dir
+            try:
+                watch.names = tuple(sorted(
+                    name for name in os.listdir(watch.path) if self._in_place(name)))
+            except OSError:
+                return None
+        files = []
+        for name in watch.names:
+            try:
+                f_st = os.stat(os.path.join(watch.path, name))
+            except OSError:
+                continue
+            files.append((name, f_st.st_ino, f_st.st_size, f_st.st_mtime_ns))
+        racy = (st.st_mtime_ns % 10 ** 9 == 0 and
+                time_ns() - st.st_mtime_ns < self.RACY_NSEC)
+        return st.st_mtime_ns, racy, tuple(files)
+
+    def _sweep(self, watch, now):
+        signature = self._signature(watch)
+        changed = signature != watch.signature or (signature is not None and signature[1])
+        watch.signature = signature
+        if changed:
+            watch.streak = 0
+        else:
+            watch.streak = min(watch.streak + 1, _PollingWaiter.MAX_STREAK)
+        watch.next_sweep = now + min(
+            self._interval * 2 ** watch.streak, self._max_interval)
+        return changed
+
+    def _sweep_all(self, watches, now):
+        return [watch for watch in watches if self._sweep(watch, now)]
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._watches:
+                    self._cond.wait()
+                now = monotonic()
+                due = [w for w in self._watches.values() if w.next_sweep <= now]
+
+            # the IO is done out of the lock
+            changed = self._run_io(self._sweep_all, due, now) if due else []
+
+            with self._lock:
+                for watch in changed:
+                    watch.changed()
+                next_sweep = min((w.next_sweep for w in self._watches.values()),
+                                 default=now + self._interval)
+                remaining = next_sweep - monotonic()
+                if remaining > 0:
+                    # a new watch is swept at once
+                    self._cond.wait(remaining)
+
+    def close(self):
+        pass
+
+
+def create_notifier(enabled, max_interval=None, sweep_interval=None, in_place=None,
+                    run_io=None):
+    # $sweep_interval is the tick of a SweepNotifier, used without
+    # inotify, None means every waiter polls on its own.
+    if enabled:
+        notifier = InotifyNotifier(max_interval=max_interval)
+        if notifier.available:
+            return notifier
+        LOG.warning('change notification is not available, fall back to polling.')
+    if sweep_interval:
+        return SweepNotifier(sweep_interval, max_interval, in_place, run_io)
+    return PollingNotifier(max_interval)
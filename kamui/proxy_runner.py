@@ -1,17 +1,31 @@
-from collections import namedtuple
+from collections import (
+    deque,
+    namedtuple,
+)
+from functools import partial
 from multiprocessing import (
     Process,
 )
 from os.path import realpath
 from queue import Queue
+from select import select
+from signal import (
+    SIGTERM,
+    signal,
+)
 from socket import (
     create_connection,
     socket,
     AF_INET,
+    SHUT_RD,
     SHUT_WR,
+    SO_LINGER,
     SOCK_STREAM,
+    SOL_SOCKET,
 )
+from struct import Struct
 from threading import (
+    Condition,
     Thread,
 )
 from time import (
@@ -20,32 +34,80 @@ from time import (
 )
 
 from kamui.base_stream import (
+    run_blocking,
     BaseClient,
     BaseServer,
     BlockingOperation,
     EAgain,
 )
+from kamui.lease import Janitor
 from kamui.logging import get_logger
+from kamui.metrics import (
+    serve_prometheus,
+    start_stats_writer,
+    stats_file_path,
+    METRICS,
+)
+from kamui.mux import MuxSession
+from kamui.notifier import (
+    create_notifier,
+    PollingNotifier,
+)
+from kamui.tracing import (
+    start_chrome_trace,
+    TRACING,
+)
 
 
 LOG = get_logger(__name__)
 
+# l_onoff=1, l_linger=0: close() resets the connection
+_LINGER_RESET = Struct('ii').pack(1, 0)
 
 ClientWorkspaceConfig = namedtuple('ClientWorkspaceConfig', (
+    'flush_deadline',
     'iops',
+    'keep_files_open',
+    'lease_timeout',
     'listen_address',
+    'max_poll_interval',
+    'max_segment_size',
+    'metrics_port',
+    'multiplex',
+    'notify',
+    'pool_size',
     'proxy_address',
+    'stats_interval',
+    'sweep',
     'time_slice_interval',
+    'trace_file',
+    'weights',
+    'window_size',
     'workspace',
+    'workspace_format',
 ))
 
 
 ServerWorkspaceConfig = namedtuple('ServerWorkspaceConfig', (
+    'flush_deadline',
     'iops',
+    'keep_files_open',
+    'lease_timeout',
+    'max_poll_interval',
+    'max_segment_size',
+    'metrics_port',
+    'notify',
     'proxy_address',
+    'stats_interval',
+    'sweep',
     'target_address',
     'time_slice_interval',
+    'trace_file',
+    'weights',
+    'window_size',
+    'workers',
     'workspace',
+    'workspace_format',
 ))
 
 
@@ -59,9 +121,182 @@ def _check_proxy_address(address):
         raise ValueError('Invalid proxy-address: ' + str(address))
 
 
+def _check_weights(weights):
+    # e.g.
+    # {'foo.com': 2, 'foo.com/3': 0.5}
+    # share of the IOPS budget per proxy-address, or per connection
+    if not isinstance(weights, dict):
+        raise ValueError('Invalid weights: ' + str(weights))
+    for name, weight in weights.items():
+        if not isinstance(weight, (int, float)) or weight <= 0:
+            raise ValueError('Invalid weight for %s: %s' % (name, weight))
+    return dict(weights)
+
+
+def _check_workspace_format(fmt):
+    if fmt not in (1, 2):
+        raise ValueError('Invalid workspace-format: ' + str(fmt))
+
+
+def _detect_format(config, io_type):
+    # Done before anything of the address is touched, the format may be
+    # another one than configured if the address is used already.
+    io_type.set_workspace_format(config.workspace_format)
+    while True:
+        try:
+            fmt = io_type.detect_format(config.workspace, config.proxy_address)
+            break
+        except EAgain:
+            sleep(config.time_slice_interval)
+    LOG.info('workspace format of %s: %s' % (config.proxy_address, fmt))
+
+
+def _exit_on_signal(signum, frame):
+    raise SystemExit(128 + signum)
+
+
+def _start_janitor(config, io_type, role):
+    if not config.lease_timeout:
+        return None
+    janitor = Janitor(io_type, config.workspace, role, config.lease_timeout)
+    janitor.start()
+    return janitor
+
+
+def _start_metrics(config, role, port):
+    # Returns the function to stop writing the stats, or None.
+    stop_stats = None
+    if config.stats_interval > 0:
+        stop_stats = start_stats_writer(stats_file_path(config.workspace, role),
+                                        config.stats_interval)
+    if port > 0:
+        serve_prometheus(port)
+        LOG.info('metrics on http://127.0.0.1:%s/metrics' % port)
+    return stop_stats
+
+
+class _ProxyConnectionPool(object):
+    # Proxy connections established ahead of the tcp connections,
+    # so a new tcp connection doesn't wait for the handshake on the
+    # shared medium. A background thread keeps $size of them.
+    #
+    # The server proxy connects to the target once it accepts, so an
+    # idle connection holds a tcp connection at the target as well.
+    # It's dropped after $max_idle secs.
+
+    def __init__(self, size, max_idle, connect, discard):
+        self._size = size
+        self._max_idle = max_idle
+        self._connect = connect
+        self._discard = discard
+        self._idle = deque()  # (conn, established time), the oldest first
+        self._cond = Condition()
+
+        thr = Thread(target=self._refill_loop)
+        thr.daemon = True
+        thr.start()
+
+    def take(self):
+        # Returns a warm connection, or None if there is none.
+        with self._cond:
+            self._evict()
+            if not self._idle:
+                return None
+            conn, _ = self._idle.popleft()
+            self._cond.notify_all()
+            return conn
+
+    def _evict(self):
+        # under self._cond
+        now = monotonic()
+        while self._idle and now - self._idle[0][1] > self._max_idle:
+            conn, _ = self._idle.popleft()
+            self._discard(conn)
+
+    def _refill_loop(self):
+        while True:
+            with self._cond:
+                self._evict()
+                while len(self._idle) >= self._size:
+                    self._cond.wait(self._max_idle / 2)
+                    self._evict()
+            try:
+                conn = self._connect()
+            except (TimeoutError, BrokenPipeError, ConnectionError) as ex:
+                LOG.error('failed to fill the proxy connection pool: %s' % ex)
+                sleep(1)
+                continue
+            with self._cond:
+                self._idle.append((conn, monotonic()))
+
+
+class _SegmentCoalescer(object):
+    # Nagle-like batching of tcp data into proxy segments.
+    #
+    # Every segment costs a few IOPS-throttled operations on the shared
+    # medium, so it's worth waiting a little for more data: at most
+    # half of the measured per-segment latency, and never longer than
+    # the flush deadline. The segment size grows while the socket keeps
+    # filling it (bulk), and shrinks back for small writes (interactive).
+
+    MIN_SEGMENT_SIZE = 4096
+
+    def __init__(self, sock, max_segment_size, flush_deadline):
+        self._sock = sock
+        self._max_size = max(max_segment_size, self.MIN_SEGMENT_SIZE)
+        self._deadline = flush_deadline
+        self._target = self.MIN_SEGMENT_SIZE
+        self._op_latency = None
+        self._eof = False
+        # The socket reads into it, a segment is copied out once.
+        # It follows the segment size, an interactive connection
+        # doesn't keep a buffer of the max size.
+        self._buf = memoryview(bytearray(self._target))
+
+    def recv(self):
+        if self._eof:
+            return b''
+        if len(self._buf) != self._target:
+            self._buf = memoryview(bytearray(self._target))
+        size = self._sock.recv_into(self._buf, self._target)
+        if not size or size >= self._target:
+            return bytes(self._buf[:size])
+
+        wait = min(self._deadline, (self._op_latency or 0) / 2)
+        deadline = monotonic() + wait
+        while size < self._target:
+            # Even if the deadline is over, take what is ready already.
+            remaining = max(deadline - monotonic(), 0)
+            readable, _, _ = select([self._sock], [], [], remaining)
+            if not readable:
+                break
+            received = self._sock.recv_into(self._buf[size:self._target])
+            if not received:
+                # EOF goes out with the next call.
+                self._eof = True
+                break
+            size += received
+        return bytes(self._buf[:size])
+
+    def feedback(self, segment_size, latency):
+        if self._op_latency is None:
+            self._op_latency = latency
+        else:
+            self._op_latency = self._op_latency * 0.8 + latency * 0.2
+
+        if segment_size >= self._target:
+            self._target = min(self._target * 2, self._max_size)
+        elif segment_size < self._target // 4:
+            self._target = max(self._target // 2, self.MIN_SEGMENT_SIZE)
+
+
 class _SimplexChannelThread(Thread):
 
-    def __init__(self, q_, addr_in, conn_in, addr_out, conn_out, *args, **kwargs):
+    RETRY_INTERVAL = 0.01
+
+    def __init__(self, q_, addr_in, conn_in, addr_out, conn_out,
+                 notifier=None, max_segment_size=4096, flush_deadline=0,
+                 *args, **kwargs):
         super(_SimplexChannelThread, self).__init__(*args, **kwargs)
         self._q = q_  # type: Queue
         self._addr_in = addr_in
@@ -69,51 +304,128 @@ class _SimplexChannelThread(Thread):
         self._addr_out = addr_out
         self._conn_out = conn_out
 
-    @staticmethod
-    def _long_op(func, *args, **kwargs):
+        self._max_segment_size = max_segment_size
+        # tcp -> proxy
+        self._coalescer = None
+        if isinstance(conn_in, socket) and not isinstance(conn_out, socket):
+            self._coalescer = _SegmentCoalescer(
+                conn_in, max_segment_size, flush_deadline)
+        # proxy -> tcp, segments go to the socket without being copied,
+        # from the medium if it's mapped
+        self._zero_copy = (isinstance(conn_out, socket) and
+                           hasattr(conn_in, 'recv_chunk'))
+
+        # The proxy side of the channel tells how to wait for the peer.
+        self._waiter = None
+        interval = self.RETRY_INTERVAL
+        for conn in (conn_in, conn_out):
+            if hasattr(conn, 'waiter'):
+                self._waiter = conn.waiter()
+                break
+            if not hasattr(conn, 'watch_path'):
+                continue
+            if conn.poll_interval() is not None:
+                interval = conn.poll_interval()
+            watch_path = conn.watch_path()
+            if notifier is not None and watch_path is not None:
+                self._waiter = notifier.waiter(watch_path, interval)
+        if self._waiter is None:
+            max_interval = notifier.max_interval if notifier is not None else None
+            self._waiter = PollingNotifier(max_interval).waiter(None, interval)
+
+    def _long_op(self, func, *args, **kwargs):
+        # TODO: set timeout
+        if not TRACING.enabled:
+            return run_blocking(self._waiter, func, *args, **kwargs)
+        start_time = monotonic()
         try:
-            return func(*args, **kwargs)
-        except BlockingOperation as ex:
-            retring = ex.retrying
-            while True:
-                try:
-                    return retring()
-                except EAgain:
-                    # TODO: set timeout and customized interval
-                    sleep(0.01)
-                    continue
+            return run_blocking(self._waiter, func, *args, **kwargs)
+        finally:
+            TRACING.span('channel', func.__name__, start_time,
+                         channel='%s -> %s' % (self._addr_in, self._addr_out))
+
+    def _recv(self):
+        if self._coalescer is not None:
+            return self._coalescer.recv()
+        if self._zero_copy:
+            return self._long_op(self._conn_in.recv_chunk, self._max_segment_size)
+        return self._long_op(self._conn_in.recv, self._max_segment_size)
+
+    def _sendall(self, data):
+        if self._coalescer is None:
+            return self._long_op(self._conn_out.sendall, data)
+        start_time = monotonic()
+        self._long_op(self._conn_out.sendall, data)
+        self._coalescer.feedback(len(data), monotonic() - start_time)
 
     def run(self):
         try:
             while True:
-                data = self._long_op(self._conn_in.recv, 4096)
+                data = self._recv()
                 if not data:
                     # read EOF
                     LOG.debug('%s -> %s: EOF' % (self._addr_in, self._addr_out))
                     self._long_op(self._conn_out.shutdown, SHUT_WR)
                     break
-                self._long_op(self._conn_out.sendall, data)
-        except ConnectionAbortedError:
-            LOG.error('connection aborted by accident.')
+                self._sendall(data)
+        except ConnectionError as ex:
+            LOG.error('connection aborted by accident: %s' % ex)
+            # The other direction may be blocked on its socket. The tcp
+            # peer is reset on close, a FIN would make the truncated
+            # stream look complete.
+            for conn in (self._conn_in, self._conn_out):
+                if isinstance(conn, socket):
+                    try:
+                        conn.setsockopt(SOL_SOCKET, SO_LINGER, _LINGER_RESET)
+                        conn.shutdown(SHUT_RD)
+                    except OSError:
+                        pass
         finally:
             self._q.put(1, block=False)
             if self._q.full():
                 LOG.debug('channel [%s -- %s] closed' % (self._addr_in, self._addr_out))
                 self._long_op(self._conn_out.close)
                 self._long_op(self._conn_in.close)
+            self._waiter.close()
 
 
 class ClientWorkspaceProcess(Process):
 
     PROXY_CLIENT = BaseClient
+    # secs a pooled proxy connection may stay unused
+    POOL_MAX_IDLE = 30
 
     @staticmethod
     def parse_config(dict_data):
+        fd = dict_data.get('flush_deadline', 0)
+        if fd < 0:
+            fd = 0
+        fd /= 1000  # ms -> s
+
         iops = dict_data.get('iops', 3)
 
+        kfo = bool(dict_data.get('keep_files_open', False))
+
+        # 0 means no leases
+        lt = dict_data.get('lease_timeout', 0)
+        if lt < 0:
+            lt = 0
+
         la = dict_data.get('listen_address')
         _check_tcp_address(la)
 
+        mss = dict_data.get('max_segment_size', 4096)
+
+        mp = dict_data.get('metrics_port', 0)
+        if mp < 0:
+            mp = 0
+
+        si = dict_data.get('stats_interval', 0)
+        if si < 0:
+            si = 0
+
+        mx = bool(dict_data.get('multiplex', False))
+
         pa = dict_data.get('proxy_address')
         _check_proxy_address(pa)
 
@@ -122,131 +434,433 @@ class ClientWorkspaceProcess(Process):
             ts = 1
         ts /= 1000  # ms -> s
 
+        # 0 means polling every time slice
+        mpi = dict_data.get('max_poll_interval', 0)
+        mpi /= 1000  # ms -> s
+        if mpi < ts:
+            mpi = ts
+
+        nt = bool(dict_data.get('notify', False))
+
+        tf = dict_data.get('trace_file') or None
+
+        sw = bool(dict_data.get('sweep', False))
+
+        ps = dict_data.get('pool_size', 0)
+        if ps < 0:
+            ps = 0
+
+        wt = _check_weights(dict_data.get('weights', {}))
+
+        wnd = dict_data.get('window_size', 1)
+        if wnd < 1:
+            wnd = 1
+
         ws = dict_data.get('workspace')
         if not ws:
             ws = './_workspace'
 
+        # 1 is the flat one of the old versions
+        wf = dict_data.get('workspace_format', 1)
+        _check_workspace_format(wf)
+
         return ClientWorkspaceConfig(
+            flush_deadline=fd,
             iops=iops,
+            keep_files_open=kfo,
+            lease_timeout=lt,
             listen_address=la,
+            max_poll_interval=mpi,
+            max_segment_size=mss,
+            metrics_port=mp,
+            multiplex=mx,
+            notify=nt,
+            pool_size=ps,
             proxy_address=pa,
+            stats_interval=si,
+            sweep=sw,
             time_slice_interval=ts,
-            workspace=realpath(ws)
+            trace_file=tf,
+            weights=wt,
+            window_size=wnd,
+            workspace=realpath(ws),
+            workspace_format=wf
         )
 
     def __init__(self, client_proxy_config, *args, **kwargs):
         super(ClientWorkspaceProcess, self).__init__(*args, **kwargs)
-        self._config = self.parse_config(client_proxy_config)
+        self._proxy_config = self.parse_config(client_proxy_config)
+        self._notifier = None
+        self._mux_session = None
+        self._pool = None
+        self._janitor = None
 
     def _proxy_connect(self, timeout_msec=30000):
-        proxy_client = self.PROXY_CLIENT(self._config.workspace)
+        proxy_client = self.PROXY_CLIENT(self._proxy_config.workspace,
+                                         self._proxy_config.window_size,
+                                         self._proxy_config.multiplex,
+                                         self._janitor)
         try:
-            conn = proxy_client.connect(self._config.proxy_address)
+            conn = proxy_client.connect(self._proxy_config.proxy_address)
         except BlockingOperation as ex:
             retrying = ex.retrying
-            interval = self._config.time_slice_interval
+            waiter = self._make_waiter(
+                proxy_client.watch_path(self._proxy_config.proxy_address))
             start_time = monotonic() * 1000
-            while True:
-                try:
-                    return retrying()
-                except EAgain:
-                    if monotonic() * 1000 - start_time > timeout_msec:
-                        raise TimeoutError()
-                    sleep(interval)
-                    continue
+            try:
+                while True:
+                    mark = waiter.mark()
+                    try:
+                        return retrying()
+                    except EAgain as ex:
+                        METRICS.inc('kamui_eagain_total', reason=str(ex))
+                        if monotonic() * 1000 - start_time > timeout_msec:
+                            raise TimeoutError()
+                        waiter.wait(mark)
+                        continue
+            finally:
+                waiter.close()
         else:
             return conn
 
+    def _proxy_open(self):
+        if not self._proxy_config.multiplex:
+            return self._proxy_connect()
+
+        session = self._mux_session
+        if session is None or session.closed:
+            conn = self._proxy_connect()
+            if not conn.multiplexed:
+                LOG.warning('the server proxy does not support multiplexing.')
+                return conn
+            session = MuxSession(conn, 'client',
+                                 partial(self._make_waiter, conn.watch_path()))
+            self._mux_session = session
+        return session.open_stream()
+
+    def _take_pooled(self):
+        # Returns (connection, data the peer sent already), or (None, b'').
+        # A pooled connection may be closed by the peer meanwhile,
+        # e.g. the target dropped an idle tcp connection.
+        while self._pool is not None:
+            conn = self._pool.take()
+            if conn is None:
+                break
+            try:
+                conn.recv(0)
+            except BlockingOperation as ex:
+                try:
+                    data = ex.retrying()
+                except EAgain:
+                    return conn, b''
+                except (BrokenPipeError, ConnectionError):
+                    data = b''
+                if data:
+                    return conn, data
+            LOG.debug('dropped a closed pooled proxy connection')
+            self._discard(conn)
+        return None, b''
+
+    def _discard(self, conn):
+        # Closes an unused connection in both directions, without
+        # holding up the caller.
+        def close():
+            waiter = self._make_waiter(conn.watch_path())
+            try:
+                run_blocking(waiter, conn.shutdown, SHUT_WR)
+                while run_blocking(waiter, conn.recv, 0):
+                    pass
+                run_blocking(waiter, conn.close)
+            except (BrokenPipeError, ConnectionError) as ex:
+                LOG.error('failed to close a pooled proxy connection: %s' % ex)
+            finally:
+                waiter.close()
+
+        thr = Thread(target=close)
+        thr.daemon = True
+        thr.start()
+
+    def _make_waiter(self, watch_path):
+        interval = self._proxy_config.time_slice_interval
+        if watch_path is None:
+            return PollingNotifier(self._proxy_config.max_poll_interval).waiter(
+                watch_path, interval)
+        return self._notifier.waiter(watch_path, interval)
+
     def run(self):
         LOG.info('--- client running ---')
-        LOG.info('config: ' + str(self._config))
-        self.PROXY_CLIENT.IO.set_iops(self._config.iops)
-
-        la = self._config.listen_address
-        pa = self._config.proxy_address
+        LOG.info('config: ' + str(self._proxy_config))
+        self.PROXY_CLIENT.IO.set_iops(self._proxy_config.iops)
+        self.PROXY_CLIENT.IO.set_weights(self._proxy_config.weights)
+        self.PROXY_CLIENT.IO.set_keep_files_open(self._proxy_config.keep_files_open)
+        _detect_format(self._proxy_config, self.PROXY_CLIENT.IO)
+        self._notifier = create_notifier(
+            self._proxy_config.notify, self._proxy_config.max_poll_interval,
+            self._proxy_config.time_slice_interval if self._proxy_config.sweep else None,
+            self.PROXY_CLIENT.IO.is_written_in_place, self.PROXY_CLIENT.IO.run_metered)
+        stop_stats = _start_metrics(self._proxy_config, 'client', self._proxy_config.metrics_port)
+        self._janitor = _start_janitor(self._proxy_config, self.PROXY_CLIENT.IO, 'client')
+        if self._proxy_config.trace_file:
+            start_chrome_trace(self._proxy_config.trace_file)
+
+        la = self._proxy_config.listen_address
+        pa = self._proxy_config.proxy_address
+
+        if self._proxy_config.pool_size > 0 and not self._proxy_config.multiplex:
+            self._pool = _ProxyConnectionPool(self._proxy_config.pool_size,
+                                              self.POOL_MAX_IDLE,
+                                              self._proxy_connect, self._discard)
 
         in_tcp = socket(AF_INET, SOCK_STREAM)
         in_tcp.bind(la)
         in_tcp.listen(128)
+        # exit through the finally clause, which removes the stats
+        signal(SIGTERM, _exit_on_signal)
         try:
             while True:
                 conn_tcp, addr_tcp = in_tcp.accept()
                 LOG.info('received a tcp connection on %s, forwarding to proxy %s' % (la, pa))
-                conn_proxy = self._proxy_connect()
+                conn_proxy, data = self._take_pooled()
+                if conn_proxy is None:
+                    conn_proxy = self._proxy_open()
+                elif data:
+                    # the target spoke first
+                    conn_tcp.sendall(data)
                 q_ = Queue(2)
-                c2s_thr = _SimplexChannelThread(q_, la, conn_tcp, pa, conn_proxy)
-                s2c_thr = _SimplexChannelThread(q_, pa, conn_proxy, la, conn_tcp)
+                c2s_thr = _SimplexChannelThread(q_, la, conn_tcp, pa, conn_proxy,
+                                                self._notifier,
+                                                self._proxy_config.max_segment_size,
+                                                self._proxy_config.flush_deadline)
+                s2c_thr = _SimplexChannelThread(q_, pa, conn_proxy, la, conn_tcp,
+                                                self._notifier)
                 c2s_thr.setDaemon(True)
                 s2c_thr.setDaemon(True)
                 c2s_thr.start()
                 s2c_thr.start()
         finally:
             in_tcp.close()
+            if stop_stats is not None:
+                stop_stats()
 
 
 class ServerWorkspaceProcess(Process):
 
     PROXY_SERVER = BaseServer
+    # max proxy connections accepted in one sweep, as the tcp listen() backlog
+    BACKLOG = 128
 
     @staticmethod
     def parse_config(dict_data):
+        fd = dict_data.get('flush_deadline', 0)
+        if fd < 0:
+            fd = 0
+        fd /= 1000  # ms -> s
+
         iops = dict_data.get('iops', 3)
 
+        kfo = bool(dict_data.get('keep_files_open', False))
+
+        # 0 means no leases
+        lt = dict_data.get('lease_timeout', 0)
+        if lt < 0:
+            lt = 0
+
         pa = dict_data.get('proxy_address')
         _check_proxy_address(pa)
 
         ta = dict_data.get('target_address')
         _check_tcp_address(ta)
 
+        mss = dict_data.get('max_segment_size', 4096)
+
+        mp = dict_data.get('metrics_port', 0)
+        if mp < 0:
+            mp = 0
+
+        si = dict_data.get('stats_interval', 0)
+        if si < 0:
+            si = 0
+
         ts = dict_data.get('time_slice_interval', 1)
         if ts < 1:
             ts = 1
         ts /= 1000  # ms -> s
 
+        # 0 means polling every time slice
+        mpi = dict_data.get('max_poll_interval', 0)
+        mpi /= 1000  # ms -> s
+        if mpi < ts:
+            mpi = ts
+
+        nt = bool(dict_data.get('notify', False))
+
+        tf = dict_data.get('trace_file') or None
+
+        sw = bool(dict_data.get('sweep', False))
+
+        wt = _check_weights(dict_data.get('weights', {}))
+
+        wnd = dict_data.get('window_size', 1)
+        if wnd < 1:
+            wnd = 1
+
+        wk = dict_data.get('workers', 1)
+        if wk < 1:
+            wk = 1
+
         ws = dict_data.get('workspace')
         if not ws:
             ws = './_workspace'
 
+        # 1 is the flat one of the old versions
+        wf = dict_data.get('workspace_format', 1)
+        _check_workspace_format(wf)
+
         return ServerWorkspaceConfig(
+            flush_deadline=fd,
             iops=iops,
+            keep_files_open=kfo,
+            lease_timeout=lt,
+            max_poll_interval=mpi,
+            max_segment_size=mss,
+            metrics_port=mp,
+            notify=nt,
             proxy_address=pa,
+            stats_interval=si,
+            sweep=sw,
             target_address=ta,
             time_slice_interval=ts,
-            workspace=realpath(ws)
+            trace_file=tf,
+            weights=wt,
+            window_size=wnd,
+            workers=wk,
+            workspace=realpath(ws),
+            workspace_format=wf
         )
 
     def __init__(self, server_proxy_config, *args, **kwargs):
         super(ServerWorkspaceProcess, self).__init__(*args, **kwargs)
-        self._config = self.parse_config(server_proxy_config)
+        self._proxy_config = self.parse_config(server_proxy_config)
+        self._notifier = None
 
-    def _proxy_accept(self, proxy_server):
-        interval = self._config.time_slice_interval
+    def _proxy_accept(self, proxy_server, waiter):
         while True:
+            mark = waiter.mark()
             try:
-                return proxy_server.accept()
-            except EAgain:
-                sleep(interval)
+                return proxy_server.accept_batch()
+            except EAgain as ex:
+                METRICS.inc('kamui_eagain_total', reason=str(ex))
+                waiter.wait(mark)
                 continue
 
+    def _make_waiter(self, watch_path):
+        interval = self._proxy_config.time_slice_interval
+        if watch_path is None:
+            return PollingNotifier(self._proxy_config.max_poll_interval).waiter(
+                watch_path, interval)
+        return self._notifier.waiter(watch_path, interval)
+
     def run(self):
         LOG.info('--- server running ---')
-        LOG.info('config: ' + str(self._config))
-        self.PROXY_SERVER.IO.set_iops(self._config.iops)
-
-        pa = self._config.proxy_address
-        ta = self._config.target_address
-
-        proxy_server = self.PROXY_SERVER(self._config.workspace)
-        proxy_server.listen(pa)
-
-        while True:
-            conn_proxy = self._proxy_accept(proxy_server)
-            LOG.info('received a proxy connection on %s, forwarding to tcp %s' % (pa, ta))
+        LOG.info('config: ' + str(self._proxy_config))
+        workers = self._proxy_config.workers
+        if workers == 1:
+            self._serve(0)
+            return
+
+        # Every worker accepts on the same proxy address, a request is
+        # claimed by one of them on the shared medium.
+        procs = [Process(target=self._serve, args=(index,)) for index in range(workers)]
+        for proc in procs:
+            proc.daemon = True
+            proc.start()
+        # The daemonic workers are only cleaned up on a normal exit,
+        # so a terminated master exits through the finally clause.
+        signal(SIGTERM, _exit_on_signal)
+        try:
+            for proc in procs:
+                proc.join()
+        finally:
+            for proc in procs:
+                if proc.is_alive():
+                    proc.terminate()
+            for proc in procs:
+                proc.join()
+
+    def _serve(self, shard_index):
+        workers = self._proxy_config.workers
+        # the workers share the IOPS budget
+        self.PROXY_SERVER.IO.set_iops(self._proxy_config.iops / workers)
+        self.PROXY_SERVER.IO.set_weights(self._proxy_config.weights)
+        self.PROXY_SERVER.IO.set_keep_files_open(self._proxy_config.keep_files_open)
+        _detect_format(self._proxy_config, self.PROXY_SERVER.IO)
+        self._notifier = create_notifier(
+            self._proxy_config.notify, self._proxy_config.max_poll_interval,
+            self._proxy_config.time_slice_interval if self._proxy_config.sweep else None,
+            self.PROXY_SERVER.IO.is_written_in_place, self.PROXY_SERVER.IO.run_metered)
+        # a forked worker starts from zero, and serves on its own port
+        METRICS.reset()
+        port = self._proxy_config.metrics_port
+        stop_stats = _start_metrics(self._proxy_config, 'server',
+                                    port + shard_index if port else 0)
+        trace_file = self._proxy_config.trace_file
+        if trace_file:
+            if workers > 1:
+                trace_file = '%s.%s' % (trace_file, shard_index)
+            start_chrome_trace(trace_file)
+
+        pa = self._proxy_config.proxy_address
+
+        janitor = _start_janitor(self._proxy_config, self.PROXY_SERVER.IO, 'server')
+        proxy_server = self.PROXY_SERVER(self._proxy_config.workspace,
+                                         self._proxy_config.window_size,
+                                         (shard_index, workers), janitor)
+        proxy_server.listen(pa, self.BACKLOG)
+        if janitor is not None:
+            janitor.scan(pa)
+        waiter = self._make_waiter(proxy_server.watch_path())
+
+        # A worker is terminated by SIGTERM, exit through the finally
+        # clause, which removes the stats.
+        signal(SIGTERM, _exit_on_signal)
+        try:
+            while True:
+                for conn_proxy in self._proxy_accept(proxy_server, waiter):
+                    if conn_proxy.multiplexed:
+                        LOG.info('received a multiplexed proxy connection on %s' % pa)
+                        MuxSession(conn_proxy, 'server',
+                                   partial(self._make_waiter, conn_proxy.watch_path()),
+                                   self._forward_async)
+                        continue
+                    self._forward(conn_proxy)
+        finally:
+            if stop_stats is not None:
+                stop_stats()
+
+    def _forward_async(self, conn_proxy):
+        # Connecting may take a while, don't hold up the mux session.
+        thr = Thread(target=self._forward, args=(conn_proxy,))
+        thr.daemon = True
+        thr.start()
+
+    def _forward(self, conn_proxy):
+        pa = self._proxy_config.proxy_address
+        ta = self._proxy_config.target_address
+        LOG.info('received a proxy connection on %s, forwarding to tcp %s' % (pa, ta))
+        try:
             conn_tcp = create_connection(ta)
-            q_ = Queue(2)
-            c2s_thr = _SimplexChannelThread(q_, pa, conn_proxy, ta, conn_tcp)
-            s2c_thr = _SimplexChannelThread(q_, ta, conn_tcp, pa, conn_proxy)
-            c2s_thr.setDaemon(True)
-            s2c_thr.setDaemon(True)
-            c2s_thr.start()
-            s2c_thr.start()
+        except OSError as ex:
+            LOG.error('failed to connect %s: %s' % (ta, ex))
+            run_blocking(self._make_waiter(None), conn_proxy.close)
+            return
+        q_ = Queue(2)
+        c2s_thr = _SimplexChannelThread(q_, pa, conn_proxy, ta, conn_tcp,
+                                        self._notifier)
+        s2c_thr = _SimplexChannelThread(q_, ta, conn_tcp, pa, conn_proxy,
+                                        self._notifier,
+                                        self._proxy_config.max_segment_size,
+                                        self._proxy_config.flush_deadline)
+        c2s_thr.setDaemon(True)
+        s2c_thr.setDaemon(True)
+        c2s_thr.start()
+        s2c_thr.start()
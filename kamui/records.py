@@ -0,0 +1,121 @@
+from struct import Struct
+from zlib import crc32
+
+
+class TornRecord(ValueError):
+    # A record which is not completely written (or got corrupted),
+    # the checksum of its header doesn't match.
+    pass
+
+
+_HEADER_CRC = Struct('>I')
+
+
+def _crc(data):
+    return crc32(data) & 0xffffffff
+
+
+# --- segment log frames ---
+#
+# A segment log is an append-only file, each record is a frame:
+#   +---------+------+--------+-----+----------+------------+---------+
+#   | version | kind | length | seq | checksum | header crc | payload |
+#   +---------+------+--------+-----+----------+------------+---------+
+#   1B        1B     4B       8B    4B         4B           $length B
+# the checksum is the crc32 of the payload, and the header crc is the
+# crc32 of the header fields before it.
+
+FRAME_VERSION = 1
+FRAME_HEADER = Struct('>BBIQII')
+_FRAME_FIELDS = Struct('>BBIQI')
+
+FRAME_DATA = 1
+FRAME_ROTATE = 2  # the rest of the stream is in the next log file
+FRAME_FIN = 3
+
+_FRAME_KINDS = (FRAME_DATA, FRAME_ROTATE, FRAME_FIN)
+
+
+def pack_frame_parts(kind, seq, payload=b''):
+    # Returns (header, payload), to be written one after the other
+    # without joining them into a copy.
+    assert kind in _FRAME_KINDS
+    fields = _FRAME_FIELDS.pack(FRAME_VERSION, kind, len(payload), seq, _crc(payload))
+    return fields + _HEADER_CRC.pack(_crc(fields)), payload
+
+
+def pack_frame(kind, seq, payload=b''):
+    return b''.join(pack_frame_parts(kind, seq, payload))
+
+
+def unpack_frame(buf, offset=0):
+    # Returns (kind, seq, payload, next_offset),
+    # or None if the frame at $offset is not completely written yet.
+    end = offset + FRAME_HEADER.size
+    if len(buf) < end:
+        return None
+    version, kind, length, seq, checksum, header_crc = FRAME_HEADER.unpack_from(buf, offset)
+    if _crc(buf[offset:offset + _FRAME_FIELDS.size]) != header_crc:
+        raise TornRecord('bad frame header checksum')
+    if version != FRAME_VERSION:
+        raise ValueError('unsupported frame version: %s' % version)
+    if kind not in _FRAME_KINDS:
+        raise ValueError('bad frame kind: %s' % kind)
+    if len(buf) < end + length:
+        return None
+    payload = buf[end:end + length]
+    if _crc(payload) != checksum:
+        raise TornRecord('bad frame checksum')
+    return kind, seq, payload, end + length
+
+
+# --- ctrl records ---
+#
+# A fixed-size binary form of the ctrl dicts:
+#   +-------+---------+-------+-----+---------+-----+------------+
+#   | magic | version | flags | seq | seq ack | log | header crc |
+#   +-------+---------+-------+-----+---------+-----+------------+
+#   2B      1B        1B      8B    8B        8B    4B
+
+CTRL_MAGIC = b'KC'
+CTRL_VERSION = 1
+CTRL_RECORD = Struct('>2sBBQQQI')
+_CTRL_FIELDS = Struct('>2sBBQQQ')
+
+_CTRL_FLAGS = (
+    ('F_SND',       0x01),
+    ('F_SND_ACK',   0x02),
+    ('F_FIN',       0x04),
+    ('F_FIN_ACK',   0x08),
+)
+
+
+def pack_ctrl(ctrl_data):
+    flags = 0
+    for name, bit in _CTRL_FLAGS:
+        if ctrl_data.get(name):
+            flags |= bit
+    fields = _CTRL_FIELDS.pack(
+        CTRL_MAGIC, CTRL_VERSION, flags,
+        max(ctrl_data.get('SEQ', 0), 0),
+        max(ctrl_data.get('SEQ_ACK', 0), 0),
+        max(ctrl_data.get('LOG', 0), 0))
+    return fields + _HEADER_CRC.pack(_crc(fields))
+
+
+def unpack_ctrl(raw):
+    if len(raw) != CTRL_RECORD.size:
+        raise TornRecord('bad ctrl record size: %s' % len(raw))
+    magic, version, flags, seq, seq_ack, log, header_crc = CTRL_RECORD.unpack(raw)
+    if _crc(raw[:_CTRL_FIELDS.size]) != header_crc:
+        raise TornRecord('bad ctrl record checksum')
+    if magic != CTRL_MAGIC or version != CTRL_VERSION:
+        raise ValueError('unsupported ctrl record: %r v%s' % (magic, version))
+    ctrl_data = {
+        'SEQ':      seq,
+        'SEQ_ACK':  seq_ack,
+        'LOG':      log,
+    }
+    for name, bit in _CTRL_FLAGS:
+        ctrl_data[name] = bool(flags & bit)
+    return ctrl_data
@@ -3,12 +3,27 @@ from getopt import getopt
 
 from kamui.base_stream import BaseClient
 from kamui.tcp_on_fs.io import FsTcpTunnelIO
+from kamui.tcp_on_fs.sim_io import (
+    parse_sim_profile,
+    SimulatedFsTcpTunnelIO,
+)
 from kamui.proxy_runner import ClientWorkspaceProcess
+from kamui.tcp_on_shm.client import ShmTcpTunnelClientWorkspaceProcess
 
 
+DEFAULT_FLUSH_DEADLINE = 10
 DEFAULT_IOPS = 10
+DEFAULT_LEASE_TIMEOUT = 60
+DEFAULT_MAX_POLL_INTERVAL = 100
+DEFAULT_MAX_SEGMENT_SIZE = 1024 * 1024
+DEFAULT_MEDIUM = 'fs'
+DEFAULT_METRICS_PORT = 0
+DEFAULT_POOL_SIZE = 0
+DEFAULT_STATS_INTERVAL = 0
 DEFAULT_TIME_SLICE_INTERVAL = 10
+DEFAULT_WINDOW_SIZE = 8
 DEFAULT_WORKSPACE = './_workspace'
+DEFAULT_WORKSPACE_FORMAT = 1
 
 
 class FsTcpTunnelClient(BaseClient):
@@ -19,15 +34,54 @@ class FsTcpTunnelClientWorkspaceProcess(ClientWorkspaceProcess):
     PROXY_CLIENT = FsTcpTunnelClient
 
 
+class SimulatedFsTcpTunnelClient(BaseClient):
+    IO = SimulatedFsTcpTunnelIO
+
+
+class SimulatedFsTcpTunnelClientWorkspaceProcess(ClientWorkspaceProcess):
+    PROXY_CLIENT = SimulatedFsTcpTunnelClient
+
+
+_PROCESS_TYPES = {
+    'fs':   FsTcpTunnelClientWorkspaceProcess,
+    'shm':  ShmTcpTunnelClientWorkspaceProcess,
+    'sim':  SimulatedFsTcpTunnelClientWorkspaceProcess,
+}
+
+
 def run(iops,
         listen_address, proxy_address,
-        time_slice_interval, workspace):
-    pr = FsTcpTunnelClientWorkspaceProcess({
+        time_slice_interval, workspace, notify=False, weights=None,
+        multiplex=False, max_segment_size=DEFAULT_MAX_SEGMENT_SIZE,
+        flush_deadline=DEFAULT_FLUSH_DEADLINE, medium=DEFAULT_MEDIUM,
+        pool_size=DEFAULT_POOL_SIZE, sim_profile=None,
+        metrics_port=DEFAULT_METRICS_PORT, stats_interval=DEFAULT_STATS_INTERVAL,
+        trace_file=None, max_poll_interval=DEFAULT_MAX_POLL_INTERVAL, sweep=False,
+        keep_files_open=False, lease_timeout=DEFAULT_LEASE_TIMEOUT,
+        workspace_format=DEFAULT_WORKSPACE_FORMAT, window_size=1):
+    if medium == 'sim':
+        SimulatedFsTcpTunnelIO.configure(**(sim_profile or {}))
+    pr = _PROCESS_TYPES[medium]({
+        'flush_deadline':           int(flush_deadline),
         'iops':                     int(iops),
+        'keep_files_open':          bool(keep_files_open),
+        'lease_timeout':            int(lease_timeout),
+        'max_poll_interval':        int(max_poll_interval),
+        'max_segment_size':         int(max_segment_size),
+        'metrics_port':             int(metrics_port),
+        'notify':                   bool(notify),
+        'pool_size':                int(pool_size),
         'listen_address':           tuple(listen_address),
+        'multiplex':                bool(multiplex),
         'proxy_address':            proxy_address,
+        'stats_interval':           int(stats_interval),
+        'sweep':                    bool(sweep),
         'time_slice_interval':      int(time_slice_interval),
+        'trace_file':               trace_file,
+        'weights':                  dict(weights or {}),
+        'window_size':              int(window_size),
         'workspace':                workspace,
+        'workspace_format':         int(workspace_format),
     })
     pr.run()
 
@@ -36,47 +90,129 @@ def usage():
     sys.stderr.writelines([
         'Usage: %s <ARGS> \n' % sys.argv[0],
         '  <ARGS> can be: \n',
+        '  --flush-deadline <NUMBER>        (OPTIONAL,DEFAULT=%s) max msecs to wait for more tcp data before sending a segment.\n' % DEFAULT_FLUSH_DEADLINE,
         '  --iops <NUMBER>                  (OPTIONAL,DEFAULT=%s) max iops for disk reading and writing.\n' % DEFAULT_IOPS,
+        '  --keep-files-open                (OPTIONAL) keep segment logs and acks open, posix only, not for NFS.\n',
+        '  --lease-timeout <NUMBER>         (OPTIONAL,DEFAULT=%s) secs until the connections and requests of a dead peer are reclaimed, 0 means off.\n' % DEFAULT_LEASE_TIMEOUT,
         '  --listen-address <IP>,<PORT>     local TCP address.\n',
+        '  --max-poll-interval <NUMBER>     (OPTIONAL,DEFAULT=%s) max msecs an idle connection backs off between polls, the max wake-up latency.\n' % DEFAULT_MAX_POLL_INTERVAL,
+        '  --max-segment-size <NUMBER>      (OPTIONAL,DEFAULT=%s) max bytes of one segment on the shared medium.\n' % DEFAULT_MAX_SEGMENT_SIZE,
+        '  --medium fs|shm|sim              (OPTIONAL,DEFAULT=%s) shm carries windowed segments in memory-mapped rings, both sides on the same host;\n' % DEFAULT_MEDIUM,
+        '                                   sim is fs with a simulated slow medium, see --sim-profile.\n',
+        '  --metrics-port <PORT>            (OPTIONAL,DEFAULT=%s) serve metrics in the Prometheus text format on 127.0.0.1, 0 means off.\n' % DEFAULT_METRICS_PORT,
+        '  --multiplex                      (OPTIONAL) carry all tcp connections over one shared proxy connection.\n',
+        '  --notify                         (OPTIONAL) wake up on inotify events, for a workspace on a local filesystem.\n',
+        '  --pool-size <NUMBER>             (OPTIONAL,DEFAULT=%s) proxy connections established ahead of tcp connections, 0 means none.\n' % DEFAULT_POOL_SIZE,
         '  --proxy-address <ADDR>           abstract proxy address. This should be the same at both proxy sides.\n',
+        '  --sim-profile <NAME>=<N>,...     (OPTIONAL) for --medium sim: latency, jitter, visibility in msecs, iops, torn in 0~1.\n',
+        '  --stats-interval <NUMBER>        (OPTIONAL,DEFAULT=%s) secs between writing stats to <workspace>/stats, removed on exit, 0 means off.\n' % DEFAULT_STATS_INTERVAL,
+        '  --sweep                          (OPTIONAL) without --notify, one thread stats the workspace for all connections instead of each polling.\n',
         '  --time-slice-interval <NUMBER>   (OPTIONAL,DEFAULT=%s) msecs between each process working frames.\n' % DEFAULT_TIME_SLICE_INTERVAL,
+        '  --trace-file <PATH>              (OPTIONAL) write a chrome://tracing timeline of IO operations and protocol stages.\n',
+        '  --weights <NAME>=<NUMBER>,...    (OPTIONAL) IOPS share of a proxy-address or of one connection (ADDR/CONN_NUM), default 1.\n',
+        '  --window-size <NUMBER>           (OPTIONAL,DEFAULT=%s) max in-flight segments per direction, 1 means stop-and-wait.\n' % DEFAULT_WINDOW_SIZE,
         '  --workspace <PATH>               (OPTIONAL,DEFAULT=%s) workspace dir. This should be the same at both proxy sides.\n' % DEFAULT_WORKSPACE,
+        '  --workspace-format <NUMBER>      (OPTIONAL,DEFAULT=%s) layout of a proxy-address new to the workspace, 1 is the flat one of old versions, 2 is sharded and needs both sides upgraded.\n' % DEFAULT_WORKSPACE_FORMAT,
         '\n',
         ])
 
 
 def parse_and_run():
     pairs, _ = getopt(sys.argv[1:], 'h', [
+        'flush-deadline=',
         'iops=',
+        'keep-files-open',
+        'lease-timeout=',
         'listen-address=',
+        'max-poll-interval=',
+        'max-segment-size=',
+        'medium=',
+        'metrics-port=',
+        'multiplex',
+        'notify',
+        'pool-size=',
         'proxy-address=',
+        'sim-profile=',
+        'stats-interval=',
+        'sweep',
         'time-slice-interval=',
+        'trace-file=',
+        'weights=',
+        'window-size=',
         'workspace=',
+        'workspace-format=',
         'help',
     ])
 
     la, pa, query = None, None, False
     iops, ti, ws = DEFAULT_IOPS, DEFAULT_TIME_SLICE_INTERVAL, DEFAULT_WORKSPACE
+    mss, fd, md = DEFAULT_MAX_SEGMENT_SIZE, DEFAULT_FLUSH_DEADLINE, DEFAULT_MEDIUM
+    wnd, nt, wt, mx = DEFAULT_WINDOW_SIZE, False, {}, False
+    ps, sp = DEFAULT_POOL_SIZE, {}
+    mp, si, tf = DEFAULT_METRICS_PORT, DEFAULT_STATS_INTERVAL, None
+    mpi, sw, kfo, lt = DEFAULT_MAX_POLL_INTERVAL, False, False, DEFAULT_LEASE_TIMEOUT
+    wf = DEFAULT_WORKSPACE_FORMAT
     for arg, value in pairs:
-        if '--iops' == arg:
+        if '--flush-deadline' == arg:
+            fd = int(value)
+        elif '--iops' == arg:
             iops = int(value)
+        elif '--keep-files-open' == arg:
+            kfo = True
+        elif '--lease-timeout' == arg:
+            lt = int(value)
         elif '--listen-address' == arg:
             la = value.split(',')
             la[1] = int(la[1])
+        elif '--multiplex' == arg:
+            mx = True
+        elif '--max-poll-interval' == arg:
+            mpi = int(value)
+        elif '--max-segment-size' == arg:
+            mss = int(value)
+        elif '--medium' == arg:
+            md = value
+        elif '--metrics-port' == arg:
+            mp = int(value)
+        elif '--notify' == arg:
+            nt = True
+        elif '--pool-size' == arg:
+            ps = int(value)
         elif '--proxy-address' == arg:
             pa = value
+        elif '--sim-profile' == arg:
+            sp = parse_sim_profile(value)
+        elif '--stats-interval' == arg:
+            si = int(value)
+        elif '--sweep' == arg:
+            sw = True
         elif '--time-slice-interval' == arg:
             ti = int(value)
+        elif '--trace-file' == arg:
+            tf = value
+        elif '--weights' == arg:
+            for pair in value.split(','):
+                name, weight = pair.rsplit('=', 1)
+                wt[name] = float(weight)
+        elif '--window-size' == arg:
+            wnd = int(value)
         elif '--workspace' == arg:
             ws = value
+        elif '--workspace-format' == arg:
+            wf = int(value)
         elif arg in ('-h', '--help'):
             query = True
 
-    if query or None in (la, pa):
+    if query or md not in _PROCESS_TYPES or None in (la, pa):
         usage()
         sys.exit(1)
 
-    run(iops, la, pa, ti, ws)
+    run(iops, la, pa, ti, ws,
+        notify=nt, weights=wt, multiplex=mx, max_segment_size=mss,
+        flush_deadline=fd, medium=md, pool_size=ps, sim_profile=sp,
+        metrics_port=mp, stats_interval=si, trace_file=tf,
+        max_poll_interval=mpi, sweep=sw, keep_files_open=kfo,
+        lease_timeout=lt, workspace_format=wf, window_size=wnd)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,135 @@
+import sys
+from getopt import getopt
+from os import (
+    getpid,
+    listdir,
+    remove as remove_file,
+    stat,
+    walk,
+)
+from os.path import (
+    isdir,
+    join as path_join,
+)
+from shutil import rmtree
+
+from kamui.logging import get_logger
+from kamui.tcp_on_fs.io import _ConnectionIO
+
+
+LOG = get_logger(__name__)
+
+
+DEFAULT_LEASE_TIMEOUT = 60
+DEFAULT_WORKSPACE = './_workspace'
+
+
+def medium_time(workspace):
+    # The mtimes are compared with the clock of the medium,
+    # which may not be the one of this host.
+    probe = path_join(workspace, '.compact.%s.probe' % getpid())
+    with open(probe, 'w'):
+        pass
+    try:
+        return stat(probe).st_mtime
+    finally:
+        remove_file(probe)
+
+
+def recent_paths(workspace, since):
+    # The leases and zones modified after $since, by a proxy still running.
+    paths = []
+    for top in ('addresses', 'leases'):
+        for root, dirs, files in walk(path_join(workspace, top)):
+            for name in dirs + files:
+                path = path_join(root, name)
+                try:
+                    if stat(path).st_mtime > since:
+                        paths.append(path)
+                except FileNotFoundError:
+                    pass
+    return paths
+
+
+def dead_zones(workspace):
+    # Returns (connection dirs, request files, lease files), of either
+    # workspace format. The shard dirs and the formats are kept.
+    conns, requests, leases = [], [], []
+    addresses_dir = path_join(workspace, 'addresses')
+    for address in (listdir(addresses_dir) if isdir(addresses_dir) else []):
+        for root, dirs, _ in walk(path_join(addresses_dir, address, 'connections')):
+            found = [name for name in dirs if _ConnectionIO.conn_id_of(name) is not None]
+            conns.extend(path_join(root, name) for name in found)
+            dirs[:] = [name for name in dirs if name not in found]
+        for root, _, files in walk(path_join(addresses_dir, address, 'requests')):
+            # the requests, the claims and the temp files of the writes
+            requests.extend(path_join(root, name) for name in files)
+    leases_dir = path_join(workspace, 'leases')
+    if isdir(leases_dir):
+        leases.extend(path_join(leases_dir, name) for name in listdir(leases_dir))
+    return conns, requests, leases
+
+
+def compact(workspace, lease_timeout, dry_run=False):
+    # Deletes every connection, request and lease of a workspace
+    # which no proxy is using. Returns False if some proxy seems to be.
+    recent = recent_paths(workspace, medium_time(workspace) - lease_timeout)
+    if recent:
+        LOG.error('the workspace is in use, e.g. %s' % recent[0])
+        return False
+
+    conns, requests, leases = dead_zones(workspace)
+    LOG.info('%s %s connections, %s requests, %s leases' % (
+        'found' if dry_run else 'deleting', len(conns), len(requests), len(leases)))
+    if dry_run:
+        return True
+    for path in conns:
+        rmtree(path, ignore_errors=True)
+    for path in requests + leases:
+        try:
+            remove_file(path)
+        except FileNotFoundError:
+            pass
+    return True
+
+
+def usage():
+    sys.stderr.writelines([
+        'Usage: %s <ARGS> \n' % sys.argv[0],
+        '  <ARGS> can be: \n',
+        '  --dry-run                        (OPTIONAL) only count what would be deleted.\n',
+        '  --lease-timeout <NUMBER>         (OPTIONAL,DEFAULT=%s) secs since the last change for the workspace to be taken as offline.\n' % DEFAULT_LEASE_TIMEOUT,
+        '  --workspace <PATH>               (OPTIONAL,DEFAULT=%s) workspace dir, with no proxy using it.\n' % DEFAULT_WORKSPACE,
+        '\n',
+        ])
+
+
+def parse_and_run():
+    pairs, _ = getopt(sys.argv[1:], 'h', [
+        'dry-run',
+        'lease-timeout=',
+        'workspace=',
+        'help',
+    ])
+
+    dr, lt, ws, query = False, DEFAULT_LEASE_TIMEOUT, DEFAULT_WORKSPACE, False
+    for arg, value in pairs:
+        if '--dry-run' == arg:
+            dr = True
+        elif '--lease-timeout' == arg:
+            lt = int(value)
+        elif '--workspace' == arg:
+            ws = value
+        elif arg in ('-h', '--help'):
+            query = True
+
+    if query or not isdir(ws):
+        usage()
+        sys.exit(1)
+
+    if not compact(ws, lt, dr):
+        sys.exit(2)
+
+
+if __name__ == '__main__':
+    parse_and_run()
@@ -1,55 +1,356 @@
 import json
+import mmap
+import os
 from os import (
+    fstat,
+    getpid,
     listdir,
     makedirs,
+    O_APPEND,
+    O_CREAT,
+    O_RDONLY,
+    O_WRONLY,
     remove as remove_file,
+    replace as replace_file,
+    rmdir,
+    stat,
 )
 from os.path import (
+    basename,
+    dirname,
     isdir,
     isfile,
     join as path_join,
 )
-from threading import Semaphore
-from shutil import rmtree
-from time import (
-    monotonic,
-    sleep as os_sleep,
+from threading import (
+    get_ident,
+    Lock,
 )
+from time import monotonic
+from shutil import rmtree
 
 from kamui.base_stream import (
     BaseIO,
     EAgain,
     id_head,
+    id_join,
     id_segments,
     id_split,
     is_request_token,
+    make_conn_id,
+    split_conn_id,
     ID_SERVER_LISTEN_BACKLOG,
     ID_CONNECTION,
     ID_CONN_C2S_CTRL,
     ID_CONN_C2S_DATA,
     ID_CONN_S2C_CTRL,
     ID_CONN_S2C_DATA,
+    ID_CONN_C2S_ACK,
+    ID_CONN_S2C_ACK,
+    ID_CONN_C2S_LOG,
+    ID_CONN_S2C_LOG,
+    ID_CONN_LEASE,
+    ID_LEASE,
+)
+from kamui.io_dispatcher import IODispatcher
+from kamui.metrics import METRICS
+from kamui.records import (
+    CTRL_RECORD,
+    pack_ctrl,
+    unpack_ctrl,
+    TornRecord,
 )
+from kamui.tracing import TRACING
+
+
+O_BINARY = getattr(os, 'O_BINARY', 0)  # windows only
+
+_known_dirs = set()  # dirs created or seen by this process
+# the dirs deleted by a peer stay known, start over beyond this
+MAX_KNOWN_DIRS = 4096
+
+
+def ensure_dir(t_dir):
+    # The medium is asked only until the dir is known to exist.
+    if t_dir in _known_dirs:
+        return
+    makedirs(t_dir, exist_ok=True)
+    if len(_known_dirs) >= MAX_KNOWN_DIRS:
+        _known_dirs.clear()
+    _known_dirs.add(t_dir)
+
+
+def forget_dir(t_dir):
+    # e.g. the dir is deleted, or found missing behind our back
+    prefix = t_dir + os.sep
+    for known_dir in list(_known_dirs):
+        if known_dir == t_dir or known_dir.startswith(prefix):
+            _known_dirs.discard(known_dir)
+
+
+def in_dir(t_dir, func, *args):
+    # Runs an operation which may create a file in $t_dir.
+    ensure_dir(t_dir)
+    try:
+        return func(*args)
+    except FileNotFoundError:
+        # removed behind our back, it's created again next time
+        forget_dir(t_dir)
+        raise
+
+
+def list_dir(t_dir):
+    # [] if the dir is gone
+    try:
+        return listdir(t_dir)
+    except (FileNotFoundError, NotADirectoryError):
+        return []
+
+
+def write_file(t_file, content):
+    # Readers never see a partial file: the content goes to a temp file
+    # beside the target first, then it's renamed over the target.
+    # The temp name doesn't look like a request token.
+    tmp_file = path_join(dirname(t_file), '.%s.%s.%s.tmp' % (
+        basename(t_file), getpid(), get_ident()))
+    mode = 'wb' if isinstance(content, bytes) else 'w'
+    try:
+        with open(tmp_file, mode) as fd:
+            fd.write(content)
+        replace_file(tmp_file, t_file)
+    except OSError:
+        if isfile(tmp_file):
+            remove_file(tmp_file)
+        raise
+
+
+def open_file(t_file, flags):
+    return os.open(t_file, flags | O_BINARY, 0o666)
+
+
+def pread_fd(fd, size, offset):
+    if hasattr(os, 'pread'):
+        return os.pread(fd, size, offset)
+    os.lseek(fd, offset, os.SEEK_SET)
+    return os.read(fd, size)
+
+
+def append_fd(fd, content):
+    # $content is bytes, or a tuple of buffers which are gathered in one
+    # write instead of being joined first. $fd is opened with O_APPEND.
+    if isinstance(content, (bytes, bytearray, memoryview)):
+        content = (content,)
+    total = sum(len(part) for part in content)
+    written = os.writev(fd, content) if hasattr(os, 'writev') else 0
+    if written < total:
+        rest = memoryview(b''.join(content))[written:]
+        while rest:
+            rest = rest[os.write(fd, rest):]
+
+
+def append_file(t_file, content):
+    fd = open_file(t_file, O_WRONLY | O_APPEND | O_CREAT)
+    try:
+        append_fd(fd, content)
+    finally:
+        os.close(fd)
+
+
+def overwrite_fd(fd, content):
+    # For the records of a fixed size, a reader may see a torn one,
+    # which fails its checksum, but never a missing file.
+    if hasattr(os, 'pwrite'):
+        os.pwrite(fd, content, 0)
+    else:
+        os.lseek(fd, 0, os.SEEK_SET)
+        os.write(fd, content)
+
+
+def overwrite_file(t_file, content):
+    fd = open_file(t_file, O_WRONLY | O_CREAT)
+    try:
+        overwrite_fd(fd, content)
+    finally:
+        os.close(fd)
+
+
+def read_fd_at(fd, offset, mmap_min_bytes):
+    # A large read maps the file instead of copying it, the checksums
+    # and the socket take the data from the page cache directly.
+    size = fstat(fd).st_size
+    if size <= offset:
+        return b''
+    if mmap_min_bytes is None or size - offset < mmap_min_bytes:
+        return pread_fd(fd, size - offset, offset)
+    start = offset - offset % mmap.ALLOCATIONGRANULARITY
+    mapped = mmap.mmap(fd, size - start, offset=start, access=mmap.ACCESS_READ)
+    return memoryview(mapped)[offset - start:]
+
+
+def read_file_at(t_file, offset, mmap_min_bytes):
+    # Returns the content from $offset, None if the file doesn't exist.
+    try:
+        fd = open_file(t_file, O_RDONLY)
+    except FileNotFoundError:
+        return None
+    try:
+        return read_fd_at(fd, offset, mmap_min_bytes)
+    finally:
+        os.close(fd)
+
+
+def create_file(t_file, content):
+    # Creates an initial file, but never overwrites one
+    # which is written by the peer at the same time.
+    mode = 'xb' if isinstance(content, bytes) else 'x'
+    try:
+        with open(t_file, mode) as fd:
+            fd.write(content)
+    except FileExistsError:
+        pass
+
+
+def load_json(t_file):
+    try:
+        with open(t_file, 'r') as fd:
+            return json.load(fd)
+    except ValueError:
+        raise EAgain('someone may be writing this zone.')
+
+
+def load_bytes(t_file):
+    with open(t_file, 'rb') as fd:
+        return fd.read()
+
+
+def load_or_create(t_file, load, initial, create):
+    # The file is opened at once, and only created if it's missing.
+    try:
+        return load(t_file)
+    except FileNotFoundError:
+        if not create:
+            return None
+    except OSError:
+        return None
+    in_dir(dirname(t_file), create_file, t_file, initial)
+    try:
+        return load(t_file)
+    except OSError:
+        return None
+
+
+def is_ack_zone(zone_id):
+    return ID_CONN_C2S_ACK in zone_id or ID_CONN_S2C_ACK in zone_id
+
+
+def is_data_zone(zone_id):
+    for data_id in (ID_CONN_C2S_DATA, ID_CONN_S2C_DATA, ID_CONN_C2S_LOG, ID_CONN_S2C_LOG):
+        if data_id in zone_id:
+            return True
+    return False
+
+
+class _AddressFormat(object):
+    # The layout of an address in the workspace:
+    #   1: flat, every request in requests/ and every connection in
+    #      connections/, as the versions before the formats have it.
+    #   2: sharded by hash, requests/a/req-...a and
+    #      connections/1/0/00001, so no dir grows with the connection
+    #      count. A change in a big dir makes every lookup in it go to
+    #      the server again on NFS, and takes the lock of the dir.
+    # The first proxy using the address fixes its format, which is kept
+    # in addresses/foo.com/format for the others.
+
+    FORMATS = (1, 2)
+    REQUEST_SHARDS = 16  # by the last digit of the token
+    CONNECTION_SHARDS = 16  # on each of the 2 levels, by the conn number
+
+    # for the new addresses, see set_workspace_format()
+    NEW_FORMAT = 1
+
+    _formats = dict()  # (workspace, address) -> format
+
+    @staticmethod
+    def target_file(workspace, address):
+        # e.g.
+        # path= $WORKSPACE/addresses/foo.com/format
+        return path_join(workspace, 'addresses', address, 'format')
+
+    @classmethod
+    def detect(cls, workspace, address):
+        fmt = cls._formats.get((workspace, address))
+        if fmt is not None:
+            return fmt
+
+        t_file = cls.target_file(workspace, address)
+        try:
+            data = load_json(t_file)
+        except FileNotFoundError:
+            a_dir = dirname(t_file)
+            fmt = cls.NEW_FORMAT
+            if isdir(path_join(a_dir, 'requests')) or isdir(path_join(a_dir, 'connections')):
+                # in use by the versions before the formats
+                fmt = 1
+            # whoever creates it first wins
+            in_dir(a_dir, create_file, t_file, json.dumps({'VERSION': fmt}))
+            data = load_json(t_file)
+
+        fmt = data.get('VERSION')
+        if fmt not in cls.FORMATS:
+            raise ValueError('Unknown workspace format of %s: %s' % (address, fmt))
+        cls._formats[(workspace, address)] = fmt
+        return fmt
+
+    @classmethod
+    def is_sharded(cls, workspace, address):
+        return cls.detect(workspace, address) > 1
 
 
 class _ServerListenBacklogIO(object):
 
+    # A listing is reused while the mtime of the dir stays the same.
+    # Changes within the mtime granularity of the medium can't be told
+    # apart, so a listing only counts if the mtime was seen unchanged
+    # for $RACY secs before it. The mtime is only compared with itself,
+    # the clock of the medium may not be the one of this host. A listing
+    # older than $MAX_AGE secs is never reused.
+    RACY = 2
+    MAX_AGE = 10
+
+    # dir -> (mtime_ns, seen since, listed at, request tokens)
+    _listings = dict()
+
     @staticmethod
     def target_dir(workspace, zone_id):
         # e.g.
         # id= $ID_SERVER_LISTEN_BACKLOG/foo.com
         # path= $WORKSPACE/addresses/foo.com/requests/
-        address = id_split(zone_id)[1]
-        return path_join(workspace, 'addresses', address, 'requests')
+        # id= $ID_SERVER_LISTEN_BACKLOG/foo.com/req-0123456789abcdef, sharded
+        # path= $WORKSPACE/addresses/foo.com/requests/f/
+        segments = id_split(zone_id)
+        requests_dir = path_join(workspace, 'addresses', segments[1], 'requests')
+        if len(segments) == 2 or not _AddressFormat.is_sharded(workspace, segments[1]):
+            return requests_dir
+        # a claim goes along with its request
+        return path_join(requests_dir, segments[2][-1])
 
-    @staticmethod
-    def target_request_file(workspace, zone_id):
+    @classmethod
+    def target_request_file(cls, workspace, zone_id):
         # e.g.
-        # id= $ID_SERVER_LISTEN_BACKLOG/foo.com/0123456789abcdef
-        # path= $WORKSPACE/addresses/foo.com/requests/0123456789abcdef
-        address = id_split(zone_id)[1]
-        token = id_split(zone_id)[2]
-        return path_join(workspace, 'addresses', address, 'requests', token)
+        # id= $ID_SERVER_LISTEN_BACKLOG/foo.com/req-0123456789abcdef
+        # path= $WORKSPACE/addresses/foo.com/requests/req-0123456789abcdef
+        return path_join(cls.target_dir(workspace, zone_id), id_split(zone_id)[2])
+
+    @classmethod
+    def shard_dirs(cls, workspace, zone_id):
+        # e.g.
+        # id= $ID_SERVER_LISTEN_BACKLOG/foo.com, sharded
+        # paths= $WORKSPACE/addresses/foo.com/requests/0/ ... /f/
+        requests_dir = cls.target_dir(workspace, zone_id)
+        if not _AddressFormat.is_sharded(workspace, id_split(zone_id)[1]):
+            return [requests_dir]
+        return [path_join(requests_dir, '%x' % shard)
+                for shard in range(_AddressFormat.REQUEST_SHARDS)]
 
     @staticmethod
     def is_list(zone_id):
@@ -59,154 +360,291 @@ class _ServerListenBacklogIO(object):
     def delete(cls, workspace, zone_id):
         if cls.is_list(zone_id):
             t_dir = cls.target_dir(workspace, zone_id)
+            forget_dir(t_dir)
             if isdir(t_dir):
                 rmtree(t_dir)
         else:
             t_file = cls.target_request_file(workspace, zone_id)
-            if isfile(t_file):
+            try:
                 remove_file(t_file)
+            except FileNotFoundError:
+                pass
+
+    @classmethod
+    def list_requests(cls, t_dir):
+        mtime = stat(t_dir).st_mtime_ns
+        now = monotonic()
+        listing = cls._listings.get(t_dir)
+        seen_since = now
+        if listing is not None and listing[0] == mtime:
+            seen_since = listing[1]
+            if listing[2] - seen_since > cls.RACY and now - listing[2] < cls.MAX_AGE:
+                return list(listing[3])
+
+        items = [item for item in listdir(t_dir) if is_request_token(item)]
+        cls._listings[t_dir] = (mtime, seen_since, now, items)
+        return list(items)
 
     def __init__(self, workspace, zone_id):
         self._workspace = workspace
         self._zone_id = zone_id
         self._is_list = self.is_list(zone_id)
+        # the paths don't change, build them once
+        self._dir = self.target_dir(workspace, zone_id)
+        self._dirs = None
+        self._file = None
+        if self._is_list:
+            self._dirs = self.shard_dirs(workspace, zone_id)
+        else:
+            self._file = self.target_request_file(workspace, zone_id)
 
-    def write(self, data):
-        t_dir = self.target_dir(self._workspace, self._zone_id)
-        if not isdir(t_dir):
-            makedirs(t_dir)
+    def _claim(self):
+        try:
+            with open(self._file, 'x'):
+                return True
+        except FileExistsError:
+            return False
 
+    def write(self, data):
         assert not self._is_list
+        in_dir(self._dir, write_file, self._file, json.dumps(data))
 
-        t_file = self.target_request_file(self._workspace, self._zone_id)
-        with open(t_file, 'w') as fd:
-            content = json.dumps(data)
-            fd.write(content)
+    def claim(self):
+        assert not self._is_list
+        return in_dir(self._dir, self._claim)
 
     def read(self, create):
-        t_dir = self.target_dir(self._workspace, self._zone_id)
-        if not isdir(t_dir) and create:
-            makedirs(t_dir)
-
         if self._is_list:
-            items = listdir(t_dir)
-            items = [item for item in items if is_request_token(item)]
+            items = []
+            for t_dir in self._dirs:
+                if create:
+                    ensure_dir(t_dir)
+                try:
+                    items.extend(self.list_requests(t_dir))
+                except FileNotFoundError:
+                    forget_dir(t_dir)
+                    raise
             return {
                 'PENDING':          len(items),
                 'REQUEST_TOKENS':   items,
             }
 
         # --- is not list ---
-        t_file = self.target_request_file(self._workspace, self._zone_id)
-        if not isfile(t_file) and create:
-            with open(t_file, 'w') as fd:
-                fd.write('{}')
-        try:
-            with open(t_file, 'r') as fd:
-                return json.load(fd)
-        except OSError:
-            return None
-        except ValueError:
-            raise EAgain('someone may be writing this zone.')
+        return load_or_create(self._file, load_json, '{}', create)
+
+    def close(self):
+        pass
 
 
 class _ConnectionIO(object):
 
+    # Reads of segment logs from this size on are mapped, not copied.
+    # A mapped file can't be deleted on windows, so it's posix only.
+    MMAP_MIN_BYTES = 256 * 1024 if os.name == 'posix' else None
+
+    # With it, a segment log or an ack is opened once for the life of
+    # the IO object, then read and written by position. NFS only shows
+    # the writes of another host to an open() after they are close()'d,
+    # so it's for a local or tmpfs workspace. See set_keep_files_open().
+    KEEP_FILES_OPEN = False
+
     FILENAME_MAP = {
         ID_CONN_C2S_CTRL:   'c2s_ctrl',
         ID_CONN_C2S_DATA:   'c2s_data',
         ID_CONN_S2C_CTRL:   's2c_ctrl',
         ID_CONN_S2C_DATA:   's2c_data',
+        ID_CONN_C2S_ACK:    'c2s_ack',
+        ID_CONN_S2C_ACK:    's2c_ack',
+        ID_CONN_C2S_LOG:    'c2s_log',
+        ID_CONN_S2C_LOG:    's2c_log',
+        ID_CONN_LEASE:      'lease',
     }
 
     @staticmethod
-    def target_dir(workspace, zone_id):
+    def conn_dir_name(conn_id):
+        # e.g.
+        # conn_id= 1, name= 00001
+        # conn_id= 1-3, name= 00001-3
+        # conn_id= 123456, name= 123456
+        conn_num, conn_gen = split_conn_id(conn_id)
+        if not conn_gen:
+            return '%05d' % conn_num
+        return '%05d-%d' % (conn_num, conn_gen)
+
+    @staticmethod
+    def conn_id_of(dir_name):
+        # the reverse of conn_dir_name(), None if it's not a connection,
+        # e.g. a shard dir
+        conn_num, _, conn_gen = dir_name.partition('-')
+        if len(conn_num) < 5 or not conn_num.isdigit() or \
+                not (conn_gen.isdigit() or not conn_gen):
+            return None
+        return make_conn_id(int(conn_num), int(conn_gen or 0))
+
+    @staticmethod
+    def is_list(zone_id):
+        return id_segments(zone_id) == 2
+
+    @classmethod
+    def target_dir(cls, workspace, zone_id):
         # e.g.
         # id= $ID_CONNECTION/foo.com/1/$ID_CONN_C2S_CTRL
         # path= $WORKSPACE/addresses/foo.com/connections/00001/
+        # id= $ID_CONNECTION/foo.com/33/$ID_CONN_C2S_CTRL, sharded
+        # path= $WORKSPACE/addresses/foo.com/connections/1/2/00033/
+        # id= $ID_CONNECTION/foo.com
+        # path= $WORKSPACE/addresses/foo.com/connections/
         address = id_split(zone_id)[1]
-        conn_num = '%05d' % int(id_split(zone_id)[2])
-        return path_join(workspace, 'addresses', address, 'connections', conn_num)
+        conns_dir = path_join(workspace, 'addresses', address, 'connections')
+        if cls.is_list(zone_id):
+            return conns_dir
+        conn_id = id_split(zone_id)[2]
+        if _AddressFormat.is_sharded(workspace, address):
+            # the numbers are taken in order, their low digits spread evenly
+            shards = _AddressFormat.CONNECTION_SHARDS
+            conn_num = split_conn_id(conn_id)[0]
+            conns_dir = path_join(conns_dir, '%x' % (conn_num % shards),
+                                  '%x' % (conn_num // shards % shards))
+        return path_join(conns_dir, cls.conn_dir_name(conn_id))
 
     @classmethod
     def target_file(cls, workspace, zone_id):
         # e.g.
         # id= $ID_CONNECTION/foo.com/1/$ID_CONN_C2S_CTRL
         # path= $WORKSPACE/addresses/foo.com/connections/00001/c2s_ctrl
-        address = id_split(zone_id)[1]
-        conn_num = '%05d' % int(id_split(zone_id)[2])
+        # id= $ID_CONNECTION/foo.com/1/$ID_CONN_C2S_LOG/3
+        # path= $WORKSPACE/addresses/foo.com/connections/00001/c2s_log.3
         suffix = cls.FILENAME_MAP[id_split(zone_id)[3]]
-        return path_join(workspace, 'addresses', address, 'connections', conn_num, suffix)
+        if id_segments(zone_id) > 4:
+            suffix += '.' + id_split(zone_id)[4]
+        return path_join(cls.target_dir(workspace, zone_id), suffix)
 
     @classmethod
     def delete(cls, workspace, zone_id):
-        t_file = cls.target_file(workspace, zone_id)
-        if isfile(t_file):
-            remove_file(t_file)
+        if id_segments(zone_id) == 3:
+            # e.g. id= $ID_CONNECTION/foo.com/1, everything of it
+            t_dir = cls.target_dir(workspace, zone_id)
+            forget_dir(t_dir)
+            if isdir(t_dir):
+                rmtree(t_dir)
+            return
+        try:
+            remove_file(cls.target_file(workspace, zone_id))
+        except FileNotFoundError:
+            pass
+
+    @classmethod
+    def prune(cls, workspace, zone_id):
+        # e.g. id= $ID_CONNECTION/foo.com/1
+        assert id_segments(zone_id) == 3
+        t_dir = cls.target_dir(workspace, zone_id)
+        # this side is done with it, whoever deletes it
+        forget_dir(t_dir)
+        lease_file = cls.FILENAME_MAP[ID_CONN_LEASE]
+        try:
+            if any(name != lease_file for name in listdir(t_dir)):
+                # the peer is not done yet
+                return
+        except FileNotFoundError:
+            return
+        try:
+            try:
+                remove_file(path_join(t_dir, lease_file))
+            except FileNotFoundError:
+                # written by the servers with leases only
+                pass
+            rmdir(t_dir)
+        except OSError:
+            # e.g. the peer did it first
+            pass
 
     def __init__(self, workspace, zone_id):
         self._workspace = workspace
         self._zone_id = zone_id
-        if ID_CONN_C2S_DATA in zone_id or ID_CONN_S2C_DATA in zone_id:
-            self._bin_data = True
-        else:
-            self._bin_data = False
+        self._bin_data = is_data_zone(zone_id)
+        # Ack zones are only used by the windowed protocol, both peers
+        # understand the binary ctrl records there. The others stay in
+        # json for the old peers.
+        self._bin_ctrl = is_ack_zone(zone_id)
+        self._is_list = self.is_list(zone_id)
+        # the paths don't change, build them once
+        self._dir = self.target_dir(workspace, zone_id)
+        self._file = None
+        if id_segments(zone_id) > 3:
+            self._file = self.target_file(workspace, zone_id)
+        self._fd = None  # kept open, see KEEP_FILES_OPEN
+
+    def _kept_fd(self, flags):
+        # Returns the fd kept open for the segment log or the ack,
+        # None if the files are opened on every operation.
+        if not self.KEEP_FILES_OPEN:
+            return None
+        if self._fd is not None and fstat(self._fd).st_nlink == 0:
+            # deleted, or replaced by a rename of an old peer
+            self.close()
+        if self._fd is None:
+            self._fd = open_file(self._file, flags)
+        return self._fd
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
 
     def write_ctrl(self, data):
-        t_dir = self.target_dir(self._workspace, self._zone_id)
-        if not isdir(t_dir):
-            makedirs(t_dir)
-
-        t_file = self.target_file(self._workspace, self._zone_id)
-        with open(t_file, 'w') as fd:
-            content = json.dumps(data)
-            fd.write(content)
-
-    def read_ctrl(self, create):
-        t_dir = self.target_dir(self._workspace, self._zone_id)
-        if not isdir(t_dir) and create:
-            makedirs(t_dir)
-
-        t_file = self.target_file(self._workspace, self._zone_id)
-        if not isfile(t_file) and create:
-            with open(t_file, 'w') as fd:
-                fd.write('{}')
-
+        if not self._bin_ctrl:
+            return in_dir(self._dir, write_file, self._file, json.dumps(data))
+        # The records have a fixed size, so they are written in place.
+        raw = pack_ctrl(data)
+        fd = in_dir(self._dir, self._kept_fd, O_WRONLY | O_CREAT)
+        if fd is None:
+            return in_dir(self._dir, overwrite_file, self._file, raw)
+        overwrite_fd(fd, raw)
+
+    def read_bin_ctrl(self):
         try:
-            with open(t_file, 'r') as fd:
-                return json.load(fd)
-        except OSError:
+            fd = self._kept_fd(O_RDONLY)
+            if fd is not None:
+                raw = pread_fd(fd, CTRL_RECORD.size, 0)
+            else:
+                with open(self._file, 'rb') as f:
+                    raw = f.read()
+        except FileNotFoundError:
             return None
-        except ValueError:
+        if not raw:
+            # created by the writer, not written yet
+            return None
+        try:
+            return unpack_ctrl(raw)
+        except TornRecord:
             raise EAgain('someone may be writing this zone.')
 
+    def read_ctrl(self, create):
+        return load_or_create(self._file, load_json, '{}', create)
+
     def write_data(self, data):
         assert isinstance(data, bytes)
-        t_dir = self.target_dir(self._workspace, self._zone_id)
-        if not isdir(t_dir):
-            makedirs(t_dir)
-
-        t_file = self.target_file(self._workspace, self._zone_id)
-        with open(t_file, 'wb') as fd:
-            fd.write(data)
+        in_dir(self._dir, write_file, self._file, data)
 
     def read_data(self, create):
-        t_dir = self.target_dir(self._workspace, self._zone_id)
-        if not isdir(t_dir) and create:
-            makedirs(t_dir)
+        return load_or_create(self._file, load_bytes, b'', create)
 
-        t_file = self.target_file(self._workspace, self._zone_id)
-        if not isfile(t_file) and create:
-            with open(t_file, 'wb') as fd:
-                fd.write(b'')
+    def append(self, data):
+        assert self._bin_data
+        fd = in_dir(self._dir, self._kept_fd, O_WRONLY | O_APPEND | O_CREAT)
+        if fd is None:
+            return in_dir(self._dir, append_file, self._file, data)
+        append_fd(fd, data)
 
+    def read_at(self, offset):
+        assert self._bin_data
         try:
-            with open(t_file, 'rb') as fd:
-                return fd.read()
-        except OSError:
+            fd = self._kept_fd(O_RDONLY)
+        except FileNotFoundError:
             return None
-        except ValueError:
-            raise EAgain('someone may be writing this zone.')
+        if fd is None:
+            return read_file_at(self._file, offset, self.MMAP_MIN_BYTES)
+        return read_fd_at(fd, offset, self.MMAP_MIN_BYTES)
 
     def write(self, data):
         if self._bin_data:
@@ -214,27 +652,137 @@ class _ConnectionIO(object):
         else:
             return self.write_ctrl(data)
 
+    def read_list(self):
+        dirs = [self._dir]
+        if _AddressFormat.is_sharded(self._workspace, id_split(self._zone_id)[1]):
+            for _ in range(2):
+                dirs = [path_join(t_dir, name) for t_dir in dirs for name in list_dir(t_dir)]
+        conn_ids = [self.conn_id_of(name) for t_dir in dirs for name in list_dir(t_dir)]
+        return {
+            'CONNECTIONS':  [conn_id for conn_id in conn_ids if conn_id is not None],
+        }
+
     def read(self, create):
-        if self._bin_data:
+        if self._is_list:
+            return self.read_list()
+        elif self._bin_data:
             return self.read_data(create)
+        elif self._bin_ctrl:
+            return self.read_bin_ctrl()
         else:
             return self.read_ctrl(create)
 
 
+class _LeaseIO(object):
+
+    @staticmethod
+    def target_dir(workspace, zone_id):
+        # e.g.
+        # id= $ID_LEASE/server-foo-1234-0123abcd
+        # path= $WORKSPACE/leases/
+        return path_join(workspace, 'leases')
+
+    @classmethod
+    def target_file(cls, workspace, zone_id):
+        # e.g.
+        # id= $ID_LEASE/server-foo-1234-0123abcd
+        # path= $WORKSPACE/leases/server-foo-1234-0123abcd
+        return path_join(cls.target_dir(workspace, zone_id), id_split(zone_id)[1])
+
+    @classmethod
+    def delete(cls, workspace, zone_id):
+        try:
+            remove_file(cls.target_file(workspace, zone_id))
+        except FileNotFoundError:
+            pass
+
+    def __init__(self, workspace, zone_id):
+        self._workspace = workspace
+        self._zone_id = zone_id
+        self._dir = self.target_dir(workspace, zone_id)
+        self._file = self.target_file(workspace, zone_id)
+
+    def write(self, data):
+        in_dir(self._dir, write_file, self._file, json.dumps(data))
+
+    def read(self, create):
+        return load_or_create(self._file, load_json, '{}', create)
+
+    def close(self):
+        pass
+
+
 class FsTcpTunnelIO(BaseIO):
 
     _ROUTES = {
         ID_SERVER_LISTEN_BACKLOG:   _ServerListenBacklogIO,
         ID_CONNECTION:              _ConnectionIO,
+        ID_LEASE:                   _LeaseIO,
     }
 
     _io_interval_msec = 100  # INTERVAL * IOPS = 1000ms
-    _last_io_timestamp = 0
-    _sema = Semaphore(1)
+    _io_workers = 4
+    _weights = dict()  # address or address/conn_num -> weight
+    _zones = dict()  # zone_id -> (flow, weight, kind)
+    MAX_KNOWN_ZONES = 4096
+    # the flow of the IO outside of the zones, see run_metered()
+    METERED_FLOW = 'metered'
+    _dispatcher = None
+    _dispatcher_lock = Lock()
 
     @classmethod
     def set_iops(cls, iops):
         cls._io_interval_msec = 1000 / iops
+        if cls._dispatcher is not None:
+            cls._dispatcher.set_interval(cls._io_interval_msec)
+
+    @classmethod
+    def set_weights(cls, weights):
+        for name, weight in weights.items():
+            if weight <= 0:
+                raise ValueError('Invalid weight for %s: %s' % (name, weight))
+        cls._weights = dict(weights)
+        cls._zones = dict()
+
+    @classmethod
+    def set_keep_files_open(cls, keep):
+        # pread/pwrite are posix only
+        _ConnectionIO.KEEP_FILES_OPEN = bool(keep) and os.name == 'posix'
+
+    @classmethod
+    def flow(cls, zone_id):
+        # e.g.
+        # id= $ID_CONNECTION/foo.com/1/$ID_CONN_C2S_LOG/3
+        # flow= $ID_CONNECTION/foo.com/1, weight of "foo.com/1" or "foo.com"
+        # id= $ID_SERVER_LISTEN_BACKLOG/foo.com/0123456789abcdef
+        # flow= $ID_SERVER_LISTEN_BACKLOG/foo.com, weight of "foo.com"
+        # id= $ID_CONNECTION/foo.com, the list of its connections
+        # flow= $ID_CONNECTION/foo.com, weight of "foo.com"
+        segments = id_split(zone_id)
+        if segments[0] == ID_CONNECTION and len(segments) > 2:
+            segments = segments[:3]
+            # the generation doesn't matter to the weights
+            conn_num = split_conn_id(segments[2])[0]
+            weight = cls._weights.get(id_join(segments[1], conn_num))
+        else:
+            segments = segments[:2]
+            weight = None
+        if weight is None:
+            weight = cls._weights.get(segments[1], 1)
+        return id_join(*segments), weight
+
+    @classmethod
+    def dispatcher(cls):
+        # The worker threads don't survive a fork,
+        # so every process starts its own dispatcher.
+        with cls._dispatcher_lock:
+            if cls._dispatcher is None or cls._dispatcher.pid != getpid():
+                cls._dispatcher = IODispatcher(cls._io_interval_msec, cls._io_workers)
+            return cls._dispatcher
+
+    @classmethod
+    def run_metered(cls, func, *args):
+        return cls.dispatcher().call(None, cls.METERED_FLOW, 1, False, func, *args)
 
     @classmethod
     def route(cls, zone_id):
@@ -243,45 +791,117 @@ class FsTcpTunnelIO(BaseIO):
             raise ValueError('Unknown zone_id: %s' % zone_id)
         return real_type
 
+    @classmethod
+    def set_workspace_format(cls, fmt):
+        if fmt not in _AddressFormat.FORMATS:
+            raise ValueError('Unknown workspace format: %s' % fmt)
+        _AddressFormat.NEW_FORMAT = fmt
+
+    @classmethod
+    def detect_format(cls, workspace, address):
+        zone_id = id_join(ID_SERVER_LISTEN_BACKLOG, address)
+        return cls._atomic(zone_id, None, True,
+                           _AddressFormat.detect, workspace, address)
+
+    @classmethod
+    def locate(cls, workspace, zone_id):
+        if id_head(zone_id) == ID_SERVER_LISTEN_BACKLOG and \
+                _ServerListenBacklogIO.is_list(zone_id):
+            # a sharded backlog changes in any of its dirs
+            t_dirs = _ServerListenBacklogIO.shard_dirs(workspace, zone_id)
+            return t_dirs[0] if len(t_dirs) == 1 else tuple(t_dirs)
+        return cls.route(zone_id).target_dir(workspace, zone_id)
+
+    @staticmethod
+    def is_written_in_place(name):
+        # e.g. c2s_log.3, c2s_ack
+        return name.split('.')[0] in (_ConnectionIO.FILENAME_MAP[ID_CONN_C2S_LOG],
+                                      _ConnectionIO.FILENAME_MAP[ID_CONN_S2C_LOG],
+                                      _ConnectionIO.FILENAME_MAP[ID_CONN_C2S_ACK],
+                                      _ConnectionIO.FILENAME_MAP[ID_CONN_S2C_ACK])
+
     @classmethod
     def delete(cls, workspace, zone_id):
         # return cls.route(zone_id).delete(workspace, zone_id)
-        return cls._atomic(cls.route(zone_id).delete, workspace, zone_id)
+        return cls._atomic(zone_id, None, False,
+                           cls.route(zone_id).delete, workspace, zone_id)
+
+    @classmethod
+    def prune(cls, workspace, zone_id):
+        return cls._atomic(zone_id, None, False,
+                           _ConnectionIO.prune, workspace, zone_id)
 
     def __init__(self, workspace, zone_id):
         super(FsTcpTunnelIO, self).__init__(workspace, zone_id)
         real_type = self.route(zone_id)
         self._real_io = real_type(workspace, zone_id)
+        # Reads and updates of ctrl, ack and requests unblock the peer,
+        # they go ahead of the bulk data, see IODispatcher.
+        self._urgent = not is_data_zone(zone_id)
+
+    def close(self):
+        self._real_io.close()
+
+    @staticmethod
+    def zone_kind(zone_id):
+        # e.g. "backlog", "id_conn_c2s_log", for the metrics
+        segments = id_split(zone_id)
+        if segments[0] == ID_CONNECTION:
+            return segments[3] if len(segments) > 3 else 'connection'
+        if segments[0] == ID_LEASE:
+            return 'lease'
+        return 'backlog'
+
+    @classmethod
+    def zone_info(cls, zone_id):
+        # The zone ids of a connection are used over and over,
+        # they are parsed once.
+        info = cls._zones.get(zone_id)
+        if info is None:
+            if len(cls._zones) >= cls.MAX_KNOWN_ZONES:
+                cls._zones.clear()
+            flow, weight = cls.flow(zone_id)
+            info = cls._zones[zone_id] = (flow, weight, cls.zone_kind(zone_id))
+        return info
 
     @classmethod
-    def _atomic(cls, func, *args, **kwargs):
-        cls._sema.acquire(timeout=10)  # FIXME
+    def _atomic(cls, zone_id, key, urgent, func, *args):
+        start_time = monotonic()
         try:
-            now = cls.now()
-            age = now - cls._last_io_timestamp
-            if age < cls._io_interval_msec:
-                cls.sleep(cls._io_interval_msec - age)
-            try:
-                return func(*args, **kwargs)
-            finally:
-                cls._last_io_timestamp = now
+            return cls._dispatch(zone_id, key, urgent, func, *args)
+        finally:
+            end_time = monotonic()
+            METRICS.observe('kamui_io_op_seconds', end_time - start_time,
+                            op=func.__name__, zone=cls.zone_info(zone_id)[2])
+            if TRACING.enabled:
+                TRACING.span('io', func.__name__, start_time, end_time, zone_id=zone_id)
+
+    @classmethod
+    def _dispatch(cls, zone_id, key, urgent, func, *args):
+        flow, weight, _ = cls.zone_info(zone_id)
+        try:
+            return cls.dispatcher().call(key, flow, weight, urgent, func, *args)
         except OSError:
             # On windows, it may cause PermissionError if
             # someone else opened the same file.
             raise EAgain('resource temporarily unavailable.')
-        finally:
-            cls._sema.release()
 
     def write(self, data):
-        return self._atomic(self._real_io.write, data)
+        return self._atomic(self._zone_id, None, self._urgent,
+                            self._real_io.write, data)
 
     def read(self, create=False):
-        return self._atomic(self._real_io.read, create)
+        return self._atomic(self._zone_id, ('read', self._zone_id, create), self._urgent,
+                            self._real_io.read, create)
 
-    @staticmethod
-    def now():
-        return monotonic() * 1000
+    def append(self, data):
+        return self._atomic(self._zone_id, None, False,
+                            self._real_io.append, data)
 
-    @staticmethod
-    def sleep(interval_msec):
-        os_sleep(interval_msec / 1000)
+    def read_at(self, offset):
+        return self._atomic(self._zone_id, ('read_at', self._zone_id, offset), False,
+                            self._real_io.read_at, offset)
+
+    def claim(self):
+        return self._atomic(self._zone_id, None, True,
+                            self._real_io.claim)
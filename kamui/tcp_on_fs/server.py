@@ -3,12 +3,27 @@ from getopt import getopt
 
 from kamui.base_stream import BaseServer
 from kamui.tcp_on_fs.io import FsTcpTunnelIO
+from kamui.tcp_on_fs.sim_io import (
+    parse_sim_profile,
+    SimulatedFsTcpTunnelIO,
+)
 from kamui.proxy_runner import ServerWorkspaceProcess
+from kamui.tcp_on_shm.server import ShmTcpTunnelServerWorkspaceProcess
 
 
+DEFAULT_FLUSH_DEADLINE = 10
 DEFAULT_IOPS = 10
+DEFAULT_LEASE_TIMEOUT = 60
+DEFAULT_MAX_POLL_INTERVAL = 100
+DEFAULT_MAX_SEGMENT_SIZE = 1024 * 1024
+DEFAULT_MEDIUM = 'fs'
+DEFAULT_METRICS_PORT = 0
+DEFAULT_STATS_INTERVAL = 0
 DEFAULT_TIME_SLICE_INTERVAL = 10
+DEFAULT_WINDOW_SIZE = 8
+DEFAULT_WORKERS = 1
 DEFAULT_WORKSPACE = './_workspace'
+DEFAULT_WORKSPACE_FORMAT = 1
 
 
 class FsTcpTunnelServer(BaseServer):
@@ -19,15 +34,53 @@ class FsTcpTunnelServerWorkspaceProcess(ServerWorkspaceProcess):
     PROXY_SERVER = FsTcpTunnelServer
 
 
+class SimulatedFsTcpTunnelServer(BaseServer):
+    IO = SimulatedFsTcpTunnelIO
+
+
+class SimulatedFsTcpTunnelServerWorkspaceProcess(ServerWorkspaceProcess):
+    PROXY_SERVER = SimulatedFsTcpTunnelServer
+
+
+_PROCESS_TYPES = {
+    'fs':   FsTcpTunnelServerWorkspaceProcess,
+    'shm':  ShmTcpTunnelServerWorkspaceProcess,
+    'sim':  SimulatedFsTcpTunnelServerWorkspaceProcess,
+}
+
+
 def run(iops,
         proxy_address, target_address,
-        time_slice_interval, workspace):
-    pr = FsTcpTunnelServerWorkspaceProcess({
+        time_slice_interval, workspace, notify=False, weights=None,
+        max_segment_size=DEFAULT_MAX_SEGMENT_SIZE,
+        flush_deadline=DEFAULT_FLUSH_DEADLINE, medium=DEFAULT_MEDIUM,
+        workers=DEFAULT_WORKERS, sim_profile=None,
+        metrics_port=DEFAULT_METRICS_PORT, stats_interval=DEFAULT_STATS_INTERVAL,
+        trace_file=None, max_poll_interval=DEFAULT_MAX_POLL_INTERVAL, sweep=False,
+        keep_files_open=False, lease_timeout=DEFAULT_LEASE_TIMEOUT,
+        workspace_format=DEFAULT_WORKSPACE_FORMAT, window_size=1):
+    if medium == 'sim':
+        SimulatedFsTcpTunnelIO.configure(**(sim_profile or {}))
+    pr = _PROCESS_TYPES[medium]({
+        'flush_deadline':           int(flush_deadline),
         'iops':                     int(iops),
+        'keep_files_open':          bool(keep_files_open),
+        'lease_timeout':            int(lease_timeout),
+        'max_poll_interval':        int(max_poll_interval),
+        'max_segment_size':         int(max_segment_size),
+        'metrics_port':             int(metrics_port),
+        'notify':                   bool(notify),
         'proxy_address':            proxy_address,
+        'stats_interval':           int(stats_interval),
+        'sweep':                    bool(sweep),
         'target_address':           tuple(target_address),
         'time_slice_interval':      int(time_slice_interval),
+        'trace_file':               trace_file,
+        'weights':                  dict(weights or {}),
+        'window_size':              int(window_size),
+        'workers':                  int(workers),
         'workspace':                workspace,
+        'workspace_format':         int(workspace_format),
     })
     pr.run()
 
@@ -36,47 +89,124 @@ def usage():
     sys.stderr.writelines([
         'Usage: %s <ARGS> \n' % sys.argv[0],
         '  <ARGS> can be: \n',
+        '  --flush-deadline <NUMBER>        (OPTIONAL,DEFAULT=%s) max msecs to wait for more tcp data before sending a segment.\n' % DEFAULT_FLUSH_DEADLINE,
         '  --iops <NUMBER>                  (OPTIONAL,DEFAULT=%s) max iops for disk reading and writing.\n' % DEFAULT_IOPS,
+        '  --keep-files-open                (OPTIONAL) keep segment logs and acks open, posix only, not for NFS.\n',
+        '  --lease-timeout <NUMBER>         (OPTIONAL,DEFAULT=%s) secs until the connections and requests of a dead peer are reclaimed, 0 means off.\n' % DEFAULT_LEASE_TIMEOUT,
+        '  --max-poll-interval <NUMBER>     (OPTIONAL,DEFAULT=%s) max msecs an idle connection backs off between polls, the max wake-up latency.\n' % DEFAULT_MAX_POLL_INTERVAL,
+        '  --max-segment-size <NUMBER>      (OPTIONAL,DEFAULT=%s) max bytes of one segment on the shared medium.\n' % DEFAULT_MAX_SEGMENT_SIZE,
+        '  --medium fs|shm|sim              (OPTIONAL,DEFAULT=%s) shm carries windowed segments in memory-mapped rings, both sides on the same host;\n' % DEFAULT_MEDIUM,
+        '                                   sim is fs with a simulated slow medium, see --sim-profile.\n',
+        '  --metrics-port <PORT>            (OPTIONAL,DEFAULT=%s) serve metrics in the Prometheus text format on 127.0.0.1, 0 means off.\n' % DEFAULT_METRICS_PORT,
+        '  --notify                         (OPTIONAL) wake up on inotify events, for a workspace on a local filesystem.\n',
         '  --proxy-address <ADDR>           abstract proxy address. This should be the same at both proxy sides.\n',
+        '  --sim-profile <NAME>=<N>,...     (OPTIONAL) for --medium sim: latency, jitter, visibility in msecs, iops, torn in 0~1.\n',
+        '  --stats-interval <NUMBER>        (OPTIONAL,DEFAULT=%s) secs between writing stats to <workspace>/stats, removed on exit, 0 means off.\n' % DEFAULT_STATS_INTERVAL,
         '  --target-address <DOMAIN>,<PORT> target TCP address. DOMAIN can be IP.\n',
+        '  --sweep                          (OPTIONAL) without --notify, one thread stats the workspace for all connections instead of each polling.\n',
         '  --time-slice-interval <NUMBER>   (OPTIONAL,DEFAULT=%s) msecs between each process working frames.\n' % DEFAULT_TIME_SLICE_INTERVAL,
+        '  --trace-file <PATH>              (OPTIONAL) write a chrome://tracing timeline of IO operations and protocol stages.\n',
+        '  --weights <NAME>=<NUMBER>,...    (OPTIONAL) IOPS share of a proxy-address or of one connection (ADDR/CONN_NUM), default 1.\n',
+        '  --window-size <NUMBER>           (OPTIONAL,DEFAULT=%s) max in-flight segments per direction, 1 means stop-and-wait.\n' % DEFAULT_WINDOW_SIZE,
+        '  --workers <NUMBER>               (OPTIONAL,DEFAULT=%s) worker processes accepting on the same proxy-address, sharing the iops.\n' % DEFAULT_WORKERS,
         '  --workspace <PATH>               (OPTIONAL,DEFAULT=%s) workspace dir. This should be the same at both proxy sides.\n' % DEFAULT_WORKSPACE,
+        '  --workspace-format <NUMBER>      (OPTIONAL,DEFAULT=%s) layout of a proxy-address new to the workspace, 1 is the flat one of old versions, 2 is sharded and needs both sides upgraded.\n' % DEFAULT_WORKSPACE_FORMAT,
         '\n',
     ])
 
 
 def parse_and_run():
     pairs, _ = getopt(sys.argv[1:], 'h', [
+        'flush-deadline=',
         'iops=',
+        'keep-files-open',
+        'lease-timeout=',
+        'max-poll-interval=',
+        'max-segment-size=',
+        'medium=',
+        'metrics-port=',
+        'notify',
         'proxy-address=',
+        'sim-profile=',
+        'stats-interval=',
+        'sweep',
         'target-address=',
         'time-slice-interval=',
+        'trace-file=',
+        'weights=',
+        'window-size=',
+        'workers=',
         'workspace=',
+        'workspace-format=',
         'help',
     ])
 
     pa, ta, query = None, None, False
     iops, ti, ws = DEFAULT_IOPS, DEFAULT_TIME_SLICE_INTERVAL, DEFAULT_WORKSPACE
+    mss, fd, md = DEFAULT_MAX_SEGMENT_SIZE, DEFAULT_FLUSH_DEADLINE, DEFAULT_MEDIUM
+    wnd, nt, wt, wk = DEFAULT_WINDOW_SIZE, False, {}, DEFAULT_WORKERS
+    sp, mp, si, tf = {}, DEFAULT_METRICS_PORT, DEFAULT_STATS_INTERVAL, None
+    mpi, sw, kfo, lt = DEFAULT_MAX_POLL_INTERVAL, False, False, DEFAULT_LEASE_TIMEOUT
+    wf = DEFAULT_WORKSPACE_FORMAT
     for arg, value in pairs:
-        if '--iops' == arg:
+        if '--flush-deadline' == arg:
+            fd = int(value)
+        elif '--iops' == arg:
             iops = int(value)
+        elif '--keep-files-open' == arg:
+            kfo = True
+        elif '--lease-timeout' == arg:
+            lt = int(value)
+        elif '--max-poll-interval' == arg:
+            mpi = int(value)
+        elif '--max-segment-size' == arg:
+            mss = int(value)
+        elif '--medium' == arg:
+            md = value
+        elif '--metrics-port' == arg:
+            mp = int(value)
+        elif '--notify' == arg:
+            nt = True
         elif '--proxy-address' == arg:
             pa = value
+        elif '--sim-profile' == arg:
+            sp = parse_sim_profile(value)
+        elif '--stats-interval' == arg:
+            si = int(value)
+        elif '--sweep' == arg:
+            sw = True
         elif '--target-address' == arg:
             ta = value.split(',')
             ta[1] = int(ta[1])
         elif '--time-slice-interval' == arg:
             ti = int(value)
+        elif '--trace-file' == arg:
+            tf = value
+        elif '--weights' == arg:
+            for pair in value.split(','):
+                name, weight = pair.rsplit('=', 1)
+                wt[name] = float(weight)
+        elif '--window-size' == arg:
+            wnd = int(value)
+        elif '--workers' == arg:
+            wk = int(value)
         elif '--workspace' == arg:
             ws = value
+        elif '--workspace-format' == arg:
+            wf = int(value)
         elif arg in ('-h', '--help'):
             query = True
 
-    if query or None in (pa, ta):
+    if query or md not in _PROCESS_TYPES or None in (pa, ta):
         usage()
         sys.exit(1)
 
-    run(iops, pa, ta, ti, ws)
+    run(iops, pa, ta, ti, ws,
+        notify=nt, weights=wt, max_segment_size=mss,
+        flush_deadline=fd, medium=md, workers=wk, sim_profile=sp,
+        metrics_port=mp, stats_interval=si, trace_file=tf,
+        max_poll_interval=mpi, sweep=sw, keep_files_open=kfo,
+        lease_timeout=lt, workspace_format=wf, window_size=wnd)
 
 
 if __name__ == '__main__':
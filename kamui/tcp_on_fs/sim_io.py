@@ -0,0 +1,189 @@
+from functools import partial
+from os import (
+    close as os_close,
+    O_CREAT,
+    O_RDWR,
+)
+from os.path import join as path_join
+from random import (
+    random,
+    randrange,
+    uniform,
+)
+from struct import Struct
+from tempfile import gettempdir
+from threading import Lock
+from time import (
+    monotonic,
+    sleep,
+)
+
+from kamui.base_stream import (
+    id_head,
+    id_segments,
+    EAgain,
+    ID_SERVER_LISTEN_BACKLOG,
+)
+from kamui.io_dispatcher import copy_result
+from kamui.tcp_on_fs.io import (
+    open_file,
+    overwrite_fd,
+    pread_fd,
+    FsTcpTunnelIO,
+)
+
+try:
+    from fcntl import (
+        lockf,
+        LOCK_EX,
+        LOCK_UN,
+    )
+except ImportError:
+    # not posix, the slot is only shared by the threads of a process
+    lockf = None
+
+
+# e.g. "latency=20,jitter=5,iops=50,visibility=1000,torn=0.01"
+SIM_PROFILE_KEYS = {
+    'latency':      'latency_ms',
+    'jitter':       'jitter_ms',
+    'iops':         'iops',
+    'visibility':   'visibility_ms',
+    'torn':         'torn_rate',
+}
+
+
+def parse_sim_profile(raw):
+    profile = dict()
+    for pair in raw.split(','):
+        if not pair:
+            continue
+        name, value = pair.split('=', 1)
+        if name not in SIM_PROFILE_KEYS:
+            raise ValueError('Unknown sim profile key: %s' % name)
+        profile[SIM_PROFILE_KEYS[name]] = float(value)
+    return profile
+
+
+class _MediumClock(object):
+    # The IOPS ceiling of the simulated medium, shared by every process
+    # on the host which uses the same medium name. The next free slot
+    # lives in a small file under a lock, CLOCK_MONOTONIC is the same
+    # for all the processes.
+
+    _SLOT = Struct('<d')
+
+    def __init__(self, name):
+        self._path = path_join(gettempdir(), 'kamui-sim-medium-%s' % name)
+        self._lock = Lock()
+
+    def take(self, interval):
+        # Returns secs to wait for the slot of the next operation.
+        with self._lock:
+            fd = open_file(self._path, O_RDWR | O_CREAT)
+            try:
+                if lockf is not None:
+                    lockf(fd, LOCK_EX)
+                raw = pread_fd(fd, self._SLOT.size, 0)
+                next_slot = self._SLOT.unpack(raw)[0] if len(raw) == self._SLOT.size else 0
+                now = monotonic()
+                slot = max(now, next_slot)
+                overwrite_fd(fd, self._SLOT.pack(slot + interval))
+                if lockf is not None:
+                    lockf(fd, LOCK_UN)
+            finally:
+                os_close(fd)
+        return slot - now
+
+
+class SimulatedFsTcpTunnelIO(FsTcpTunnelIO):
+    # A slow shared medium on top of a local dir, for judging the
+    # transport on one box:
+    #   latency, jitter: secs every operation takes on the medium
+    #   iops: max operations per sec of the medium, for all processes
+    #   visibility: secs a read may return a stale result, as an NFS
+    #       attribute cache does; own writes are seen at once
+    #   torn: the chance of a read seeing a file being written
+    # Everything is off by default.
+
+    _latency = 0
+    _jitter = 0
+    _visibility = 0
+    _torn_rate = 0
+    _clock = None
+    _interval = 0
+
+    MAX_CACHED_ZONES = 4096
+
+    _cache_lock = Lock()
+    _cache = dict()  # zone_id -> {read key -> (time, result)}
+
+    @classmethod
+    def configure(cls, latency_ms=0, jitter_ms=0, iops=0, visibility_ms=0, torn_rate=0,
+                  medium_name='default'):
+        cls._latency = latency_ms / 1000
+        cls._jitter = jitter_ms / 1000
+        cls._visibility = visibility_ms / 1000
+        cls._torn_rate = torn_rate
+        cls._interval = 1 / iops if iops > 0 else 0
+        cls._clock = _MediumClock(medium_name) if iops > 0 else None
+        with cls._cache_lock:
+            cls._cache.clear()
+
+    @classmethod
+    def _medium_op(cls, tearable, func, *args):
+        delay = 0
+        if cls._clock is not None:
+            delay = cls._clock.take(cls._interval)
+        delay += max(0, cls._latency + uniform(-cls._jitter, cls._jitter))
+        if delay > 0:
+            sleep(delay)
+
+        result = func(*args)
+        if tearable and cls._torn_rate and random() < cls._torn_rate:
+            if isinstance(result, dict) and result:
+                raise EAgain('someone may be writing this zone.')
+            if isinstance(result, (bytes, memoryview)) and len(result) > 1:
+                return bytes(result[:randrange(len(result))])
+        return result
+
+    @classmethod
+    def _forget(cls, zone_id):
+        with cls._cache_lock:
+            cls._cache.pop(zone_id, None)
+
+    @classmethod
+    def _dispatch(cls, zone_id, key, urgent, func, *args):
+        # $key is None for the operations which change the medium.
+        if key is None:
+            cls._forget(zone_id)
+            return super(SimulatedFsTcpTunnelIO, cls)._dispatch(
+                zone_id, key, urgent, partial(cls._medium_op, False, func), *args)
+
+        if cls._visibility > 0:
+            with cls._cache_lock:
+                cached = cls._cache.get(zone_id, {}).get(key)
+            if cached is not None and monotonic() - cached[0] < cls._visibility:
+                return copy_result(cached[1])
+
+        # A listing is never torn, the files are.
+        tearable = not (id_head(zone_id) == ID_SERVER_LISTEN_BACKLOG and
+                        id_segments(zone_id) == 2)
+        result = super(SimulatedFsTcpTunnelIO, cls)._dispatch(
+            zone_id, key, urgent, partial(cls._medium_op, tearable, func), *args)
+
+        if cls._visibility > 0:
+            with cls._cache_lock:
+                if len(cls._cache) > cls.MAX_CACHED_ZONES:
+                    cls._prune()
+                cls._cache.setdefault(zone_id, {})[key] = (monotonic(), copy_result(result))
+        return result
+
+    @classmethod
+    def _prune(cls):
+        # under cls._cache_lock, e.g. zones deleted by the peer
+        expire_time = monotonic() - cls._visibility
+        for zone_id in list(cls._cache):
+            cached = cls._cache[zone_id]
+            if all(item[0] < expire_time for item in cached.values()):
+                del cls._cache[zone_id]
@@ -0,0 +1,18 @@
+from kamui.base_stream import BaseClient
+from kamui.tcp_on_shm.io import (
+    check_window_size,
+    ShmTcpTunnelIO,
+)
+from kamui.proxy_runner import ClientWorkspaceProcess
+
+
+class ShmTcpTunnelClient(BaseClient):
+    IO = ShmTcpTunnelIO
+
+
+class ShmTcpTunnelClientWorkspaceProcess(ClientWorkspaceProcess):
+    PROXY_CLIENT = ShmTcpTunnelClient
+
+    def __init__(self, *args, **kwargs):
+        super(ShmTcpTunnelClientWorkspaceProcess, self).__init__(*args, **kwargs)
+        check_window_size(self._proxy_config.window_size)
@@ -0,0 +1,319 @@
+import mmap
+from os import (
+    close as os_close,
+    fstat,
+    ftruncate,
+    open as os_open,
+    remove as remove_file,
+    O_CREAT,
+    O_RDWR,
+)
+from os.path import join as path_join
+from struct import Struct
+from threading import Lock
+
+from kamui.base_stream import (
+    EAgain,
+    id_head,
+    id_segments,
+    id_split,
+    ID_CONNECTION,
+    ID_CONN_C2S_ACK,
+    ID_CONN_C2S_LOG,
+    ID_CONN_S2C_ACK,
+    ID_CONN_S2C_LOG,
+)
+from kamui.logging import get_logger
+from kamui.records import (
+    pack_ctrl,
+    unpack_ctrl,
+    CTRL_RECORD,
+    FRAME_HEADER,
+    TornRecord,
+)
+from kamui.tcp_on_fs.io import (
+    _ConnectionIO,
+    ensure_dir,
+    FsTcpTunnelIO,
+)
+
+
+LOG = get_logger(__name__)
+
+
+# --- layout of a connection file ---
+#
+#   0       c2s ack slot
+#   64      s2c ack slot
+#   128     c2s ring counters: head, tail
+#   160     s2c ring counters: head, tail
+#   192     c2s closed flag, s2c closed flag
+#   256     c2s ring data, $RING_SIZE bytes
+#   256 + $RING_SIZE
+#           s2c ring data, $RING_SIZE bytes
+#
+# Each ring has a single producer (the sender) and a single consumer
+# (the receiver). The producer only moves the head and the consumer
+# only moves the tail, both count bytes since the beginning of the
+# stream. A counter is stored along with its complement, so a torn
+# update is detected instead of being taken as a valid position.
+
+_COUNTER = Struct('<QQ')
+_MASK = 0xffffffffffffffff
+
+_SLOT_SIZE = 64
+_HEADER_SIZE = 256
+
+_DIRECTIONS = {
+    ID_CONN_C2S_ACK:    0,
+    ID_CONN_C2S_LOG:    0,
+    ID_CONN_S2C_ACK:    1,
+    ID_CONN_S2C_LOG:    1,
+}
+
+
+def check_window_size(window_size):
+    # Only the windowed protocol goes through the rings.
+    if window_size <= 1:
+        LOG.warning('window size %s is stop-and-wait, which goes through '
+                    'files instead of shared memory.' % window_size)
+
+
+class _ShmConnectionFile(object):
+    # one mapped file per connection, shared by the zones of it
+
+    RING_SIZE = 8 * 1024 * 1024
+    FILENAME = 'shm'
+
+    _lock = Lock()
+    _opened = dict()  # path -> _ShmConnectionFile
+
+    @classmethod
+    def get(cls, workspace, zone_id):
+        t_dir = _ConnectionIO.target_dir(workspace, zone_id)
+        path = path_join(t_dir, cls.FILENAME)
+        with cls._lock:
+            opened = cls._opened.get(path)
+            if opened is not None and opened.closed:
+                # The connection number is reused,
+                # the mapping of the old connection is stale.
+                opened = None
+            if opened is None:
+                ensure_dir(t_dir)
+                opened = cls(path)
+                if opened.closed:
+                    # the peer has not removed the old file yet
+                    try:
+                        remove_file(path)
+                    except FileNotFoundError:
+                        pass
+                    opened = cls(path)
+                cls._opened[path] = opened
+            return opened
+
+    def __init__(self, path):
+        self.path = path
+        size = _HEADER_SIZE + 2 * self.RING_SIZE
+        fd = os_open(path, O_RDWR | O_CREAT, 0o600)
+        try:
+            if fstat(fd).st_size < size:
+                # Both sides may do this, the new space is zero-filled
+                # which is a valid empty state.
+                ftruncate(fd, size)
+            self.buf = mmap.mmap(fd, size)
+        finally:
+            os_close(fd)
+
+    # --- ack slots ---
+
+    def write_slot(self, direction, raw):
+        offset = direction * _SLOT_SIZE
+        self.buf[offset:offset + len(raw)] = raw
+
+    def read_slot(self, direction):
+        offset = direction * _SLOT_SIZE
+        raw = self.buf[offset:offset + CTRL_RECORD.size]
+        if not any(raw):
+            return None
+        return raw
+
+    # --- rings ---
+
+    def _load(self, offset):
+        value, check = _COUNTER.unpack_from(self.buf, offset)
+        if value ^ check != _MASK:
+            raise EAgain('someone may be writing this zone.')
+        return value
+
+    def _store(self, offset, value):
+        _COUNTER.pack_into(self.buf, offset, value, value ^ _MASK)
+
+    def _counters(self, direction):
+        head_offset = 128 + direction * 32
+        return head_offset, head_offset + 16
+
+    def _ring_offset(self, direction):
+        return _HEADER_SIZE + direction * self.RING_SIZE
+
+    def _position(self, offset):
+        # an untouched counter is all zero
+        if not any(self.buf[offset:offset + 16]):
+            return 0
+        return self._load(offset)
+
+    def push(self, direction, data):
+        if len(data) > self.RING_SIZE:
+            raise ValueError('segment is larger than the ring: %s' % len(data))
+        head_offset, tail_offset = self._counters(direction)
+        head = self._position(head_offset)
+        tail = self._position(tail_offset)
+        if self.RING_SIZE - (head - tail) < len(data):
+            raise EAgain('ring full')
+
+        base = self._ring_offset(direction)
+        start = head % self.RING_SIZE
+        first = min(len(data), self.RING_SIZE - start)
+        view = memoryview(data)
+        self.buf[base + start:base + start + first] = view[:first]
+        if first < len(data):
+            self.buf[base:base + len(data) - first] = view[first:]
+        # publish the data after it's written
+        self._store(head_offset, head + len(data))
+
+    def pull(self, direction, position):
+        # Everything before $position is consumed,
+        # returns the bytes from $position to the head.
+        head_offset, tail_offset = self._counters(direction)
+        head = self._position(head_offset)
+        if position > head:
+            raise BrokenPipeError('bad ring position')
+        if self._position(tail_offset) != position:
+            self._store(tail_offset, position)
+        if position == head:
+            return b''
+
+        base = self._ring_offset(direction)
+        start = position % self.RING_SIZE
+        length = head - position
+        first = min(length, self.RING_SIZE - start)
+        if first == length:
+            # contiguous, hand out the mapped memory itself
+            return memoryview(self.buf)[base + start:base + start + length]
+        return (self.buf[base + start:base + start + first] +
+                self.buf[base:base + length - first])
+
+    # --- life cycle ---
+
+    @property
+    def closed(self):
+        return bool(self.buf[192] and self.buf[193])
+
+    def close_direction(self, direction):
+        self.buf[192 + direction] = 1
+        if self.closed:
+            with self._lock:
+                self._opened.pop(self.path, None)
+            try:
+                remove_file(self.path)
+            except FileNotFoundError:
+                pass
+
+
+class _ShmConnectionIO(object):
+
+    def __init__(self, workspace, zone_id):
+        self._workspace = workspace
+        self._zone_id = zone_id
+        self._direction = _DIRECTIONS[id_split(zone_id)[3]]
+        self._is_ack = id_split(zone_id)[3] in (ID_CONN_C2S_ACK, ID_CONN_S2C_ACK)
+
+    def _file(self):
+        return _ShmConnectionFile.get(self._workspace, self._zone_id)
+
+    def write(self, data):
+        assert self._is_ack
+        self._file().write_slot(self._direction, pack_ctrl(data))
+
+    def read(self, create):
+        assert self._is_ack
+        raw = self._file().read_slot(self._direction)
+        if raw is None:
+            return None
+        try:
+            return unpack_ctrl(raw)
+        except TornRecord:
+            raise EAgain('someone may be writing this zone.')
+
+    def append(self, data):
+        assert not self._is_ack
+        if isinstance(data, tuple):
+            data = b''.join(data)
+        self._file().push(self._direction, data)
+
+    def read_at(self, offset):
+        assert not self._is_ack
+        return self._file().pull(self._direction, offset)
+
+    def delete(self):
+        # The sender deletes its ack zone at last, when the direction is
+        # closed, the file goes with the second one of the directions.
+        if self._is_ack:
+            self._file().close_direction(self._direction)
+
+
+class ShmTcpTunnelIO(FsTcpTunnelIO):
+    # Segment logs and acks of the windowed protocol go through ring
+    # buffers in a mapped file, which suits a tmpfs or shared-memory
+    # backed workspace with both proxies on the same host. The request
+    # backlog and the stop-and-wait zones are still files.
+    #
+    # The memory operations are not throttled by the IOPS limit.
+
+    LOG_ROTATE_BYTES = None  # the ring reuses its space
+    # a frame is pushed at once, it must fit in an empty ring
+    MAX_FRAME_PAYLOAD = _ShmConnectionFile.RING_SIZE - FRAME_HEADER.size
+    POLL_INTERVAL = 0.001
+
+    @staticmethod
+    def is_shm_zone(zone_id):
+        return (id_head(zone_id) == ID_CONNECTION and id_segments(zone_id) > 3 and
+                id_split(zone_id)[3] in _DIRECTIONS)
+
+    @classmethod
+    def locate(cls, workspace, zone_id):
+        if id_head(zone_id) == ID_CONNECTION:
+            # writes to a mapped file raise no change notification
+            return None
+        return super(ShmTcpTunnelIO, cls).locate(workspace, zone_id)
+
+    @classmethod
+    def delete(cls, workspace, zone_id):
+        if cls.is_shm_zone(zone_id):
+            return _ShmConnectionIO(workspace, zone_id).delete()
+        return super(ShmTcpTunnelIO, cls).delete(workspace, zone_id)
+
+    def __init__(self, workspace, zone_id):
+        super(ShmTcpTunnelIO, self).__init__(workspace, zone_id)
+        self._shm_io = None
+        if self.is_shm_zone(zone_id):
+            self._shm_io = _ShmConnectionIO(workspace, zone_id)
+
+    def write(self, data):
+        if self._shm_io is not None:
+            return self._shm_io.write(data)
+        return super(ShmTcpTunnelIO, self).write(data)
+
+    def read(self, create=False):
+        if self._shm_io is not None:
+            return self._shm_io.read(create)
+        return super(ShmTcpTunnelIO, self).read(create)
+
+    def append(self, data):
+        if self._shm_io is not None:
+            return self._shm_io.append(data)
+        return super(ShmTcpTunnelIO, self).append(data)
+
+    def read_at(self, offset):
+        if self._shm_io is not None:
+            return self._shm_io.read_at(offset)
+        return super(ShmTcpTunnelIO, self).read_at(offset)
@@ -0,0 +1,18 @@
+from kamui.base_stream import BaseServer
+from kamui.tcp_on_shm.io import (
+    check_window_size,
+    ShmTcpTunnelIO,
+)
+from kamui.proxy_runner import ServerWorkspaceProcess
+
+
+class ShmTcpTunnelServer(BaseServer):
+    IO = ShmTcpTunnelIO
+
+
+class ShmTcpTunnelServerWorkspaceProcess(ServerWorkspaceProcess):
+    PROXY_SERVER = ShmTcpTunnelServer
+
+    def __init__(self, *args, **kwargs):
+        super(ShmTcpTunnelServerWorkspaceProcess, self).__init__(*args, **kwargs)
+        check_window_size(self._proxy_config.window_size)
@@ -0,0 +1,93 @@
+import json
+from os import getpid
+from threading import (
+    get_ident,
+    Lock,
+)
+from time import monotonic
+
+
+class TraceHook(object):
+    # Receives the trace points of a process, override what's needed.
+    # Times are secs of CLOCK_MONOTONIC, which is the same for every
+    # process on the host.
+
+    def on_span(self, cat, name, start_time, end_time, args):
+        # e.g. an IO operation, or a blocking call with its retries
+        pass
+
+    def on_event(self, cat, name, event_time, args):
+        # e.g. a stage transition of a connection
+        pass
+
+
+class _Tracing(object):
+    # Off by default, the trace points check $enabled before doing
+    # anything, so they cost one attribute lookup when no hook is set.
+
+    def __init__(self):
+        self.enabled = False
+        self._hooks = ()
+
+    def add_hook(self, hook):
+        self._hooks = self._hooks + (hook,)
+        self.enabled = True
+
+    def remove_hook(self, hook):
+        self._hooks = tuple(h for h in self._hooks if h is not hook)
+        self.enabled = bool(self._hooks)
+
+    def span(self, cat, name, start_time, end_time=None, **args):
+        if end_time is None:
+            end_time = monotonic()
+        for hook in self._hooks:
+            hook.on_span(cat, name, start_time, end_time, args)
+
+    def event(self, cat, name, **args):
+        event_time = monotonic()
+        for hook in self._hooks:
+            hook.on_event(cat, name, event_time, args)
+
+
+TRACING = _Tracing()
+
+
+class ChromeTraceExporter(TraceHook):
+    # Writes the Trace Event Format of chrome://tracing and Perfetto.
+    # The closing bracket of the array is optional in the format, so
+    # the file stays readable if the process is killed.
+
+    def __init__(self, path):
+        self._lock = Lock()
+        self._pid = getpid()
+        self._fd = open(path, 'w', buffering=1)
+        self._fd.write('[\n')
+
+    def _write(self, event):
+        line = json.dumps(event, default=str) + ',\n'
+        with self._lock:
+            self._fd.write(line)
+
+    def on_span(self, cat, name, start_time, end_time, args):
+        self._write({
+            'name': name, 'cat': cat, 'ph': 'X',
+            'ts': start_time * 1e6, 'dur': (end_time - start_time) * 1e6,
+            'pid': self._pid, 'tid': get_ident(), 'args': args,
+        })
+
+    def on_event(self, cat, name, event_time, args):
+        self._write({
+            'name': name, 'cat': cat, 'ph': 'i', 's': 't',
+            'ts': event_time * 1e6,
+            'pid': self._pid, 'tid': get_ident(), 'args': args,
+        })
+
+    def close(self):
+        with self._lock:
+            self._fd.close()
+
+
+def start_chrome_trace(path):
+    exporter = ChromeTraceExporter(path)
+    TRACING.add_hook(exporter)
+    return exporter